@@ -5,7 +5,7 @@ def get_tortoise_orm_config(config_obj):
         },
         "apps": {
             "models": {
-                "models": ["db.game", "db.laserball", "db.legacy", "db.player", "db.sm5", "db.tag", "aerich.models"],
+                "models": ["db.game", "db.laserball", "db.legacy", "db.player", "db.sm5", "db.tag", "db.upload", "aerich.models"],
                 "default_connection": "default"
             }
         }
@@ -7,7 +7,8 @@ import re
 from dataclasses import dataclass
 
 from tortoise import Model, fields
-from helpers.cachehelper import cache
+from tortoise.expressions import F
+from helpers.cachehelper import cache, invalidate_game
 from db.types import Team, IntRole, EventType, PlayerStateType, NAME_TO_TEAM
 from typing import List, Optional
 from abc import ABC, abstractmethod
@@ -341,6 +342,42 @@ class EntityEnds(Model):
         return str(self)
 
 
+# values of a game that don't change after it's imported, computed once by statshelper.build_game_summary()
+# so the game pages don't have to go through the events every time
+class GameSummary(Model):
+    id = fields.IntField(pk=True)
+    game_type = fields.CharField(20)  # Game.short_type, "sm5" or "laserball"
+    game_id = fields.IntField()
+    # GAME_SUMMARY_VERSION when it was computed, summaries of other versions are ignored until they're backfilled
+    version = fields.IntField()
+    duration = fields.IntField()  # how long the game actually lasted, in milliseconds
+    team_scores = fields.JSONField()  # key: team element ("Fire"), value: final score with the elimination bonus
+    eliminated_teams = fields.JSONField()  # elements of the teams that had no players left (sm5 only)
+    medic_death_times = fields.JSONField()  # key: team element, value: time the medic died if they did (sm5 only)
+    # key: EntityStarts id, value: {"state_distribution": {...}, "score_components": {...} (sm5 only)}
+    players = fields.JSONField()
+
+    def get_team_score(self, team: Team) -> int:
+        return self.team_scores.get(team.element, 0)
+
+    def is_team_eliminated(self, team: Team) -> bool:
+        return team.element in self.eliminated_teams
+
+    def get_medic_death_time(self, team: Team) -> Optional[int]:
+        return self.medic_death_times.get(team.element)
+
+    def get_player(self, entity_start: EntityStarts) -> Optional[dict]:
+        # json only has string keys
+        return self.players.get(str(entity_start.id))
+
+    def __str__(self) -> str:
+        return f"GameSummary(game_type={self.game_type}, game_id={self.game_id}, version={self.version})"
+
+    class Meta:
+        table = "gamesummary"
+        unique_together = (("game_type", "game_id"),)
+
+
 @dataclass
 class PlayerInfo:
     """Information about a player in one particular game."""
@@ -374,6 +411,7 @@ class Game(Model):
     start_time = fields.DatetimeField()
     mission_duration = fields.IntField() # how long the game can last if it doesn't end early, in milliseconds
     log_time = fields.DatetimeField(auto_now_add=True)
+    edit_version = fields.IntField(default=0)  # bumped by mark_edited() whenever the game changes after import
     # Field that is not currently stored: penalty (the amount of points deducted from when a player gets a penalty ex: 0, -1000)
     teams = fields.ManyToManyField("models.Teams")
     entity_starts = fields.ManyToManyField("models.EntityStarts")
@@ -392,6 +430,18 @@ class Game(Model):
         """
         raise NotImplementedError("Subclasses must implement short_type property")
 
+    async def mark_edited(self, invalidate_cache: bool = True) -> None:
+        """
+        Records that something about this game changed after it was imported (ratings, logged in players,
+        ranked status...). ETags handed out for the game stop matching and its cached pages are dropped.
+
+        With invalidate_cache=False the cache is left alone, for changes that are rolled back afterwards.
+        """
+        await self.__class__.filter(id=self.id).update(edit_version=F("edit_version") + 1)
+        self.edit_version += 1
+        if invalidate_cache:
+            await invalidate_game(self)
+
     # win chance related functions
 
     @cache()
@@ -0,0 +1,13 @@
+from tortoise import BaseDBAsyncClient
+
+
+async def upgrade(db: BaseDBAsyncClient) -> str:
+    return """
+        ALTER TABLE `sm5game` ADD `edit_version` INT NOT NULL  DEFAULT 0;
+        ALTER TABLE `laserballgame` ADD `edit_version` INT NOT NULL  DEFAULT 0;"""
+
+
+async def downgrade(db: BaseDBAsyncClient) -> str:
+    return """
+        ALTER TABLE `sm5game` DROP COLUMN `edit_version`;
+        ALTER TABLE `laserballgame` DROP COLUMN `edit_version`;"""
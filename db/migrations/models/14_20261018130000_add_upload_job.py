@@ -0,0 +1,22 @@
+from tortoise import BaseDBAsyncClient
+
+
+async def upgrade(db: BaseDBAsyncClient) -> str:
+    return """
+        CREATE TABLE IF NOT EXISTS `uploadjob` (
+    `id` INT NOT NULL PRIMARY KEY AUTO_INCREMENT,
+    `type` VARCHAR(20) NOT NULL,
+    `file_name` VARCHAR(255) NOT NULL,
+    `spool_path` VARCHAR(255) NOT NULL,
+    `start_time` VARCHAR(14),
+    `status` VARCHAR(10) NOT NULL  COMMENT 'QUEUED: queued\nPROCESSING: processing\nDONE: done\nFAILED: failed' DEFAULT 'queued',
+    `error` LONGTEXT,
+    `game_id` INT,
+    `created_at` DATETIME(6) NOT NULL  DEFAULT CURRENT_TIMESTAMP(6),
+    `finished_at` DATETIME(6)
+) CHARACTER SET utf8mb4;"""
+
+
+async def downgrade(db: BaseDBAsyncClient) -> str:
+    return """
+        DROP TABLE IF EXISTS `uploadjob`;"""
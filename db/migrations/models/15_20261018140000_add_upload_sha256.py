@@ -0,0 +1,12 @@
+from tortoise import BaseDBAsyncClient
+
+
+async def upgrade(db: BaseDBAsyncClient) -> str:
+    return """
+        ALTER TABLE `uploadjob` ADD `sha256` VARCHAR(64) UNIQUE;"""
+
+
+async def downgrade(db: BaseDBAsyncClient) -> str:
+    return """
+        ALTER TABLE `uploadjob` DROP INDEX `sha256`;
+        ALTER TABLE `uploadjob` DROP COLUMN `sha256`;"""
@@ -0,0 +1,22 @@
+from tortoise import BaseDBAsyncClient
+
+
+async def upgrade(db: BaseDBAsyncClient) -> str:
+    return """
+        CREATE TABLE IF NOT EXISTS `gamesummary` (
+    `id` INT NOT NULL PRIMARY KEY AUTO_INCREMENT,
+    `game_type` VARCHAR(20) NOT NULL,
+    `game_id` INT NOT NULL,
+    `version` INT NOT NULL,
+    `duration` INT NOT NULL,
+    `team_scores` JSON NOT NULL,
+    `eliminated_teams` JSON NOT NULL,
+    `medic_death_times` JSON NOT NULL,
+    `players` JSON NOT NULL,
+    UNIQUE KEY `uid_gamesummary_game_ty_5a9a3e` (`game_type`, `game_id`)
+) CHARACTER SET utf8mb4;"""
+
+
+async def downgrade(db: BaseDBAsyncClient) -> str:
+    return """
+        DROP TABLE IF EXISTS `gamesummary`;"""
@@ -13,7 +13,7 @@ from typing import List, Optional
 from tortoise import Model, fields
 from helpers.cachehelper import cache
 from sanic.log import logger
-from db.game import Game
+from db.game import Game, GameSummary
 import math
 
 # The current version we expect in SM5Game.laserrank_version. If it doesn't match, that game should be migrated
@@ -58,15 +58,18 @@ class SM5Game(Game):
     def short_type(self) -> str:
         return "sm5"
     
-    async def get_team_doubles_percent(self, team: Team) -> float:
+    async def get_team_doubles_percent(self, team: Team, summary: Optional[GameSummary] = None) -> float:
+        """
+        summary: the summary of this game if it has one, the time the medic died is taken from there
+        """
         if team == Team.RED:
             if self._team1_double_percent is None:
-                self._team1_double_percent = await self._get_team_doubles_percent(team)
+                self._team1_double_percent = await self._get_team_doubles_percent(team, summary)
                 await self.save(update_fields=["_team1_double_percent"])
             return self._team1_double_percent
         else:
             if self._team2_double_percent is None:
-                self._team2_double_percent = await self._get_team_doubles_percent(team)
+                self._team2_double_percent = await self._get_team_doubles_percent(team, summary)
                 await self.save(update_fields=["_team2_double_percent"])
             return self._team2_double_percent
 
@@ -148,10 +151,10 @@ class SM5Game(Game):
             return medic_death_event.time
         return None
 
-    async def _get_team_doubles_percent(self, team: Team) -> float:
+    async def _get_team_doubles_percent(self, team: Team, summary: Optional[GameSummary] = None) -> float:
         # get what timestamp the medic died at
 
-        medic_death_time = await self.get_medic_death_time(team)
+        medic_death_time = summary.get_medic_death_time(team) if summary else await self.get_medic_death_time(team)
 
         # go through every resupply
         resupplies = await self.events \
@@ -275,10 +278,12 @@ class SM5Stats(Model):
         score: int = await (await self.entity).get_score()
         return int(str(score)[-1])
 
-    async def mvp_points(self) -> float:
+    async def mvp_points(self, summary: Optional[GameSummary] = None) -> float:
         """
         mvp points according to lfstats.com
 
+        summary: the summary of the game if it has one, whether the other team was eliminated is taken from there
+
         NOTE: this is a function, while LaserballStats.mvp_points is a property
         """
 
@@ -308,7 +313,9 @@ class SM5Stats(Model):
         if mission_end is not None:
             mission_length = mission_end.time
 
-            if await game.get_team_eliminated(SM5_ENEMY_TEAM[(await entity.team).enum]):
+            enemy_team = SM5_ENEMY_TEAM[(await entity.team).enum]
+
+            if summary.is_team_eliminated(enemy_team) if summary else await game.get_team_eliminated(enemy_team):
                 total_points += round(max(4, 4 + (game.mission_duration - mission_length - 180 * 1000) / 1000 / 60), 2)
 
         # cancel opponent nukes: 3 points for every opponent nuke canceled
@@ -0,0 +1,41 @@
+from tortoise import Model, fields
+from enum import Enum
+
+class UploadStatus(Enum):
+    QUEUED = "queued"  # waiting for the upload worker
+    PROCESSING = "processing"
+    DONE = "done"
+    FAILED = "failed"
+
+# a tdf file uploaded through /util/upload_tdf, imported by the upload worker (see helpers/uploadhelper.py)
+class UploadJob(Model):
+    id = fields.IntField(pk=True)
+    type = fields.CharField(20) # sm5, sm5_3team, laserball, dnd
+    file_name = fields.CharField(255) # name of the uploaded file
+    spool_path = fields.CharField(255) # where the file waits until it's processed
+    sha256 = fields.CharField(64, unique=True, null=True) # hash of the file, the same file is only queued once
+    start_time = fields.CharField(14, null=True) # start time from the tdf header ("%Y%m%d%H%M%S"), jobs are processed in this order
+    status = fields.CharEnumField(UploadStatus, default=UploadStatus.QUEUED)
+    error = fields.TextField(null=True)
+    game_id = fields.IntField(null=True) # the imported game, if there is one
+    created_at = fields.DatetimeField(auto_now_add=True)
+    finished_at = fields.DatetimeField(null=True)
+
+    async def to_dict(self) -> dict:
+        return {
+            "job": self.id,
+            "type": self.type,
+            "file": self.file_name,
+            "status": self.status.value,
+            "error": self.error,
+            "game_id": self.game_id,
+            "created_at": self.created_at.isoformat() if self.created_at else None,
+            "finished_at": self.finished_at.isoformat() if self.finished_at else None,
+        }
+
+    def __str__(self):
+        return f"UploadJob(id={self.id}, type={self.type}, file={self.file_name}, status={self.status})"
+
+    class Meta:
+        table = "uploadjob"
+        ordering = ["id"]
@@ -97,11 +97,11 @@ async def admin_audit_ranked_status(request: Request, type: str) -> str:
                     logger.info(f"SM5 Game ID {game.id} ranked status changed from {game.ranked} to {ranked}")
                     game.ranked = ranked
                     await game.save()
+                    await game.mark_edited()
 
-                    # unranked -> ranked
+                    # the games after it were rated with the old status
 
-                    if ranked:
-                        await ratinghelper.update_sm5_ratings(game)
+                    await ratinghelper.correct_ratings(game)
 
         if type in ["laserball", "all"]:
             laserball_games = await LaserballGame.all().order_by("start_time")
@@ -148,11 +148,11 @@ async def admin_audit_ranked_status(request: Request, type: str) -> str:
                     logger.info(f"Laserball Game ID {game.id} ranked status changed from {game.ranked} to {ranked}")
                     game.ranked = ranked
                     await game.save()
+                    await game.mark_edited()
 
-                    # unranked -> ranked
+                    # the games after it were rated with the old status
 
-                    if ranked:
-                        await ratinghelper.update_laserball_ratings(game)
+                    await ratinghelper.correct_ratings(game)
 
     request.app.add_task(task(), name="Audit Ranked Status")
 
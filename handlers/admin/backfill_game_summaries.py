@@ -0,0 +1,37 @@
+from sanic import Request
+from sanic.log import logger
+
+from db.game import GameSummary
+from db.laserball import LaserballGame
+from db.sm5 import SM5Game
+from helpers.statshelper import build_game_summary, GAME_SUMMARY_VERSION
+from shared import app
+from utils import admin_only, reset_banner
+
+_BATCH_SIZE = 20
+
+
+@app.post("/admin/backfill_game_summaries")
+@admin_only
+async def admin_backfill_game_summaries(request: Request) -> str:
+    response = await request.respond(content_type="text/html")
+
+    async def task():
+        for short_type, model in [("sm5", SM5Game), ("laserball", LaserballGame)]:
+            # Only the games that don't have a summary of the current version yet.
+            up_to_date_ids = set(await GameSummary.filter(game_type=short_type, version=GAME_SUMMARY_VERSION)
+                                 .values_list("game_id", flat=True))
+            ids = [id for id in await model.all().order_by("id").values_list("id", flat=True)
+                   if id not in up_to_date_ids]
+
+            for i in range(0, len(ids), _BATCH_SIZE):
+                for game in await model.filter(id__in=ids[i:i + _BATCH_SIZE]):
+                    await build_game_summary(game)
+
+                logger.info(f"Built {short_type} game summaries for {min(i + _BATCH_SIZE, len(ids))}/{len(ids)} games")
+
+    request.app.ctx.banner["text"] = "Game summaries are being computed, the site may be slow until it's done"
+    request.app.ctx.banner["type"] = "warning"
+    request.app.add_task(task(), name="Backfill Game Summaries").add_done_callback(lambda _: reset_banner())
+
+    return response.json({"status": "ok"})
@@ -0,0 +1,44 @@
+from sanic import Request, response
+
+from helpers.cachehelper import get_cache_stats, get_cache_entries, evict
+from shared import app
+from utils import render_template, admin_only
+
+_ENTRIES_PER_PAGE = 100
+
+
+@app.get("/admin/cache")
+@admin_only
+async def admin_cache(request: Request) -> str:
+    try:
+        page = int(request.args.get("page", 0))
+    except ValueError:
+        page = 0
+
+    entries = get_cache_entries()
+
+    return await render_template(
+        request,
+        "admin/cache.html",
+        stats=get_cache_stats(),
+        entries=entries[page * _ENTRIES_PER_PAGE:(page + 1) * _ENTRIES_PER_PAGE],
+        entry_count=len(entries),
+        page=page,
+        has_next_page=len(entries) > (page + 1) * _ENTRIES_PER_PAGE,
+    )
+
+
+@app.get("/admin/cache/json")
+@admin_only
+async def admin_cache_json(request: Request) -> str:
+    return response.json({"status": "ok", "stats": get_cache_stats(), "entries": get_cache_entries()})
+
+
+@app.post("/admin/cache/evict")
+@admin_only
+async def admin_cache_evict(request: Request) -> str:
+    key = request.json.get("key")
+    if not key:
+        return response.json({"status": "error", "message": "No key given"}, status=400)
+
+    return response.json({"status": "ok", "evicted": await evict(key)})
@@ -5,11 +5,12 @@ from sanic import Request
 from sanic import exceptions, response
 from sanic.log import logger
 
-from db.game import EntityEnds
+from db.game import EntityEnds, GameSummary
 from db.laserball import LaserballGame, LaserballStats
 from db.sm5 import SM5Game, SM5Stats
-from db.types import Team
-from helpers import ratinghelper, adminhelper
+from db.types import Team, GameType
+from helpers import ratinghelper, adminhelper, cachehelper
+from helpers.tdfhelper import get_tdf_path
 from shared import app
 from utils import render_template, admin_only
 
@@ -77,10 +78,8 @@ async def admin_game_rank(request: Request, mode: str, id: Union[int, str]) -> s
     game.ranked = True
     await game.save()
 
-    if mode == "sm5":
-        await ratinghelper.update_sm5_ratings(game)
-    elif mode == "laserball":
-        await ratinghelper.update_laserball_ratings(game)
+    # the games after it were rated without this one
+    await ratinghelper.correct_ratings(game)
 
     return response.json({"status": "ok"})
 
@@ -98,6 +97,9 @@ async def admin_game_unrank(request: Request, mode: str, id: Union[int, str]) ->
     game.ranked = False
     await game.save()
 
+    # takes the game back out of the ratings of its players and everyone they played afterwards
+    await ratinghelper.correct_ratings(game)
+
     return response.json({"status": "ok"})
 
 
@@ -126,15 +128,21 @@ async def admin_game_log_in_player(request: Request, mode: str, id: Union[int, s
 async def admin_game_delete(request: Request, mode: str, id: Union[int, str]) -> str:
     if mode == "sm5":
         game = await SM5Game.filter(id=id).first()
-        await game.delete()
-        os.remove("sm5_tdf/" + game.tdf_name)
     elif mode == "laserball":
         game = await LaserballGame.filter(id=id).first()
-        await game.delete()
-        os.remove("laserball_tdf/" + game.tdf_name)
     else:
         raise exceptions.NotFound("Not found: Invalid game type")
 
+    entity_ids = await game.entity_starts.filter(type="player").values_list("entity_id", flat=True)
+
+    await cachehelper.invalidate_game(game)
+    await GameSummary.filter(game_type=game.short_type, game_id=game.id).delete()
+    await game.delete()
+    os.remove(get_tdf_path(f"{mode}_tdf", game.tdf_name))
+
+    if game.ranked:
+        await ratinghelper.correct_ratings_from(GameType(mode), game.start_time, game.id, entity_ids)
+
     return response.json({"status": "ok"})
 
 
@@ -3,7 +3,7 @@ import asyncio
 from sanic import Request, response
 from sanic.log import logger
 
-from helpers.cachehelper import flush_cache
+from helpers.cachehelper import flush_cache, get_precache_progress
 from helpers.ratinghelper import recalculate_ratings, recalculate_laserball_ratings, recalculate_sm5_ratings
 from shared import app
 from utils import render_template, admin_only
@@ -62,6 +62,11 @@ async def admin_flush_cache(request: Request) -> str:
 
     return response.json({"status": "ok"})
 
+@app.get("/admin/precache")
+@admin_only
+async def admin_precache_progress(request: Request) -> str:
+    return response.json({"status": "ok", "progress": get_precache_progress()})
+
 @app.post("/admin/set_banner")
 @admin_only
 async def admin_set_banner(request: Request) -> str:
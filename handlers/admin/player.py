@@ -4,6 +4,7 @@ from sanic import Request, response, exceptions
 
 from db.player import Player
 from db.tag import Tag, TagType
+from helpers import cachehelper
 from shared import app
 from utils import render_template, admin_only
 from sanic.log import logger
@@ -57,6 +58,8 @@ async def admin_player_add_tag(request: Request, id: Union[int, str]) -> str:
         new_tag = Tag(id=tag, type=tag_type, player=player)
         await new_tag.save()
 
+        await cachehelper.invalidate(cachehelper.player_tag(player.player_id), cachehelper.entity_tag(player.entity_id))
+
         return response.json({"status": "ok"})
     
     return response.json({"status": "error"}, status=400)
\ No newline at end of file
@@ -1,14 +1,24 @@
+import asyncio
+import gzip
+import os
+
 from sanic import Request
 from sanic import exceptions, response
 from sanic.log import logger
 
 from db.laserball import LaserballGame
 from db.sm5 import SM5Game
-from helpers.cachehelper import cache
+from helpers.cachehelper import cache, game_tag
+from helpers.gamehelper import get_game_etag
 from helpers.statshelper import sentry_trace
+from helpers.tdfhelper import get_tdf_path, COMPRESSED_SUFFIX
 from handlers.api import api_bp
 from sanic_ext import openapi
 from sanic_ext.extensions.openapi.definitions import RequestBody, Response
+from utils import conditional_get, accepts_encoding, CACHE_CONTROL_DATA
+
+# bytes of a decompressed tdf file sent at a time
+_TDF_CHUNK_SIZE = 64 * 1024
 
 
 @api_bp.get("/game/<type:str>/<id:int>/tdf")
@@ -40,20 +50,38 @@ async def api_game_tdf(request: Request, type: str, id: int) -> str:
         raise exceptions.NotFound("Game not found!")
 
     full_type_name = "sm5" if type == "sm5" else "laserball"
+    path = get_tdf_path(f"{full_type_name}_tdf", game.tdf_name)
 
-    # return the tdf file
-    try:
-        return await response.file(f"{full_type_name}_tdf/{game.tdf_name}", filename=game.tdf_name)
-    except FileNotFoundError:
+    if not os.path.exists(path):
         raise exceptions.NotFound("TDF file not found on server!")
 
+    if not path.endswith(COMPRESSED_SUFFIX):
+        return await response.file(path, filename=game.tdf_name)
+
+    # the file is stored compressed, send it as it is if the client can decompress it
+    if accepts_encoding(request, "gzip"):
+        return await response.file_stream(path, filename=game.tdf_name, mime_type="text/plain",
+                                          headers={"Content-Encoding": "gzip", "Vary": "Accept-Encoding"})
+
+    # otherwise decompress it while it's sent, a chunk at a time and off the event loop
+    stream = await request.respond(content_type="text/plain", headers={
+        "Content-Disposition": f'attachment; filename="{game.tdf_name}"',
+        "Vary": "Accept-Encoding",
+    })
+    loop = asyncio.get_running_loop()
+    with gzip.open(path, "rb") as file:
+        while chunk := await loop.run_in_executor(None, file.read, _TDF_CHUNK_SIZE):
+            await stream.send(chunk)
+    await stream.eof()
+
 
 @api_bp.get("/game/<type:str>/<id:int>/json")
 # exclude from openapi docs because it's too complex to document properly
 # and not meant for public use. TODO: add an updated version that is documented well
 @openapi.exclude()
 @sentry_trace
-@cache()
+@conditional_get(get_game_etag, CACHE_CONTROL_DATA)
+@cache(tags=lambda request, type, id: [game_tag(type, id)], query_args=())
 async def api_game_json(request: Request, type: str, id: int) -> str:
     """
     This is meant for the web frontend only to request a game from the api
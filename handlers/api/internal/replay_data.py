@@ -4,13 +4,16 @@ from db.laserball import LaserballGame
 from db.sm5 import SM5Game
 from helpers.replay_laserball import create_laserball_replay
 from helpers.replay_sm5 import create_sm5_replay
+from helpers.gamehelper import get_game_etag
 from helpers.statshelper import sentry_trace
 from handlers.api import api_bp
 from sanic_ext import openapi
+from utils import conditional_get, CACHE_CONTROL_DATA
 
 @api_bp.get("/internal/game/<type:str>/<id:int>/replay_data")
 @openapi.exclude()
 @sentry_trace
+@conditional_get(get_game_etag, CACHE_CONTROL_DATA)
 async def api_game_replay_data(request: Request, type: str, id: int) -> HTTPResponse:
     if type.lower() == "sm5":
         game = await SM5Game.filter(id=id).first()
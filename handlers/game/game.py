@@ -8,14 +8,14 @@ from sanic.log import logger
 from db.game import EntityEnds
 from db.laserball import LaserballGame, LaserballStats, Team as LaserballTeam
 from db.sm5 import SM5Game, Team as SM5Team
-from helpers.cachehelper import cache_template, precache_template
-from helpers.gamehelper import get_matchmaking_teams
+from helpers.cachehelper import cache_template, precache_template, game_tag
+from helpers.gamehelper import get_matchmaking_teams, get_game_etag
 from helpers.laserballhelper import get_laserball_player_stats
 from helpers.sm5helper import get_sm5_player_stats, get_sm5_notable_events
 from helpers.statshelper import sentry_trace, get_sm5_team_score_graph_data, \
     millis_to_time
 from shared import app
-from utils import render_cached_template
+from utils import render_cached_template, conditional_get, CACHE_CONTROL_PAGE
 
 
 async def precache_rule() -> Tuple[List, List]:
@@ -43,7 +43,8 @@ async def precache_rule() -> Tuple[List, List]:
 
 @app.get("/game/<type:str>/<id:int>/")
 @sentry_trace
-@cache_template()
+@conditional_get(get_game_etag, CACHE_CONTROL_PAGE, per_user=True)
+@cache_template(tags=lambda request, type, id: [game_tag(type, id)], query_args=(), output=True)
 @precache_template(rule=precache_rule)
 async def game_index(request: Request, type: str, id: int) -> str:
     if type == "sm5":
@@ -2,7 +2,7 @@ from sanic import Request
 
 from db.laserball import LaserballGame
 from db.sm5 import SM5Game
-from helpers.cachehelper import cache_template, precache_template
+from helpers.cachehelper import cache_template, precache_template, TAG_GAMES
 from helpers.statshelper import sentry_trace
 from shared import app
 from utils import render_cached_template
@@ -12,7 +12,7 @@ GAMES_PER_PAGE = 15
 
 @app.get("/games")
 @sentry_trace
-@cache_template()
+@cache_template(tags=[TAG_GAMES], query_args=("page", "mode", "sort", "sort_dir"), output=True)
 @precache_template()
 async def games(request: Request) -> str:
     page = int(request.args.get("page", 0))
@@ -6,13 +6,13 @@ from db.game import EntityEnds
 from db.laserball import LaserballGame
 from db.sm5 import SM5Game
 from db.types import IntRole, Team, LineChartData, RgbColor
-from helpers.cachehelper import cache_template
-from helpers.gamehelper import SM5_STATE_COLORS
+from helpers.cachehelper import cache_template, game_tag
+from helpers.gamehelper import SM5_STATE_COLORS, get_game_etag
 from helpers.laserballhelper import get_laserball_player_stats
 from helpers.sm5helper import get_sm5_player_stats
 from helpers.statshelper import sentry_trace, millis_to_time, get_sm5_single_player_score_graph_data
 from shared import app
-from utils import render_cached_template
+from utils import render_cached_template, conditional_get, CACHE_CONTROL_PAGE
 
 # Modifiers for the score card colors of other players. One of these will be applied
 # to the color so it's ever so slightly different.
@@ -44,7 +44,9 @@ def _chart_strings(values: list[str]) -> str:
 
 @app.get("/game/<type:str>/<id:int>/scorecard/<entity_end_id:int>")
 @sentry_trace
-@cache_template()
+@conditional_get(lambda type, id, entity_end_id: get_game_etag(type, id), CACHE_CONTROL_PAGE, per_user=True)
+@cache_template(tags=lambda request, type, id, entity_end_id: [game_tag(type, id)], query_args=(),
+                output=True)
 async def scorecard(request: Request, type: str, id: int, entity_end_id: int) -> str:
     if type == "sm5":
         game = await SM5Game.filter(id=id).prefetch_related("entity_starts", "entity_ends").first()
@@ -2,7 +2,7 @@ from sanic import Request
 from sanic.log import logger
 
 from helpers import userhelper
-from helpers.cachehelper import cache_template, precache_template
+from helpers.cachehelper import cache_template, precache_template, TAG_LEADERBOARD, TAG_GAMES, PRECACHE_PRIORITY_HIGH
 from helpers.statshelper import sentry_trace
 from shared import app
 from utils import render_cached_template
@@ -10,8 +10,8 @@ from utils import render_cached_template
 
 @app.get("/")
 @sentry_trace
-@cache_template()
-@precache_template()
+@cache_template(tags=[TAG_LEADERBOARD, TAG_GAMES], query_args=(), output=True)
+@precache_template(priority=PRECACHE_PRIORITY_HIGH)
 async def index(request: Request) -> str:
     logger.info("Loading index page")
 
@@ -6,7 +6,7 @@ from db.player import Player
 from helpers import ratinghelper
 from shared import app
 from utils import render_cached_template, render_template
-from helpers.cachehelper import cache_template, precache_template
+from helpers.cachehelper import cache_template, precache_template, TAG_LEADERBOARD
 
 
 class FakePlayer:
@@ -42,7 +42,7 @@ class FakePlayer:
 
 
 @app.get("/matchmaking")
-@cache_template()
+@cache_template(tags=[TAG_LEADERBOARD], query_args=(), output=True)
 @precache_template()
 async def matchmaking(request: Request) -> str:
     players = await Player.all()
@@ -10,13 +10,14 @@ from db.laserball import LaserballGame, LaserballStats
 from db.player import Player
 from db.sm5 import SM5Game, SM5Stats
 from db.types import GameType, Team, Role, ROLES, ROLE_MAP
-from helpers.cachehelper import cache_template, precache_template
+from helpers.cachehelper import cache_template, precache_template, add_cache_tags, player_tag, entity_tag, \
+    TAG_LEADERBOARD, PRECACHE_PRIORITY_LOW
 from helpers.laserballhelper import get_laserball_rating_over_time
 from helpers.sm5helper import get_sm5_rating_over_time
 from helpers.statshelper import sentry_trace, create_time_series_ordered_graph
-from helpers.userhelper import get_median_role_score, get_per_role_game_count
+from helpers.userhelper import get_median_role_score, get_per_role_game_count, get_player_etag
 from shared import app
-from utils import render_cached_template
+from utils import render_cached_template, conditional_get, CACHE_CONTROL_PAGE
 
 _GAMES_PER_PAGE = 5
 
@@ -83,8 +84,9 @@ async def precache_rule() -> Tuple[List, List]:
 
 @app.get("/player/<id>")
 @sentry_trace
-@cache_template()
-@precache_template(rule=precache_rule)
+@conditional_get(lambda id: get_player_etag(unquote(id)), CACHE_CONTROL_PAGE, per_user=True)
+@cache_template(tags=[TAG_LEADERBOARD], query_args=("sm5page", "lbpage", "role"), output=True)
+@precache_template(rule=precache_rule, priority=PRECACHE_PRIORITY_LOW)
 async def player_get(request: Request, id: Union[int, str]) -> str:
     sm5page = request.args.get("sm5page", 0)
     lbpage = request.args.get("lbpage", 0)
@@ -113,6 +115,8 @@ async def player_get(request: Request, id: Union[int, str]) -> str:
     if not player:
         raise exceptions.NotFound("Not found: Invalid ID or codename")
 
+    add_cache_tags(player_tag(player.player_id), entity_tag(player.entity_id))
+
     logger.info(f"Loading player page for {player}")
 
     logger.debug("Loading recent games")
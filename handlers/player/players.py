@@ -2,7 +2,7 @@ from sanic import Request
 from tortoise.expressions import F
 
 from db.player import Player
-from helpers.cachehelper import cache_template, precache_template
+from helpers.cachehelper import cache_template, precache_template, TAG_LEADERBOARD
 from helpers.statshelper import sentry_trace
 from shared import app
 from utils import render_cached_template
@@ -10,7 +10,7 @@ from utils import render_cached_template
 
 @app.get("/players")
 @sentry_trace
-@cache_template()
+@cache_template(tags=[TAG_LEADERBOARD], query_args=("page", "sort", "sort_dir"), output=True)
 @precache_template()
 async def players(request: Request) -> str:
     page = request.args.get("page", 0)
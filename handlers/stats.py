@@ -7,7 +7,7 @@ from db.player import Player
 from db.sm5 import SM5Game
 from db.types import Team, IntRole
 from helpers import statshelper
-from helpers.cachehelper import cache_template, precache_template
+from helpers.cachehelper import cache_template, precache_template, TAG_STATS, PRECACHE_PRIORITY_HIGH
 from helpers.statshelper import sentry_trace
 from shared import app
 from utils import render_cached_template
@@ -15,8 +15,8 @@ from utils import render_cached_template
 
 @app.get("/stats")
 @sentry_trace
-@cache_template(ttl=60*60*24)  # Cache for 24 hours
-@precache_template()
+@cache_template(ttl=60*60*24, tags=[TAG_STATS], query_args=(), output=True)  # Cache for 24 hours
+@precache_template(priority=PRECACHE_PRIORITY_HIGH)
 async def stats(request: Request) -> str:
     logger.info("Loading stats page")
 
@@ -1,10 +1,9 @@
-from pathlib import Path
-
 from sanic import Request, exceptions, response
 from sanic.log import logger
 
 from helpers.statshelper import sentry_trace
-from helpers.tdfhelper import parse_sm5_game, parse_laserball_game
+from db.upload import UploadJob, UploadStatus
+from helpers.uploadhelper import UPLOAD_TYPES, enqueue_upload, get_queue_position
 from shared import app
 import sentry_sdk
 
@@ -33,45 +32,31 @@ async def auto_upload(request: Request) -> str:
         logger.error("No file provided in the request.")
         raise exceptions.BadRequest("No file provided in the request.")
 
-    if type == "sm5":
-        target_path = "./sm5_tdf/" + file.name
-        _create_file_from_request(file, target_path)
-        await parse_sm5_game(target_path)
-    elif type == "sm5_3team":
-        target_path = "./sm5_3team_tdf/" + file.name
-        _create_file_from_request(file, target_path)
-        # don't parse 3 team games, since they are not supported yet
-    elif type == "laserball":
-        target_path = "./laserball_tdf/" + file.name
-        _create_file_from_request(file, target_path)
-        await parse_laserball_game(target_path)
-    elif type == "dnd":
-        target_path = "./dnd_tdf/" + file.name
-        _create_file_from_request(file, target_path)
-        # don't parse DnD games, since they are not supported yet
-    else:
+    if type not in UPLOAD_TYPES:
         logger.error(f"Unsupported type: {type}")
         raise exceptions.BadRequest(f"Unsupported type: {type}")
 
-    logger.info("Uploaded TDF successfully!")
+    # the game is imported by the upload worker, see helpers/uploadhelper.py
+    job, created = await enqueue_upload(type, file.name, file.body)
 
-    return response.text("Uploaded!")
+    if created:
+        logger.info(f"Queued TDF as upload job {job.id}")
+    else:
+        logger.info(f"TDF was uploaded already as upload job {job.id}")
 
+    # 202 while the job waits for the worker, 200 for files that were imported already
+    return response.json({"job": job.id, "status_url": f"/util/upload_tdf/{job.id}", "duplicate": not created},
+                         status=202 if job.status == UploadStatus.QUEUED else 200)
 
-def _create_file_from_request(request_file, target_path: str):
-    """Reads the data from a request's file and stores it a local file.
 
-    Creates the path structure leading up to the target path if it doesn't
-    exist already.
+@app.get("/util/upload_tdf/<job:int>")
+async def upload_tdf_status(request: Request, job: int) -> str:
+    upload_job = await UploadJob.get_or_none(id=job)
 
-    Args:
-        request_file: The file from the HTTP request.
-        target_path: The path to store this file in. Can be relative.
-    """
-    filepath = Path(target_path)
+    if upload_job is None:
+        raise exceptions.NotFound("Upload job not found")
 
-    # Create the directory if it doesn't exist already.
-    filepath.parent.mkdir(parents=True, exist_ok=True)
+    status = await upload_job.to_dict()
+    status["position"] = await get_queue_position(upload_job)
 
-    # Copy the entire contents of the request file into the target file.
-    open(target_path, "wb").write(request_file.body)
+    return response.json(status)
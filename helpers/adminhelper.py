@@ -8,7 +8,7 @@ from db.laserball import LaserballGame
 from db.player import Player
 from db.sm5 import SM5Stats, SM5Game
 from db.types import Permission
-from helpers import tdfhelper, userhelper, ratinghelper
+from helpers import tdfhelper, userhelper, ratinghelper, cachehelper, statshelper
 from shared import app
 
 
@@ -58,28 +58,29 @@ async def manually_login_player_sm5(game: Union[SM5Game, LaserballGame], battles
 
     # update the tdf file
 
-    tdf = game.tdf_name
-
     if mode == "sm5":
-        tdf = "sm5_tdf/" + tdf
+        tdf = tdfhelper.get_tdf_path("sm5_tdf", game.tdf_name)
     elif mode == "laserball":
-        tdf = "laserball_tdf/" + tdf
+        tdf = tdfhelper.get_tdf_path("laserball_tdf", game.tdf_name)
     else:
         raise ValueError("Invalid mode")
 
     # simple find and replace
 
-    with open(tdf, "r", encoding="utf-16") as f:
+    with tdfhelper.open_tdf(tdf) as f:
         contents = f.read()
 
         contents = contents.replace(old_entity_id, player.entity_id)
         contents = contents.replace(battlesuit, codename)
 
-    with open(tdf, "w", encoding="utf-16") as f:
+    with tdfhelper.open_tdf(tdf, "w") as f:
         f.write(contents)
 
     logger.debug("Wrote to file successfully")
 
+    await cachehelper.invalidate(cachehelper.entity_tag(old_entity_id))
+    await game.mark_edited()
+
 
 async def delete_player_from_game(game: Union[SM5Game, LaserballGame], codename: str, id: int, mode: str) -> None:
     """
@@ -152,24 +153,28 @@ async def delete_player_from_game(game: Union[SM5Game, LaserballGame], codename:
 
     # update the tdf file
 
-    tdf = game.tdf_name
-
     if mode == "sm5":
-        tdf = "sm5_tdf/" + tdf
+        tdf = tdfhelper.get_tdf_path("sm5_tdf", game.tdf_name)
     elif mode == "laserball":
-        tdf = "laserball_tdf/" + tdf
+        tdf = tdfhelper.get_tdf_path("laserball_tdf", game.tdf_name)
     else:
         raise ValueError("Invalid mode")
 
     # simple find and replace
 
-    with open(tdf, "r", encoding="utf-16") as f:
+    with tdfhelper.open_tdf(tdf) as f:
         contents = f.read()
 
         contents = contents.replace(entity_start.entity_id, "")
         contents = contents.replace(codename, "")
 
-    with open(tdf, "w", encoding="utf-16") as f:
+    with tdfhelper.open_tdf(tdf, "w") as f:
         f.write(contents)
 
     logger.debug("Wrote to file successfully")
+
+    # the team scores and everything else in the summary changed without this player
+    await statshelper.build_game_summary(game)
+
+    await cachehelper.invalidate(cachehelper.entity_tag(entity_start.entity_id))
+    await game.mark_edited()
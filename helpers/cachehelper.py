@@ -1,23 +1,597 @@
 import asyncio
+import contextvars
+import hashlib
+import heapq
+import io
+import json
+import pickle
+import sys
 import time
-from typing import Dict, Any, Tuple, Union, Callable, List, Optional, Awaitable
+import zlib
+from collections import OrderedDict
+from datetime import datetime
+from enum import Enum
+from functools import partial
+from typing import Dict, Any, Tuple, Union, Callable, List, Optional, Awaitable, Hashable, Iterator, AsyncIterator, \
+    Iterable, Set, FrozenSet
 import urllib.parse
 from sanic import Sanic
 
 from sanic.log import logger
 from sanic.request import Request
-from tortoise.queryset import QuerySet
-from db.types import Permission
+from tortoise.models import Model
+from tortoise.queryset import AwaitableQuery
+from db.types import Permission, Team, Role, GameType, EventType, IntRole, PlayerStateType, PlayerStateDetailType
 import urllib
 import re
 
 refresh_time_queryset = 60 * 30  # 30 minutes
 refresh_time_function = 0  # 0 seconds
 
-queryset_cache: Dict[str, Tuple[Any, QuerySet]] = {}
-function_cache: Dict[str, Any] = {}
+# limits for the in-process caches, once either one is exceeded the least valuable entries get evicted
+function_cache_max_entries = 2048
+function_cache_max_bytes = 256 * 1024 * 1024  # 256 MiB
+queryset_cache_max_entries = 4096
+queryset_cache_max_bytes = 128 * 1024 * 1024  # 128 MiB
+
+# how deep estimate_size() walks into nested containers and objects
+_SIZE_ESTIMATE_MAX_DEPTH = 6
+
+EVICTION_LRU = "lru"  # evict the least recently used entry
+EVICTION_LFU = "lfu"  # evict the least frequently used entry (ties broken by recency)
+
+
+def estimate_size(value: Any, _depth: int = 0, _seen: Optional[set] = None) -> int:
+    """
+    Returns an approximation of how many bytes a cached value keeps alive.
+
+    Walks containers and object attributes up to a fixed depth, objects shared between entries
+    are counted for every entry that holds them, so this errs on the high side.
+    """
+    if _seen is None:
+        _seen = set()
+
+    if id(value) in _seen:
+        return 0
+    _seen.add(id(value))
+
+    size = sys.getsizeof(value, 0)
+
+    if _depth >= _SIZE_ESTIMATE_MAX_DEPTH or isinstance(value, (str, bytes, bytearray, int, float, bool)):
+        return size
+
+    if isinstance(value, dict):
+        for k, v in value.items():
+            size += estimate_size(k, _depth + 1, _seen) + estimate_size(v, _depth + 1, _seen)
+    elif isinstance(value, (list, tuple, set, frozenset)):
+        for item in value:
+            size += estimate_size(item, _depth + 1, _seen)
+    elif hasattr(value, "__dict__") and not isinstance(value, type):
+        size += estimate_size(vars(value), _depth + 1, _seen)
+
+    return size
+
+
+class CacheBackend:
+    """
+    Interface for the storage behind function_cache and queryset_cache.
+
+    Backends behave like a dict, plus get() which counts hits and misses. Backends that evict entries on their own
+    call on_evict with the key of each one.
+    """
+
+    def __init__(self) -> None:
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.on_evict: Optional[Callable[[Hashable], None]] = None
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        raise NotImplementedError
+
+    def __getitem__(self, key: Hashable) -> Any:
+        raise NotImplementedError
+
+    def __setitem__(self, key: Hashable, value: Any) -> None:
+        raise NotImplementedError
+
+    def __delitem__(self, key: Hashable) -> None:
+        raise NotImplementedError
+
+    def __contains__(self, key: Hashable) -> bool:
+        raise NotImplementedError
+
+    def __len__(self) -> int:
+        raise NotImplementedError
+
+    def peek(self, key: Hashable, default: Any = None) -> Any:
+        """Like get(), but doesn't count as a hit or miss or as a use of the entry."""
+        raise NotImplementedError
+
+    def replace(self, key: Hashable, value: Any) -> None:
+        """
+        Stores a new value of the same size for an existing key, without it counting as a use of the entry.
+        """
+        raise NotImplementedError
+
+    def __iter__(self) -> Iterator[Hashable]:
+        return iter(self.keys())
+
+    def keys(self) -> List[Hashable]:
+        raise NotImplementedError
+
+    def pop(self, key: Hashable, default: Any = None) -> Any:
+        if key not in self:
+            return default
+        value = self[key]
+        del self[key]
+        return value
+
+    def clear(self) -> None:
+        raise NotImplementedError
+
+    @property
+    def hit_ratio(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total > 0 else 0.0
+
+    def get_stats(self) -> Dict[str, Any]:
+        return {
+            "entries": len(self),
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_ratio": self.hit_ratio,
+        }
+
+    def reset_stats(self) -> None:
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+
+class BoundedCache(CacheBackend):
+    """
+    In-process cache with a maximum entry count and an (approximate) maximum byte budget.
+
+    policy is either EVICTION_LRU or EVICTION_LFU. Sizes are measured with estimate_size()
+    once, when an entry is stored.
+    """
+
+    def __init__(self, max_entries: Optional[int] = None, max_bytes: Optional[int] = None,
+                 policy: str = EVICTION_LRU, sizeof: Callable[[Any], int] = estimate_size) -> None:
+        super().__init__()
+
+        if policy not in (EVICTION_LRU, EVICTION_LFU):
+            raise ValueError(f"Invalid eviction policy: {policy}")
+
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.policy = policy
+        self.sizeof = sizeof
+        self.total_bytes = 0
+
+        # key -> value, ordered from least to most recently used
+        self._data: "OrderedDict[Hashable, Any]" = OrderedDict()
+        self._sizes: Dict[Hashable, int] = {}
+        self._frequencies: Dict[Hashable, int] = {}
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        if key not in self._data:
+            self.misses += 1
+            return default
+
+        self.hits += 1
+        self._touch(key)
+        return self._data[key]
+
+    def __getitem__(self, key: Hashable) -> Any:
+        value = self._data[key]
+        self._touch(key)
+        return value
+
+    def peek(self, key: Hashable, default: Any = None) -> Any:
+        return self._data.get(key, default)
+
+    def replace(self, key: Hashable, value: Any) -> None:
+        if key not in self._data:
+            raise KeyError(key)
+        # assigning an existing key keeps its place in the order
+        self._data[key] = value
+
+    def __setitem__(self, key: Hashable, value: Any) -> None:
+        size = self.sizeof(value)
+
+        if key in self._data:
+            self.total_bytes -= self._sizes[key]
+        else:
+            self._frequencies[key] = 0
+
+        self._data[key] = value
+        self._sizes[key] = size
+        self.total_bytes += size
+        self._touch(key)
+
+        self._evict(protect=key)
+
+    def __delitem__(self, key: Hashable) -> None:
+        del self._data[key]
+        self.total_bytes -= self._sizes.pop(key)
+        self._frequencies.pop(key, None)
+
+    def __contains__(self, key: Hashable) -> bool:
+        return key in self._data
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def keys(self) -> List[Hashable]:
+        return list(self._data.keys())
+
+    def clear(self) -> None:
+        self._data.clear()
+        self._sizes.clear()
+        self._frequencies.clear()
+        self.total_bytes = 0
+
+    def size_of(self, key: Hashable) -> int:
+        return self._sizes.get(key, 0)
+
+    def get_stats(self) -> Dict[str, Any]:
+        stats = super().get_stats()
+        stats.update({
+            "bytes": self.total_bytes,
+            "max_entries": self.max_entries,
+            "max_bytes": self.max_bytes,
+            "policy": self.policy,
+        })
+        return stats
+
+    def _touch(self, key: Hashable) -> None:
+        self._data.move_to_end(key)
+        self._frequencies[key] = self._frequencies.get(key, 0) + 1
+
+    def _over_budget(self) -> bool:
+        if self.max_entries is not None and len(self._data) > self.max_entries:
+            return True
+        if self.max_bytes is not None and self.total_bytes > self.max_bytes:
+            return True
+        return False
+
+    def _pick_victim(self, protect: Hashable) -> Optional[Hashable]:
+        if self.policy == EVICTION_LRU:
+            for key in self._data:
+                if key != protect:
+                    return key
+            return None
+
+        # LFU: iterate in recency order so the first minimum found is also the least recently used one
+        victim = None
+        victim_frequency = None
+        for key in self._data:
+            if key == protect:
+                continue
+            frequency = self._frequencies.get(key, 0)
+            if victim_frequency is None or frequency < victim_frequency:
+                victim = key
+                victim_frequency = frequency
+        return victim
+
+    def _evict(self, protect: Hashable) -> None:
+        while self._over_budget():
+            victim = self._pick_victim(protect)
+            if victim is None:
+                # the new entry alone is over budget, don't keep it around
+                if protect in self._data and self.max_bytes is not None and self.total_bytes > self.max_bytes:
+                    self._evict_key(protect)
+                return
+            self._evict_key(victim)
+
+    def _evict_key(self, key: Hashable) -> None:
+        del self[key]
+        self.evictions += 1
+        if self.on_evict is not None:
+            self.on_evict(key)
+
+
+# second cache level shared between all Sanic workers (and restarts), backed by redis
+# entries are kept at least this long in redis even when their ttl is shorter, so a stale
+# value can still be served by a freshly started worker while it refreshes in the background
+shared_cache_min_expiry = 60 * 60 * 24  # 1 day
+shared_cache_prefix = "laserforce_ranking:cache:"
+
+
+def _restore_model(cls: type, fields: Dict[str, Any], relations: Dict[str, Any]) -> Model:
+    obj = cls.__new__(cls)
+    obj._partial = False
+    obj._saved_in_db = True
+    obj._custom_generated_pk = False
+
+    for name, value in fields.items():
+        setattr(obj, name, value)
+
+    for name, value in relations.items():
+        if name in cls._meta.fk_fields or name in cls._meta.o2o_fields:
+            setattr(obj, f"_{name}", value)
+        else:
+            getattr(obj, name)._set_result_for_query(value)
+
+    return obj
+
+
+class _ModelPickler(pickle.Pickler):
+    """
+    For the in-process query cache, pickles Tortoise models as their column values plus whatever relations were already fetched,
+    the rest of the model state (meta, connections, unfetched querysets) is rebuilt from the class.
+    """
+
+    def reducer_override(self, obj: Any) -> Any:
+        if not isinstance(obj, Model):
+            return NotImplemented
+
+        meta = obj._meta
+        state = obj.__dict__
+
+        fields = {name: state[name] for name in meta.fields_db_projection if name in state}
+        # annotations and other plain attributes set by the handlers
+        for name, value in state.items():
+            if not name.startswith("_") and name not in fields:
+                fields[name] = value
+
+        relations = {}
+        for name in meta.fk_fields | meta.o2o_fields:
+            value = state.get(f"_{name}")
+            if isinstance(value, Model):
+                relations[name] = value
+        for name in meta.m2m_fields | meta.backward_fk_fields | meta.backward_o2o_fields:
+            value = state.get(f"_{name}")
+            if getattr(value, "_fetched", False):
+                relations[name] = list(value.related_objects)
+
+        return _restore_model, (type(obj), fields, relations)
+
+
+def _snapshot(value: Any) -> bytes:
+    buffer = io.BytesIO()
+    _ModelPickler(buffer, protocol=pickle.HIGHEST_PROTOCOL).dump(value)
+    return buffer.getvalue()
+
+
+def _restore_snapshot(data: bytes) -> Any:
+    return pickle.loads(data)
+
+
+# the shared cache only holds plain data, so what's read from redis can't be anything else. values with models or
+# other objects in them stay in the in-process cache, the pages are cached as their rendered output anyway
+_SHARED_ENUMS: Dict[str, type] = {cls.__name__: cls for cls in (Team, Role, GameType, EventType, IntRole,
+                                                                PlayerStateType, PlayerStateDetailType, Permission)}
+
+
+def _to_plain(value: Any) -> Any:
+    # json has no tuples, datetimes, enums or dicts with other keys than strings, those are stored tagged
+    if value is None or isinstance(value, (bool, str)) and not isinstance(value, Enum):
+        return value
+    if isinstance(value, Enum):
+        if _SHARED_ENUMS.get(type(value).__name__) is not type(value):
+            raise TypeError(f"{type(value).__name__} can't be stored in the shared cache")
+        return {"__enum__": type(value).__name__, "name": value._name_}
+    if isinstance(value, (int, float)):
+        return value
+    if isinstance(value, list):
+        return [_to_plain(item) for item in value]
+    if isinstance(value, tuple):
+        return {"__tuple__": [_to_plain(item) for item in value]}
+    if isinstance(value, dict):
+        return {"__dict__": [[_to_plain(k), _to_plain(v)] for k, v in value.items()]}
+    if isinstance(value, datetime):
+        return {"__datetime__": value.isoformat()}
+    raise TypeError(f"{type(value).__name__} can't be stored in the shared cache")
+
+
+def _from_plain(value: Any) -> Any:
+    if isinstance(value, list):
+        return [_from_plain(item) for item in value]
+    if not isinstance(value, dict):
+        return value
+    if "__tuple__" in value:
+        return tuple([_from_plain(item) for item in value["__tuple__"]])
+    if "__dict__" in value:
+        return {_from_plain(k): _from_plain(v) for k, v in value["__dict__"]}
+    if "__datetime__" in value:
+        return datetime.fromisoformat(value["__datetime__"])
+    if "__enum__" in value:
+        return _SHARED_ENUMS[value["__enum__"]][value["name"]]
+    raise ValueError(f"Not a shared cache value: {value!r}")
+
+
+def serialize_cache_value(value: Any) -> bytes:
+    """
+    Serializes a cache entry into the compact form stored in the shared cache, compressed json.
+
+    Raises TypeError if the value contains something that isn't plain data (see _to_plain()).
+    """
+    return zlib.compress(json.dumps(_to_plain(value), separators=(",", ":")).encode("utf-8"))
+
+
+def deserialize_cache_value(data: bytes) -> Any:
+    return _from_plain(json.loads(zlib.decompress(data)))
+
+
+class InMemoryRedis:
+    """
+    Minimal stand-in for the parts of the redis client the shared cache uses.
+
+    Keeps everything in a dict of the current process, meant for tests and for running without redis.
+    """
+
+    def __init__(self) -> None:
+        self._data: Dict[str, Tuple[bytes, Optional[float]]] = {}
+
+    def _alive(self, key: str) -> bool:
+        entry = self._data.get(key)
+        if entry is None:
+            return False
+        if entry[1] is not None and entry[1] < time.time():
+            del self._data[key]
+            return False
+        return True
+
+    async def get(self, key: str) -> Optional[bytes]:
+        return self._data[key][0] if self._alive(key) else None
+
+    async def set(self, key: str, value: bytes, ex: Optional[int] = None) -> bool:
+        self._data[key] = (value, time.time() + ex if ex is not None else None)
+        return True
+
+    async def delete(self, *keys: str) -> int:
+        return len([self._data.pop(key) for key in keys if self._alive(key)])
+
+    async def scan_iter(self, match: Optional[str] = None) -> AsyncIterator[str]:
+        prefix = match.rstrip("*") if match else ""
+        for key in list(self._data):
+            if key.startswith(prefix) and self._alive(key):
+                yield key
+
+
+class SharedCache:
+    """
+    Cache level below the in-process caches, shared between workers through redis.
+
+    Values are stored in the form produced by serialize_cache_value() next to their expiry time.
+    Redis errors and values that can't be serialized are logged and treated as misses,
+    a broken shared cache only ever costs a recomputation.
+    """
+
+    def __init__(self, redis: Any, prefix: str = shared_cache_prefix,
+                 min_expiry: int = shared_cache_min_expiry) -> None:
+        """
+        `redis` must be a client returning bytes (decode_responses=False), or an InMemoryRedis.
+        """
+        self.redis = redis
+        self.prefix = prefix
+        self.min_expiry = min_expiry
+
+        self.hits = 0
+        self.misses = 0
+        self.writes = 0
+        self.unserializable = 0
+        self.errors = 0
+
+    def _redis_key(self, key: str) -> str:
+        return self.prefix + hashlib.sha256(key.encode("utf-8")).hexdigest()
+
+    async def get(self, key: str) -> Optional[Tuple[Any, float]]:
+        try:
+            data = await self.redis.get(self._redis_key(key))
+            entry = deserialize_cache_value(data) if data is not None else None
+        except Exception as e:
+            self.errors += 1
+            logger.warning(f"Shared cache lookup failed for {key}: {e!r}")
+            entry = None
+
+        if entry is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return entry
+
+    async def set(self, key: str, entry: Tuple[Any, float]) -> bool:
+        try:
+            data = serialize_cache_value(entry)
+        except Exception as e:
+            self.unserializable += 1
+            logger.debug(f"Not storing {key} in the shared cache: {e!r}")
+            return False
+
+        expiry = max(int(entry[1] - time.time()) + 1, self.min_expiry)
+        try:
+            await self.redis.set(self._redis_key(key), data, ex=expiry)
+        except Exception as e:
+            self.errors += 1
+            logger.warning(f"Shared cache write failed for {key}: {e!r}")
+            return False
+
+        self.writes += 1
+        return True
+
+    async def delete(self, *keys: str) -> None:
+        if not keys:
+            return
+        try:
+            await self.redis.delete(*[self._redis_key(key) for key in keys])
+        except Exception as e:
+            self.errors += 1
+            logger.warning(f"Shared cache delete failed for {', '.join(keys)}: {e!r}")
+
+    async def clear(self) -> None:
+        try:
+            keys = [key async for key in self.redis.scan_iter(match=self.prefix + "*")]
+            if keys:
+                await self.redis.delete(*keys)
+        except Exception as e:
+            self.errors += 1
+            logger.warning(f"Shared cache flush failed: {e!r}")
+
+    def get_stats(self) -> Dict[str, Any]:
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "writes": self.writes,
+            "unserializable": self.unserializable,
+            "errors": self.errors,
+        }
+
+
+# (snapshot, expires_at, stored_at) by query, see cached_query()
+queryset_cache: CacheBackend = BoundedCache(queryset_cache_max_entries, queryset_cache_max_bytes,
+                                            sizeof=lambda entry: len(entry[0]) + 64)
+# (result, expires_at, stored_at) by key, see cache() and cache_template()
+function_cache: CacheBackend = BoundedCache(function_cache_max_entries, function_cache_max_bytes)
 function_cache_enabled = False
-original_await = QuerySet.__await__
+# optional shared second level for cache/cache_template, see use_shared_cache()
+shared_cache: Optional[SharedCache] = None
+
+# single-flight bookkeeping: key -> task computing the value for that key right now
+_inflight: Dict[str, asyncio.Task] = {}
+# number of callers that awaited another caller's computation instead of starting their own
+coalesced_waiters = 0
+# number of background refreshes that were skipped because one was already running for the key
+coalesced_refreshes = 0
+# keys that are being refreshed in the background right now
+_background_refreshes: Set[str] = set()
+# generation of every key that is being computed right now, bumped whenever the key is invalidated, marked stale or
+# evicted so a computation that started before doesn't store its outdated result (see _refresh_entry())
+_generations: Dict[str, int] = {}
+# the tags collected so far by each computation running right now, by key, so entries that aren't stored yet are
+# found by their tags as well
+_computing_tags: Dict[str, List[Set[str]]] = {}
+# "module.function" -> [hits, stale hits, misses] of cache() and cache_template()
+function_stats: Dict[str, List[int]] = {}
+
+# dependency tags, an entry is dropped or marked stale when one of its tags is invalidated
+TAG_LEADERBOARD = "leaderboard"  # anything that depends on player ratings
+TAG_STATS = "stats"  # totals and accuracy numbers over all games
+TAG_GAMES = "games"  # lists of games
+
+_tag_keys: Dict[str, Set[str]] = {}
+_key_tags: Dict[str, FrozenSet[str]] = {}
+# tags declared with cache(tags=...) and cache_template(tags=...), by undecorated function
+_declared_tags: Dict[Callable, Union[Iterable[str], Callable[..., Iterable[str]]]] = {}
+# query arguments that are part of the key, declared with cache(query_args=...), by undecorated function
+_query_args: Dict[Callable, Tuple[str, ...]] = {}
+# functions decorated with cache_template(), True if they cache rendered output instead of template arguments
+_template_modes: Dict[Callable, bool] = {}
+# "module.function" key prefixes, by undecorated function
+_key_prefixes: Dict[Callable, str] = {}
+# tags collected for the entry that is being computed in the current task, see add_cache_tags()
+_collected_tags: contextvars.ContextVar[Optional[Set[str]]] = contextvars.ContextVar("collected_tags", default=None)
+
+# expiry times of queryset_cache entries as a heap of (expires_at, key), expired entries are removed
+# whenever cached_query() runs instead of every entry having its own timer
+_query_expiry: List[Tuple[float, str]] = []
+# query shape -> [hits, misses]
+query_shape_stats: Dict[str, List[int]] = {}
+_SQL_LITERAL = re.compile(r"'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b")
 
 # list of funtions to save in cache when the server starts
 precached_functions: Dict[Callable, Tuple[List, Dict]] = {}
@@ -27,108 +601,492 @@ precached_templates: Dict[Callable, Tuple[List, Dict]] = {}
 precached_rules: Dict[Callable, Awaitable] = {}
 precached_template_rules: Dict[Callable, Awaitable] = {}
 
+# precache priorities, lower runs first
+PRECACHE_PRIORITY_HIGH = 0  # pages nearly every visitor sees (index, stats)
+PRECACHE_PRIORITY_NORMAL = 1
+PRECACHE_PRIORITY_LOW = 2  # long tail like single player pages
 
-def __await__(self: QuerySet) -> Any:
-    self._make_query()
+precache_priorities: Dict[Callable, int] = {}
+# how many targets are precached at the same time, so startup doesn't take every database connection
+precache_concurrency = 4
 
-    if self.query in queryset_cache:
-        result = queryset_cache[self.query][0]
 
-        async def _wrapper() -> Any:
-            return result
+def use_cache() -> None:
+    global function_cache_enabled
+    function_cache_enabled = True
+
+
+def _query_key(qs: AwaitableQuery) -> str:
+    # prefetches and first()/get() aren't part of the SQL but change the result
+    prefetch = sorted(getattr(qs, "_prefetch_map", {}) or {})
+    return f"query:{type(qs).__name__}:{getattr(qs, '_single', False)}:{prefetch}:{qs.sql()}"
+
+
+def _query_shape(sql: str) -> str:
+    # the query with its literals taken out, so hit ratios are counted per query and not per parameter
+    return _SQL_LITERAL.sub("?", sql)
+
+
+def _expire_queries(now: float) -> None:
+    while _query_expiry and _query_expiry[0][0] <= now:
+        expires_at, key = heapq.heappop(_query_expiry)
+        # the key may have been refreshed with a later expiry since this was pushed
+        if key in queryset_cache and queryset_cache.peek(key)[1] <= now:
+            del queryset_cache[key]
+            _set_tags(key, ())
+
+
+async def cached_query(qs: AwaitableQuery, ttl: Union[float, int] = refresh_time_queryset,
+                       tags: Iterable[str] = ()) -> Any:
+    """
+    Awaits `qs`, or returns a copy of its result from the last ttl seconds.
+
+    The result is stored as a snapshot, so every caller gets its own model instances and
+    nothing a request changes on them leaks into the next one. Use for queries that are
+    run often with the same parameters and whose results don't need to be current to the second,
+    `tags` work like the ones of cache() and are also added to the cached function this runs in.
+    """
+    tags = tuple(tags)
+    add_cache_tags(*tags)
+
+    if not function_cache_enabled:
+        return await qs
+
+    now = time.time()
+    _expire_queries(now)
+
+    key = _query_key(qs)
+    counts = query_shape_stats.setdefault(_query_shape(key), [0, 0])
 
-        yield from _wrapper().__await__()
+    cached = queryset_cache.get(key)
+    if cached is not None and cached[1] > now:
+        counts[0] += 1
+        return _restore_snapshot(cached[0])
 
+    counts[1] += 1
+    result = await qs
+
+    try:
+        snapshot = _snapshot(result)
+    except Exception as e:
+        logger.debug(f"Not caching query {key}: {e!r}")
         return result
-    else:
-        result = original_await(self)
 
-        result_value = (yield from result)
+    expires_at = now + ttl
+    queryset_cache[key] = (snapshot, expires_at, now)
+    _set_tags(key, tags)
+    heapq.heappush(_query_expiry, (expires_at, key))
 
-        if "LIMIT 1" not in self.query:
-            queryset_cache[self.query] = (result_value, self)
+    return result
 
-            # schedule a refresh after 'refresh_time_queryset' seconds
 
-            async def _refresh() -> None:
-                await asyncio.sleep(refresh_time_queryset)
-                del queryset_cache[self.query]
+def use_shared_cache(redis: Any) -> SharedCache:
+    """
+    Puts a shared cache backed by `redis` (a client that returns bytes) below the in-process function cache.
+    """
+    global shared_cache
+    shared_cache = SharedCache(redis)
+    return shared_cache
 
-            asyncio.ensure_future(_refresh())
 
-        async def _wrapper() -> Any:
-            return result_value
+def set_cache_backends(function_backend: Optional[CacheBackend] = None,
+                       queryset_backend: Optional[CacheBackend] = None) -> None:
+    """
+    Replaces the storage used by cache/cache_template and/or the queryset cache.
 
-        yield from _wrapper().__await__()
+    Existing entries are not carried over.
+    """
+    global function_cache, queryset_cache
+
+    if function_backend is not None:
+        function_cache = function_backend
+        function_cache.on_evict = _drop_tags
+    if queryset_backend is not None:
+        queryset_cache = queryset_backend
+        queryset_cache.on_evict = _drop_tags
+
+
+def get_cache_stats() -> Dict[str, Optional[Dict[str, Any]]]:
+    # per decorated function, entries stored by precaching count even if the function was never called
+    functions: Dict[str, Dict[str, Any]] = {}
+    for key in function_cache.keys():
+        name = key.split(":", 1)[0]
+        stats = functions.setdefault(name, {"entries": 0, "bytes": 0})
+        stats["entries"] += 1
+        stats["bytes"] += _size_of(function_cache, key) or 0
+    for name, (hits, stale_hits, misses) in function_stats.items():
+        total = hits + stale_hits + misses
+        functions.setdefault(name, {"entries": 0, "bytes": 0}).update({
+            "hits": hits,
+            "stale_hits": stale_hits,
+            "misses": misses,
+            "hit_ratio": (hits + stale_hits) / total if total > 0 else 0.0,
+        })
+
+    return {
+        "function_cache": function_cache.get_stats(),
+        "functions": functions,
+        "queryset_cache": {
+            **queryset_cache.get_stats(),
+            "shapes": {shape: {"hits": hits, "misses": misses} for shape, (hits, misses) in query_shape_stats.items()},
+        },
+        "shared_cache": shared_cache.get_stats() if shared_cache is not None else None,
+        "single_flight": {
+            "in_flight": len(_inflight),
+            "background_refreshes": len(_background_refreshes),
+            "coalesced_waiters": coalesced_waiters,
+            "coalesced_refreshes": coalesced_refreshes,
+        },
+    }
 
-        return result_value
 
+def _size_of(backend: CacheBackend, key: str) -> Optional[int]:
+    return backend.size_of(key) if isinstance(backend, BoundedCache) else None
+
+
+def get_cache_entries() -> List[Dict[str, Any]]:
+    """
+    Returns every entry of the function and query caches with its size, age and remaining TTL (negative if stale),
+    largest first. Reading them doesn't count as a use of the entries.
+    """
+    now = time.time()
+    entries = []
+    for cache_name, backend in [("function", function_cache), ("query", queryset_cache)]:
+        for key in backend.keys():
+            entry = backend.peek(key)
+            if entry is None:
+                continue
+            entries.append({
+                "cache": cache_name,
+                "key": key,
+                "function": key.split(":", 1)[0] if cache_name == "function" else _query_shape(key),
+                "bytes": _size_of(backend, key),
+                "age": now - entry[2],
+                "ttl_left": entry[1] - now,
+                "refreshing": key in _background_refreshes,
+                "tags": sorted(_key_tags.get(key, ())),
+            })
+
+    entries.sort(key=lambda entry: entry["bytes"] or 0, reverse=True)
+    return entries
+
+
+async def evict(key: str) -> bool:
+    """
+    Drops a single entry by key, from both levels. Returns whether this process had it.
+    """
+    dropped = function_cache.pop(key, None) is not None or queryset_cache.pop(key, None) is not None
+    _set_tags(key, ())
+    _bump_generations([key])
+
+    if shared_cache is not None:
+        await shared_cache.delete(key)
+
+    logger.info(f"Evicted cache entry {key}")
+    return dropped
+
+
+def _start_flight(key: str, compute: Callable[[], Awaitable[Any]]) -> Tuple[asyncio.Task, bool]:
+    """
+    Returns the task computing `key`, starting it with `compute` if nothing is running for that key yet.
+
+    The second value is True if a new computation was started. The computation runs in its own task
+    so a cancelled request doesn't cancel the work other requests are waiting on.
+    """
+    task = _inflight.get(key)
+    if task is not None:
+        return task, False
+
+    task = asyncio.ensure_future(compute())
+    _inflight[key] = task
+
+    def _done(t: asyncio.Task) -> None:
+        if _inflight.get(key) is t:
+            del _inflight[key]
+        if not t.cancelled():
+            t.exception()  # mark the exception as retrieved in case every waiter went away
+
+    task.add_done_callback(_done)
+    return task, True
+
+
+async def _single_flight(key: str, compute: Callable[[], Awaitable[Any]]) -> Any:
+    """
+    Runs `compute` for `key`, or waits for the computation that is already running for it.
+    """
+    global coalesced_waiters
+
+    task, started = _start_flight(key, compute)
+    if not started:
+        coalesced_waiters += 1
+        logger.debug("Waiting for in-flight computation of %s", key)
+
+    return await asyncio.shield(task)
 
-def use_cache() -> None:
-    global function_cache_enabled
-    QuerySet.__await__ = __await__
-    function_cache_enabled = True
+
+def _refresh_in_background(key: str, compute: Callable[[], Awaitable[Any]]) -> None:
+    global coalesced_refreshes
+
+    task, started = _start_flight(key, compute)
+    if not started:
+        coalesced_refreshes += 1
+        return
+
+    _background_refreshes.add(key)
+    task.add_done_callback(lambda _: _background_refreshes.discard(key))
+
+
+def game_tag(type: str, id: Union[int, str]) -> str:
+    return f"game:{type}:{id}"
+
+
+def entity_tag(entity_id: str) -> str:
+    return f"entity:{entity_id}"
+
+
+def player_tag(player_id: str) -> str:
+    return f"player:{player_id}"
+
+
+def add_cache_tags(*tags: str) -> None:
+    """
+    Adds tags to the entry that is being computed, for dependencies only known inside the cached function.
+
+    Does nothing when called outside of a cached function.
+    """
+    collected = _collected_tags.get()
+    if collected is not None:
+        collected.update(tags)
+
+
+def _tags_for(f, args, kwargs) -> Set[str]:
+    from db.game import Game, EntityStarts
+    from db.player import Player
+
+    tags = set()
+
+    declared = _declared_tags.get(f)
+    if callable(declared):
+        tags.update(declared(*args, **kwargs))
+    elif declared is not None:
+        tags.update(declared)
+
+    # games, entities and players passed to the function are dependencies as well
+    for value in (*args, *kwargs.values()):
+        if isinstance(value, Game):
+            tags.add(game_tag(value.short_type, value.id))
+        elif isinstance(value, EntityStarts):
+            tags.add(entity_tag(value.entity_id))
+        elif isinstance(value, Player):
+            tags.update((player_tag(value.player_id), entity_tag(value.entity_id)))
+
+    return tags
+
+
+def _drop_tags(key: Hashable) -> None:
+    for tag in _key_tags.pop(key, ()):
+        keys = _tag_keys.get(tag)
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del _tag_keys[tag]
+
+
+def _set_tags(key: str, tags: Iterable[str]) -> None:
+    _drop_tags(key)
+
+    tags = frozenset(tags)
+    if tags:
+        _key_tags[key] = tags
+        for tag in tags:
+            _tag_keys.setdefault(tag, set()).add(key)
+
+    # backends without on_evict don't tell the index about evicted entries, so forget those once it gets much bigger
+    # than the caches
+    if len(_key_tags) > 2 * max(len(function_cache) + len(queryset_cache), 1024):
+        for stale_key in [k for k in _key_tags if k not in function_cache and k not in queryset_cache]:
+            _drop_tags(stale_key)
+
+
+# keep the tag index in sync with what the caches evict, set_cache_backends() does the same for new backends
+function_cache.on_evict = _drop_tags
+queryset_cache.on_evict = _drop_tags
+
+
+def _propagate_tags(key: str) -> None:
+    # a cached function that uses another cached function depends on everything that one depends on
+    tags = _key_tags.get(key)
+    if tags:
+        add_cache_tags(*tags)
+
+
+def _keys_for_tags(tags: Iterable[str]) -> Set[str]:
+    tags = set(tags)
+    keys = set()
+    for tag in tags:
+        keys.update(_tag_keys.get(tag, ()))
+    keys.update(key for key, running in _computing_tags.items() if any(not tags.isdisjoint(c) for c in running))
+    return keys
+
+
+def _begin_computation(key: str, collected: Set[str]) -> int:
+    """
+    Registers a computation of `key` that collects its tags in `collected`, returns the generation of the key
+    """
+    _computing_tags.setdefault(key, []).append(collected)
+    return _generations.setdefault(key, 0)
+
+
+def _end_computation(key: str, collected: Set[str]) -> None:
+    running = _computing_tags[key]
+    # by identity, two computations can collect the same tags
+    del running[next(i for i, c in enumerate(running) if c is collected)]
+    if not running:
+        del _computing_tags[key]
+        del _generations[key]
+
+
+def _bump_generations(keys: Iterable[str]) -> None:
+    """
+    Makes the computations of `keys` that are running right now discard their results,
+    callers that come after this start a new computation instead of waiting for them
+    """
+    for key in keys:
+        if key in _generations:
+            _generations[key] += 1
+        _inflight.pop(key, None)
+
+
+async def invalidate(*tags: str) -> int:
+    """
+    Drops every entry that has one of `tags`, the next call computes it again.
+
+    Returns the number of entries dropped.
+    """
+    keys = _keys_for_tags(tags)
+    _bump_generations(keys)
+    dropped = 0
+    for key in keys:
+        if function_cache.pop(key, None) is not None or queryset_cache.pop(key, None) is not None:
+            dropped += 1
+        _set_tags(key, ())
+
+    if shared_cache is not None:
+        await shared_cache.delete(*keys)
+
+    logger.debug(f"Invalidated {dropped} cache entries for {', '.join(tags)}")
+    return dropped
+
+
+async def mark_stale(*tags: str) -> int:
+    """
+    Expires every entry that has one of `tags` without dropping it.
+
+    The stale value keeps being served until the background refresh of the next hit has finished,
+    which is what expensive pages like the stats page want.
+
+    Returns the number of entries marked.
+    """
+    keys = _keys_for_tags(tags)
+    _bump_generations(keys)
+    marked = 0
+    for key in keys:
+        if key in function_cache:
+            # same value, so it keeps its size and its place in the eviction order
+            entry = function_cache.peek(key)
+            function_cache.replace(key, (entry[0], 0, entry[2]))
+            marked += 1
+        elif queryset_cache.pop(key, None) is not None:
+            # queries are never refreshed in the background, so a stale one is just dropped
+            _set_tags(key, ())
+            marked += 1
+
+    if shared_cache is not None:
+        # otherwise the refresh would load the old value back from the shared cache
+        await shared_cache.delete(*keys)
+
+    logger.debug(f"Marked {marked} cache entries stale for {', '.join(tags)}")
+    return marked
+
+
+async def invalidate_game(game) -> None:
+    """
+    Drops everything cached for `game` and the players in it, and marks pages covering all games stale.
+
+    To be called whenever a game or the ratings of its players change.
+    """
+    if not function_cache_enabled:
+        return
+
+    entity_ids = await game.entity_starts.all().values_list("entity_id", flat=True)
+
+    await invalidate(game_tag(game.short_type, game.id), *[entity_tag(entity_id) for entity_id in entity_ids])
+    await mark_stale(TAG_LEADERBOARD, TAG_STATS, TAG_GAMES)
 
 
 def flush_cache(flush_queryset: bool = True, flush_function: bool = True) -> None:
     if flush_queryset:
         queryset_cache.clear()
+        _query_expiry.clear()
     if flush_function:
+        _bump_generations(list(_generations))
         function_cache.clear()
-        Sanic.get_app("laserforce_ranking").add_task(precache_all_functions(), name="Precache Functions After Flush")
+        _tag_keys.clear()
+        _key_tags.clear()
+        Sanic.get_app("laserforce_ranking").add_task(_repopulate_after_flush(), name="Precache Functions After Flush")
     logger.info("Cache flushed")
 
 
+async def _repopulate_after_flush() -> None:
+    # the shared cache has to be empty before precaching, otherwise the old values would be loaded back from it
+    if shared_cache is not None:
+        await shared_cache.clear()
+    await precache_all_functions()
+
+
 # cache decorator (modified from aiocache.cached)
 # ttl: time to live in seconds
 # refresh_in_background: whether to refresh the cache in the background after ttl seconds
-def cache(ttl: Union[float, int] = refresh_time_function, refresh_in_background: bool = True):
+# tags: dependency tags of the entries, either a list or a function taking the same arguments
+#       as the cached function (see invalidate() and mark_stale())
+# query_args: for request handlers, the query arguments that change the response, others are left out of the key
+#             (None means all of them)
+def cache(ttl: Union[float, int] = refresh_time_function, refresh_in_background: bool = True,
+          tags: Optional[Union[Iterable[str], Callable[..., Iterable[str]]]] = None,
+          query_args: Optional[Iterable[str]] = None):
     def decorator(f):
+        if tags is not None:
+            _declared_tags[f] = tags
+        if query_args is not None:
+            _query_args[f] = tuple(query_args)
+
         async def wrapper(*args, **kwargs):
             if not function_cache_enabled:
                 return await f(*args, **kwargs)
 
-            request = None
-            request_args = None
-            if len(args) > 0 and isinstance(args[0], Request):
-                request: Request = args[0]
-                request_args = request.args
-
-            request = None
-            request_args = None
-            request_json = None
-            if len(args) > 0 and isinstance(args[0], Request):
-                request: Request = args[0]
-                request_args = request.args
-                request_json = request.json
-
-            key = f"{f.__name__}_{args}_{kwargs}"
-            if request_args:
-                key += f"_{request_args}"
-            if request_json:
-                key += f"_{request_json}"
+            key = _create_cache_key(f, args, kwargs)
             result = None
+            cached = function_cache.get(key)
+            counts = _function_counts(f)
 
-            if key in function_cache:
-                logger.debug(f"Cache hit for {key}")
-                result = function_cache[key][0]
-                ttl_left = function_cache[key][1] - time.time()
-                logger.debug(f"TTL left for {key}: {ttl_left}")
+            async def _refresh() -> Any:
+                return await _refresh_entry(key, f, args, kwargs, ttl)
 
-                if refresh_in_background and ttl_left < 0:
-                    async def _refresh() -> None:
-                        logger.debug(f"Refreshing cache for {key}")
+            if cached is not None:
+                result = cached[0]
+                ttl_left = cached[1] - time.time()
+                logger.debug("Cache hit for %s, TTL left: %s", key, ttl_left)
+                counts[0 if ttl_left >= 0 else 1] += 1
 
-                        result = await f(*args, **kwargs)
-                        function_cache[key] = (result, time.time() + ttl)
-                        logger.debug(f"Cache refreshed for {key}")
-
-                    asyncio.ensure_future(_refresh())
+                if refresh_in_background and ttl_left < 0:
+                    _refresh_in_background(key, _refresh)
             else:
-                logger.debug(f"Cache miss for {key}")
+                logger.debug("Cache miss for %s", key)
+                counts[2] += 1
 
-                result = await f(*args, **kwargs)
-                function_cache[key] = (result, time.time() + ttl)
+                result = await _single_flight(key, _refresh)
+
+            _propagate_tags(key)
             return result
         
         wrapper.__name__ = f.__name__
@@ -145,36 +1103,146 @@ async def refresh_template(f, *args, ttl: Union[float, int] = refresh_time_funct
     
     key = _create_cache_key(f, args, kwargs)
 
-    logger.debug(f"Refreshing cache for {key}")
+    return await _single_flight(key, _template_refresher(key, f, args, kwargs, ttl))
+
+
+def _template_refresher(key: str, f, args, kwargs, ttl: Union[float, int]) -> Callable[[], Awaitable[Any]]:
+    async def _refresh() -> Any:
+        return await _refresh_entry(key, f, args, kwargs, ttl)
+
+    return _refresh
+
+
+async def _refresh_entry(key: str, f, args, kwargs, ttl: Union[float, int]) -> Any:
+    """
+    Computes the value for `key` and stores it in the function cache, and in the shared cache if one is used.
+
+    If the shared cache has a fresh value for `key` (or any value, when this process has none yet),
+    that value is used instead of computing it again.
+
+    If the key is invalidated while this runs, the result is returned to the callers waiting for it but not stored,
+    it may have been computed from data from before the change.
+    """
+    collected = _tags_for(f, args, kwargs)
+    generation = _begin_computation(key, collected)
+    try:
+        return await _compute_entry(key, f, args, kwargs, ttl, collected, generation)
+    finally:
+        _end_computation(key, collected)
+
+
+async def _compute_entry(key: str, f, args, kwargs, ttl: Union[float, int], collected: Set[str],
+                         generation: int) -> Any:
+    if shared_cache is not None:
+        entry = await shared_cache.get(key)
+        if entry is not None and (entry[1] >= time.time() or key not in function_cache):
+            logger.debug("Loaded %s from the shared cache", key)
+            if _generations[key] == generation:
+                function_cache[key] = (entry[0], entry[1], time.time())
+                _set_tags(key, entry[2])
+            return entry[0]
+
+    logger.debug("Refreshing cache for %s", key)
+
+    _collected_tags.set(collected)  # this runs in its own task, so the context of the caller isn't touched
 
     result = await f(*args, **kwargs)
-    function_cache[key] = (result, time.time() + ttl)
-    logger.debug(f"Cache refreshed for {key}")
+    output = _template_modes.get(f)
+    if output:
+        from utils import render_output_template
+        result = await render_output_template(result[0], result[1], *result[2], **result[3])
+
+    if _generations[key] != generation:
+        logger.debug("Not storing %s, it was invalidated while it was computed", key)
+        return result
+
+    now = time.time()
+    expires_at = now + ttl
+    function_cache[key] = (result, expires_at, now)
+    _set_tags(key, collected)
+    logger.debug("Cache refreshed for %s", key)
+
+    if shared_cache is not None:
+        # the request a template context was created for is never used again, only the context is
+        value = (None, *result[1:]) if output is False else result
+        await shared_cache.set(key, (value, expires_at, tuple(collected)))
+
+        if _generations[key] != generation:
+            # invalidated during the write, which can have happened after the invalidation deleted it
+            await shared_cache.delete(key)
 
     return result
 
 
+def _key_part(value: Any) -> str:
+    # models are identified by their primary key, their repr can be long and include mutable fields
+    if isinstance(value, Model):
+        return f"{type(value).__name__}#{value.pk}"
+    if isinstance(value, (list, tuple)):
+        return "[" + ",".join([_key_part(item) for item in value]) + "]"
+    if isinstance(value, dict):
+        return "{" + ",".join([f"{_key_part(k)}:{_key_part(v)}" for k, v in value.items()]) + "}"
+    return repr(value)
+
+
+def _query_string_part(request: Request, whitelist: Optional[Iterable[str]]) -> str:
+    # sorted names and values, so ?a=1&b=2 and ?b=2&a=1 are the same entry
+    args = request.args
+    if not args:
+        return ""
+    names = sorted(args) if whitelist is None else sorted(name for name in whitelist if name in args)
+    return "&".join([f"{name}={','.join(sorted(args.getlist(name)))}" for name in names])
+
+
 def _create_cache_key(f, args, kwargs) -> str:
-    key = f"{f.__name__}_{args}_{kwargs}"
-    if len(args) > 0 and isinstance(args[0], Request):
+    """
+    Returns the key for calling `f` with `args` and `kwargs`, the name of the function and a fixed size digest.
+
+    For handlers the request counts with its whitelisted query arguments (see query_args of cache()) and body,
+    everything else about it is ignored. Path parameters are part of `kwargs`.
+    """
+    parts = []
+    if args and isinstance(args[0], Request):
         request: Request = args[0]
-        request_args = request.args
-        request_json = request.json
-        if request_args:
-            key += f"_{request_args}"
-        if request_json:
-            key += f"_{request_json}"
-        logger.debug(
-            f"Creating cache key for {f.__name__} with args: {args} and kwargs: {kwargs}, request_args: {request_args}, request_json: {request_json} => {key}"
-        )
-    else:
-        logger.debug(f"Creating cache key for {f.__name__} with args: {args} and kwargs: {kwargs} => {key}")
-
-    return key
-
-def cache_template(ttl: Union[float, int] = refresh_time_function, refresh_in_background: bool = True):
+        parts.append(_query_string_part(request, _query_args.get(f)))
+        if request.body:
+            parts.append(hashlib.blake2b(request.body, digest_size=16).hexdigest())
+        args = args[1:]
+
+    parts.append(_key_part(args))
+    if kwargs:
+        parts.append(_key_part(kwargs))
+
+    digest = hashlib.blake2b("|".join(parts).encode("utf-8"), digest_size=16).hexdigest()
+    return f"{_key_prefix(f)}:{digest}"
+
+
+def _key_prefix(f) -> str:
+    prefix = _key_prefixes.get(f)
+    if prefix is None:
+        prefix = _key_prefixes[f] = f"{f.__module__}.{f.__qualname__}"
+    return prefix
+
+
+def _function_counts(f) -> List[int]:
+    counts = function_stats.get(_key_prefix(f))
+    if counts is None:
+        counts = function_stats[_key_prefix(f)] = [0, 0, 0]
+    return counts
+
+# output: cache the rendered page instead of the template arguments, per-user parts of the page are
+#         filled in for every response (see utils.render_output_template())
+def cache_template(ttl: Union[float, int] = refresh_time_function, refresh_in_background: bool = True,
+                   tags: Optional[Union[Iterable[str], Callable[..., Iterable[str]]]] = None,
+                   query_args: Optional[Iterable[str]] = None, output: bool = False):
     # cache the results of the template
     def decorator(f):
+        _template_modes[f] = output
+        if tags is not None:
+            _declared_tags[f] = tags
+        if query_args is not None:
+            _query_args[f] = tuple(query_args)
+
         async def wrapper(*args, **kwargs) -> str:
             if not function_cache_enabled:
                 new_args = await f(*args, **kwargs)
@@ -184,19 +1252,25 @@ def cache_template(ttl: Union[float, int] = refresh_time_function, refresh_in_ba
             key = _create_cache_key(f, args, kwargs)
             
             result = None
+            cached = function_cache.get(key)
+            counts = _function_counts(f)
 
-            if key in function_cache:
-                logger.debug(f"Cache hit for {key}")
-                result = function_cache[key][0]
-                ttl_left = function_cache[key][1] - time.time()
-                logger.debug(f"TTL left for {key}: {ttl_left}")
+            if cached is not None:
+                result = cached[0]
+                ttl_left = cached[1] - time.time()
+                logger.debug("Cache hit for %s, TTL left: %s", key, ttl_left)
+                counts[0 if ttl_left >= 0 else 1] += 1
 
                 if refresh_in_background and ttl_left < 0:
-                    asyncio.ensure_future(refresh_template(f, *args, **kwargs, ttl=ttl))
+                    _refresh_in_background(key, _template_refresher(key, f, args, kwargs, ttl))
             else:
-                logger.debug(f"Cache miss for {key}")
+                logger.debug("Cache miss for %s", key)
+                counts[2] += 1
 
-                result = await refresh_template(f, *args, **kwargs, ttl=ttl)
+                result = await _single_flight(key, _template_refresher(key, f, args, kwargs, ttl))
+            if output:
+                from utils import respond_with_output
+                return await respond_with_output(args[0], result)
             from utils import render_template
             return await render_template(args[0], result[1], *result[2], **result[3])
 
@@ -206,7 +1280,8 @@ def cache_template(ttl: Union[float, int] = refresh_time_function, refresh_in_ba
 
     return decorator
 
-def precache(*args, rule: Optional[Awaitable] = None, **kwargs) -> Callable:
+def precache(*args, rule: Optional[Awaitable] = None, priority: int = PRECACHE_PRIORITY_NORMAL,
+             **kwargs) -> Callable:
     """
     Decorator to precache the result of a function.
 
@@ -216,10 +1291,13 @@ def precache(*args, rule: Optional[Awaitable] = None, **kwargs) -> Callable:
     using a function to dynamically generate the argument lists.
 
     @precache(rule=function)
+
+    Targets with a lower `priority` are precached first.
     """
     
 
     def decorator(f):
+        precache_priorities[f] = priority
         args_ = args
 
         if rule is not None:
@@ -237,7 +1315,8 @@ def precache(*args, rule: Optional[Awaitable] = None, **kwargs) -> Callable:
     
     return decorator
 
-def precache_template(*args, rule: Optional[Awaitable] = None, **kwargs) -> Callable:
+def precache_template(*args, rule: Optional[Awaitable] = None, priority: int = PRECACHE_PRIORITY_NORMAL,
+                      **kwargs) -> Callable:
     """
     Decorator to precache the result of a template.
 
@@ -247,8 +1326,11 @@ def precache_template(*args, rule: Optional[Awaitable] = None, **kwargs) -> Call
     using a function to dynamically generate the argument lists.
 
     @precache_template(rule=function)
+
+    Targets with a lower `priority` are precached first.
     """
     def decorator(f):
+        precache_priorities[f] = priority
         args_ = args
 
         if rule is not None:
@@ -271,8 +1353,7 @@ async def _precache_function(f, *args, **kwargs) -> None:
     key = _create_cache_key(f, args, kwargs)
     logger.debug(f"Pre-caching {key} with args: {args} and kwargs: {kwargs}")
 
-    result = await f(*args, **kwargs)
-    function_cache[key] = (result, time.time() + refresh_time_function)
+    await _single_flight(key, _template_refresher(key, f, args, kwargs, refresh_time_function))
 
     logger.debug(f"Pre-cache complete for {key}")
 
@@ -309,6 +1390,107 @@ async def _precache_template(f, *args, **kwargs) -> None:
     await _precache_function(f, *args, **kwargs)
 
 
+class PrecacheScheduler:
+    """
+    Precaches a list of targets in priority order with at most `concurrency` of them running at once.
+
+    Keeps track of its progress for the admin pages, and can be cancelled at any time.
+    """
+
+    def __init__(self, concurrency: int = precache_concurrency) -> None:
+        self.concurrency = concurrency
+        self._queue: List[Tuple[int, int, str, Callable[[], Awaitable[None]]]] = []
+        self._workers: List[asyncio.Task] = []
+
+        self.total = 0
+        self.done = 0
+        self.failed = 0
+        self.running: Dict[str, float] = {}  # name -> start time
+        self.timings: List[Tuple[str, float]] = []  # (name, seconds) of finished targets, in order of completion
+        self.started_at: Optional[float] = None
+        self.finished_at: Optional[float] = None
+        self.cancelled = False
+
+    def add(self, priority: int, name: str, run: Callable[[], Awaitable[None]]) -> None:
+        # the counter keeps targets with the same priority in the order they were added
+        heapq.heappush(self._queue, (priority, self.total, name, run))
+        self.total += 1
+
+    async def _worker(self) -> None:
+        while self._queue:
+            _, _, name, run = heapq.heappop(self._queue)
+            start = time.time()
+            self.running[name] = start
+            try:
+                await run()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                self.failed += 1
+                logger.warning(f"Pre-caching {name} failed: {e!r}")
+            finally:
+                del self.running[name]
+            self.done += 1
+            self.timings.append((name, time.time() - start))
+
+    async def run(self) -> None:
+        self.started_at = time.time()
+        self._workers = [asyncio.ensure_future(self._worker()) for _ in range(min(self.concurrency, self.total))]
+        try:
+            await asyncio.gather(*self._workers)
+        finally:
+            self.finished_at = time.time()
+
+        logger.info(f"Pre-cached {self.done} targets in {self.finished_at - self.started_at:.1f}s ({self.failed} failed)")
+
+    def cancel(self) -> None:
+        self.cancelled = True
+        self._queue.clear()
+        for worker in self._workers:
+            worker.cancel()
+
+    def get_progress(self) -> Dict[str, Any]:
+        now = time.time()
+        return {
+            "total": self.total,
+            "done": self.done,
+            "failed": self.failed,
+            "cancelled": self.cancelled,
+            "elapsed": ((self.finished_at or now) - self.started_at) if self.started_at is not None else 0,
+            "finished": self.finished_at is not None,
+            "running": {name: now - start for name, start in self.running.items()},
+            "timings": [{"name": name, "seconds": seconds} for name, seconds in self.timings],
+        }
+
+
+_precache_scheduler: Optional[PrecacheScheduler] = None
+
+
+def get_precache_progress() -> Optional[Dict[str, Any]]:
+    """
+    Returns the progress of the last (or current) precache run, None if there was none yet.
+    """
+    return _precache_scheduler.get_progress() if _precache_scheduler is not None else None
+
+
+def cancel_precache() -> None:
+    if _precache_scheduler is not None:
+        _precache_scheduler.cancel()
+
+
+def _precache_target_name(f, args, kwargs) -> str:
+    arguments = [repr(arg) for arg in args] + [f"{name}={value!r}" for name, value in kwargs.items()]
+    return f"{f.__name__}({', '.join(arguments)})"
+
+
+async def _rule_targets(f, rule) -> List[Tuple[List, Dict]]:
+    if not asyncio.iscoroutinefunction(rule):
+        raise TypeError(f"Precache rule for {f.__name__} must be a coroutine function")
+
+    arglists, kwarglists = await rule()
+    return list(zip(arglists, kwarglists))
+
+
 async def precache_all_functions() -> None:
     """
     Actually precache the functions/templates that were decorated with @precache or @precache_template.
@@ -317,40 +1499,26 @@ async def precache_all_functions() -> None:
     and the db isn't connected, so we can't run the function.
 
     Run this function (in the background) after the server starts to precache all functions.
+    A run that is still going when this is called again is cancelled.
     """
+    global _precache_scheduler
 
     logger.info("Pre-caching functions and templates...")
 
-    # add the dynamic precache rules
+    cancel_precache()
+    scheduler = _precache_scheduler = PrecacheScheduler()
 
-    for f, rule in precached_rules.items():
-        if asyncio.iscoroutinefunction(rule):
-            arglists, kwarglists = await rule()
-        else:
-            raise TypeError(f"Precache rule for {f.__name__} must be a coroutine function")
-
-        for args, kwargs in zip(arglists, kwarglists):
-            if precached_functions.get(f):
-                precached_functions[f].append((args, kwargs))
-            else:
-                precached_functions[f] = [(args, kwargs)]
-    
-    for f, rule in precached_template_rules.items():
-        if asyncio.iscoroutinefunction(rule):
-            arglists, kwarglists = await rule()
-        else:
-            raise TypeError(f"Precache rule for {f.__name__} must be a coroutine function")
+    # the dynamic precache rules are evaluated again for every run, their results change as games are added
 
-        for args, kwargs in zip(arglists, kwarglists):
-            if precached_templates.get(f):
-                precached_templates[f].append((args, kwargs))
-            else:
-                precached_templates[f] = [(args, kwargs)]
+    for targets, rules, precache_target in ((precached_functions, precached_rules, _precache_function),
+                                            (precached_templates, precached_template_rules, _precache_template)):
+        for f in {**targets, **rules}:
+            arglists = list(targets.get(f, []))
+            if f in rules:
+                arglists += await _rule_targets(f, rules[f])
 
-    for f, arglists in precached_functions.items():
-        for args, kwargs in arglists:
-            asyncio.ensure_future(_precache_function(f, *args, **kwargs))
+            for args, kwargs in arglists:
+                scheduler.add(precache_priorities.get(f, PRECACHE_PRIORITY_NORMAL), _precache_target_name(f, args, kwargs),
+                              partial(precache_target, f, *args, **kwargs))
 
-    for f, arglists in precached_templates.items():
-        for args, kwargs in arglists:
-            asyncio.ensure_future(_precache_template(f, *args, **kwargs))
\ No newline at end of file
+    await scheduler.run()
@@ -4,12 +4,19 @@ This is different from statshelper in that it does not calculate stats, it
 only deals with getting and extracting and visualizing data.
 """
 from collections import defaultdict
-from typing import List, Dict
+from typing import List, Dict, Optional
 
 from sanic import exceptions
 
 from db.game import EntityStarts, EntityEnds, PlayerInfo
+from db.laserball import LaserballGame
+from db.sm5 import SM5Game
 from db.types import PlayerStateDetailType, Team
+from helpers.cachehelper import cached_query, game_tag
+
+# How long a game's version is trusted before it's looked up again. Edits made in this process drop it right
+# away, this only bounds how long other workers keep answering 304 for a game that was edited elsewhere.
+GAME_VERSION_TTL = 60
 
 """Map of every possible player state and the display name for it in SM5 games.
 
@@ -109,4 +116,25 @@ async def get_matchmaking_teams(team_rosters: Dict[Team, List[PlayerInfo]]) -> (
     players_matchmake_team1 = await get_player_current_names(team_rosters[team1])
     players_matchmake_team2 = await get_player_current_names(team_rosters[team2])
 
-    return players_matchmake_team1, players_matchmake_team2
\ No newline at end of file
+    return players_matchmake_team1, players_matchmake_team2
+
+async def get_game_etag(type: str, id: int) -> Optional[str]:
+    """
+    Returns the ETag for everything served about a game, or None if the game doesn't exist.
+
+    It's made of the game id, its laserrank_version and edit_version, so it only changes when the game is migrated
+    or edited. The version is kept in the query cache, a request for a game that didn't change doesn't need the DB.
+    """
+    if type == "sm5":
+        version = await cached_query(SM5Game.filter(id=id).first().values_list("laserrank_version", "edit_version"),
+                                     ttl=GAME_VERSION_TTL, tags=[game_tag(type, id)])
+    elif type == "laserball":
+        version = await cached_query(LaserballGame.filter(id=id).first().values_list("edit_version"),
+                                     ttl=GAME_VERSION_TTL, tags=[game_tag(type, id)])
+    else:
+        return None
+
+    if version is None:
+        return None
+
+    return f'"{type}-{id}-' + "-".join(str(part) for part in version) + '"'
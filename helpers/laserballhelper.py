@@ -12,7 +12,7 @@ from db.types import Team
 from helpers.cachehelper import cache
 from helpers.gamehelper import get_team_rosters, SM5_STATE_LABEL_MAP
 from helpers.statshelper import PlayerCoreGameStats, get_player_state_distribution, TeamCoreGameStats, count_blocks, \
-    get_ticks_for_time_graph, millis_to_time, TimeSeriesRawData, TimeSeriesDataPoint
+    get_ticks_for_time_graph, millis_to_time, TimeSeriesRawData, TimeSeriesDataPoint, get_game_summary
 
 # TODO: A lot of stuff from statshelper.py should be moved here. But let's do that separately to keep the commit size
 #  reasonable.
@@ -205,6 +205,9 @@ async def get_laserball_player_stats(game: LaserballGame,
     all_players = {}
     game_duration = game.mission_duration
 
+    # computed when the game was imported, older games might not have one yet
+    summary = await get_game_summary(game)
+
     team_rosters = await get_team_rosters(game.entity_starts, game.entity_ends)
 
     possession_times = await game.get_possession_times()
@@ -239,10 +242,15 @@ async def get_laserball_player_stats(game: LaserballGame,
                 # This player might have been kicked before the game was over. Don't include in the actual result.
                 continue
 
-            state_distribution = await get_player_state_distribution(player.entity_start, player.entity_end,
-                                                                     game.player_states,
-                                                                     game.events,
-                                                                     SM5_STATE_LABEL_MAP)
+            player_summary = summary.get_player(player.entity_start) if summary else None
+
+            if player_summary:
+                state_distribution = player_summary["state_distribution"]
+            else:
+                state_distribution = await get_player_state_distribution(player.entity_start, player.entity_end,
+                                                                         game.player_states,
+                                                                         game.events,
+                                                                         SM5_STATE_LABEL_MAP)
 
             blocked_main_player = None
             blocked_by_main_player = None
@@ -344,7 +352,7 @@ async def get_laserball_player_stats(game: LaserballGame,
         teams.append(
             TeamLaserballGameStats(
                 team=team,
-                score=await game.get_team_score(team),
+                score=summary.get_team_score(team) if summary else await game.get_team_score(team),
                 players=players,
                 sum_player=sum_player,
                 team_score_graph=team_score_graph,
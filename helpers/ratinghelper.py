@@ -1,19 +1,23 @@
+import datetime
 import itertools
 import math
 import random
 import statistics
-from typing import List, Tuple, Union, Optional
+from dataclasses import dataclass, field
+from functools import cached_property
+from typing import Callable, Dict, Iterable, List, MutableSequence, Sequence, Set, Tuple, Union, Optional
 
 from openskill.models import PlackettLuceRating, PlackettLuce
 from openskill.models.weng_lin.common import phi_major
 from sanic.log import logger
+from tortoise.expressions import F, Q
 
-from db.game import Events
+from db.game import EntityEnds, EntityStarts, Events, Teams
 from db.laserball import LaserballGame
 from db.player import Player
 from db.sm5 import SM5Game
-from db.types import EventType, GameType, Team, IntRole
-from helpers import userhelper
+from db.types import EventType, GameType, Team, IntRole, NAME_TO_TEAM
+from helpers import cachehelper
 
 # CONSTANTS
 
@@ -92,6 +96,8 @@ LB_ASSIST_WEIGHT_SIGMA = 0.75  # uncertainty weight for assists in laserball
 
 
 class CustomPlackettLuce(PlackettLuce):
+    zeta = ZETA  # uneven team adjustment, see predict_win()
+
     def predict_win(self, teams: List[List[PlackettLuceRating]]) -> List[Union[int, float]]:
         # Check Arguments
         self._check_teams(teams)
@@ -108,13 +114,13 @@ class CustomPlackettLuce(PlackettLuce):
                 # team 1 has more players than team 2
                 for player in teams[1]:
                     # multiply by 1 + 0.1 * the difference in player count
-                    player.mu *= 1 + ZETA * abs(len(teams[0]) - len(teams[1]))
+                    player.mu *= 1 + self.zeta * abs(len(teams[0]) - len(teams[1]))
             elif len(teams[0]) < len(teams[1]): # TODO: do testing to see if this actually predicts uneven matches well
                 logger.debug("Adjusting team ratings for uneven team count (team 2 has more players)")
                 # team 2 has more players than team 1
                 for player in teams[0]:
                     # multiply by 1 + 0.1 * the difference in player count
-                    player.mu *= 1 + ZETA * abs(len(teams[0]) - len(teams[1]))
+                    player.mu *= 1 + self.zeta * abs(len(teams[0]) - len(teams[1]))
 
             total_player_count = len(teams[0]) + len(teams[1])
             teams_ratings = self._calculate_team_ratings(teams)
@@ -136,310 +142,338 @@ class CustomPlackettLuce(PlackettLuce):
         return PlackettLuce.predict_win(self, teams)
 
 
-model = CustomPlackettLuce(MU, SIGMA, BETA, KAPPA, tau=TAU)
-Rating = PlackettLuceRating
-
-
-# sm5 elo helper functions
-
-async def update_sm5_ratings(game: SM5Game) -> bool:
+@dataclass(frozen=True)
+class RatingConfig:
     """
-    Updates the sm5 ratings for a game
-    it first calculates the individual player ratings
-    then it calculates the team ratings
-    then it updates the player ratings through openskill
+    The parameters of the rating model, the defaults are the constants above.
 
-    returns: True if successful, False if not
-    it could return False if the game is not ranked
+    The rating functions take one so other values can be tried without changing the module,
+    see helpers/sweephelper.py
     """
-    if not game.ranked:
-        return False
+    mu: float = MU
+    sigma: float = SIGMA
+    beta: float = BETA
+    kappa: float = KAPPA
+    tau: float = TAU
+    zeta: float = ZETA
+
+    sm5_hit_weight_mu: float = SM5_HIT_WEIGHT_MU
+    sm5_hit_weight_sigma: float = SM5_HIT_WEIGHT_SIGMA
+    sm5_hit_medic_weight_mu: float = SM5_HIT_MEDIC_WEIGHT_MU
+    sm5_hit_medic_weight_sigma: float = SM5_HIT_MEDIC_WEIGHT_SIGMA
+    sm5_missile_weight_mu: float = SM5_MISSILE_WEIGHT_MU
+    sm5_missile_weight_sigma: float = SM5_MISSILE_WEIGHT_SIGMA
+    sm5_missile_medic_weight_mu: float = SM5_MISSILE_MEDIC_WEIGHT_MU
+    sm5_missile_medic_weight_sigma: float = SM5_MISSILE_MEDIC_WEIGHT_SIGMA
+    sm5_role_weight_multipliers: Dict[IntRole, Tuple[float, float]] = \
+        field(default_factory=lambda: dict(SM5_ROLE_WEIGHT_MULTIPLIERS))
+
+    lb_steal_weight_mu: float = LB_STEAL_WEIGHT_MU
+    lb_steal_weight_sigma: float = LB_STEAL_WEIGHT_SIGMA
+    lb_goal_weight_mu: float = LB_GOAL_WEIGHT_MU
+    lb_goal_weight_sigma: float = LB_GOAL_WEIGHT_SIGMA
+    lb_assist_weight_mu: float = LB_ASSIST_WEIGHT_MU
+    lb_assist_weight_sigma: float = LB_ASSIST_WEIGHT_SIGMA
+
+    @cached_property
+    def model(self) -> CustomPlackettLuce:
+        model = CustomPlackettLuce(self.mu, self.sigma, self.beta, self.kappa, tau=self.tau)
+        model.zeta = self.zeta
+        return model
+
+
+DEFAULT_CONFIG = RatingConfig()
+
+model = DEFAULT_CONFIG.model
+Rating = PlackettLuceRating
 
-    # need to update previous rating and for each entity end object
 
-    for entity_end in await game.entity_ends.filter(entity__type="player", entity__entity_id__startswith="#"):
-        player = await Player.filter(entity_id=(await entity_end.entity).entity_id).first()
-        entity_end.previous_rating_mu = player.sm5_mu
-        entity_end.previous_rating_sigma = player.sm5_sigma
-        await entity_end.save()
+# one on one updates
 
-    # go through all events for each game
+# every event is a rate() call between two single players, openskill builds, validates and deep copies the teams
+# for each of them. these do the same math on plain floats, in the same order as PlackettLuce._compute() so the
+# results are the same
 
-    events: List[Events] = await game.events.filter(type__in=
-                                                    [EventType.DAMAGED_OPPONENT, EventType.DOWNED_OPPONENT,
-                                                     EventType.MISSILE_DAMAGE_OPPONENT,
-                                                     EventType.MISSILE_DOWN_OPPONENT, EventType.RESUPPLY_LIVES,
-                                                     EventType.RESUPPLY_AMMO]
-                                                    ).order_by("time").all()  # only get the events that we need
 
-    for event in events:
-        if "@" in event.arguments[0] or "@" in event.arguments[2]:
-            continue
-        match event.type:
-            case EventType.DAMAGED_OPPONENT | EventType.DOWNED_OPPONENT:
-                shooter = await userhelper.player_from_token(game, event.arguments[0])
-                shooter_player = await Player.filter(entity_id=shooter.entity_id).first()
-                shooter_elo = shooter_player.sm5_rating
-                shooter_elo_role = shooter_player.get_role_rating(shooter.role)
+def rate_1v1(winner_mu: float, winner_sigma: float, loser_mu: float, loser_sigma: float,
+             config: RatingConfig = DEFAULT_CONFIG) -> Tuple[float, float, float, float]:
+    """
+    Same as config.model.rate([[winner], [loser]], ranks=[0, 1])
 
-                target = await userhelper.player_from_token(game, event.arguments[2])
-                target_player = await Player.filter(entity_id=target.entity_id).first()
-                target_elo = target_player.sm5_rating
-                target_elo_role = target_player.get_role_rating(target.role)
+    returns: (winner mu, winner sigma, loser mu, loser sigma)
+    """
+    tau_squared = config.tau * config.tau
+    beta_squared = config.beta ** 2
 
-                general_out = model.rate([[shooter_elo], [target_elo]], ranks=[0, 1])
-                role_out = model.rate([[shooter_elo_role], [target_elo_role]], ranks=[0, 1])
+    winner_sigma = math.sqrt(winner_sigma * winner_sigma + tau_squared)
+    loser_sigma = math.sqrt(loser_sigma * loser_sigma + tau_squared)
+    winner_sigma_squared = winner_sigma ** 2
+    loser_sigma_squared = loser_sigma ** 2
 
-                weight_mu = SM5_HIT_WEIGHT_MU # default for damage and downed events
-                weight_sigma = SM5_HIT_WEIGHT_SIGMA # default for damage and downed events
-                if target.role == IntRole.MEDIC:
-                    weight_mu = SM5_HIT_MEDIC_WEIGHT_MU # give more weight to medic hits
-                    weight_sigma = SM5_HIT_MEDIC_WEIGHT_SIGMA
+    c = math.sqrt(0.0 + (winner_sigma_squared + beta_squared) + (loser_sigma_squared + beta_squared))
 
-                # update general ratings with weights
-                shooter_player.sm5_mu += (general_out[0][0].mu - shooter_player.sm5_mu) * weight_mu
-                shooter_player.sm5_sigma += (general_out[0][0].sigma - shooter_player.sm5_sigma) * weight_sigma
+    winner_exp = math.exp(winner_mu / c)
+    loser_exp = math.exp(loser_mu / c)
+    winner_share = winner_exp / (winner_exp + loser_exp)
+    loser_share = loser_exp / (winner_exp + loser_exp)
 
-                # update role ratings with weights
+    winner_omega = (0.0 + (1 - winner_share)) * (winner_sigma_squared / c)
+    winner_delta = (0.0 + winner_share * (1 - winner_share)) * (winner_sigma_squared / c ** 2)
+    winner_delta *= math.sqrt(winner_sigma_squared) / c
 
-                shooter_role_weight_mu, shooter_role_weight_sigma = SM5_ROLE_WEIGHT_MULTIPLIERS[shooter.role]
+    loser_omega = (0.0 - loser_share) * (loser_sigma_squared / c)
+    loser_delta = (0.0 + loser_share * (1 - loser_share)) * (loser_sigma_squared / c ** 2)
+    loser_delta *= math.sqrt(loser_sigma_squared) / c
 
-                setattr(shooter_player, f"{str(shooter.role).lower()}_mu", getattr(shooter_player, f"{str(shooter.role).lower()}_mu") + (role_out[0][0].mu - getattr(shooter_player, f"{str(shooter.role).lower()}_mu")) * weight_mu * shooter_role_weight_mu)
-                setattr(shooter_player, f"{str(shooter.role).lower()}_sigma", getattr(shooter_player, f"{str(shooter.role).lower()}_sigma") + (role_out[0][0].sigma - getattr(shooter_player, f"{str(shooter.role).lower()}_sigma")) * weight_sigma * shooter_role_weight_sigma)
+    return (
+        winner_mu + (winner_sigma ** 2 / winner_sigma_squared) * winner_omega,
+        winner_sigma * math.sqrt(max(1 - (winner_sigma ** 2 / winner_sigma_squared) * winner_delta, config.kappa)),
+        loser_mu + (loser_sigma ** 2 / loser_sigma_squared) * loser_omega,
+        loser_sigma * math.sqrt(max(1 - (loser_sigma ** 2 / loser_sigma_squared) * loser_delta, config.kappa)),
+    )
 
-                if target.role == IntRole.MEDIC:
-                    # don't penalize medics extra just for being medic
-                    # (give people hitting medics more ranking, but don't give medics less ranking because it's a medic hit)
-                    weight_mu = SM5_HIT_WEIGHT_MU
-                    weight_sigma = SM5_HIT_WEIGHT_SIGMA
 
-                # update general ratings with weights
-                target_player.sm5_mu += (general_out[1][0].mu - target_player.sm5_mu) * weight_mu
-                target_player.sm5_sigma += (general_out[1][0].sigma - target_player.sm5_sigma) * weight_sigma
+def rate_against_self(mu: float, sigma: float, config: RatingConfig = DEFAULT_CONFIG) -> Tuple[float, float]:
+    """
+    Same as rating = Rating(mu, sigma); config.model.rate([[rating], [rating]], ranks=[0, 1])[0][0], which is how goals are rated.
 
-                # update role ratings with weights
+    rate() changes the ratings it's given, so the one rating gets tau added twice and is updated as the winner
+    and then again as the loser
+    """
+    tau_squared = config.tau * config.tau
+    beta_squared = config.beta ** 2
 
-                target_role_weight_mu, target_role_weight_sigma = SM5_ROLE_WEIGHT_MULTIPLIERS[target.role]
+    sigma = math.sqrt(sigma * sigma + tau_squared)
+    sigma = math.sqrt(sigma * sigma + tau_squared)
+    sigma_squared = sigma ** 2
 
-                setattr(target_player, f"{str(target.role).lower()}_mu", getattr(target_player, f"{str(target.role).lower()}_mu") + (role_out[1][0].mu - getattr(target_player, f"{str(target.role).lower()}_mu")) * weight_mu * target_role_weight_mu)
-                setattr(target_player, f"{str(target.role).lower()}_sigma", getattr(target_player, f"{str(target.role).lower()}_sigma") + (role_out[1][0].sigma - getattr(target_player, f"{str(target.role).lower()}_sigma")) * weight_sigma * target_role_weight_sigma)
+    c = math.sqrt(0.0 + (sigma_squared + beta_squared) + (sigma_squared + beta_squared))
 
-                await shooter_player.save()
-                await target_player.save()
+    exp = math.exp(mu / c)
+    share = exp / (exp + exp)
 
-            case EventType.MISSILE_DAMAGE_OPPONENT | EventType.MISSILE_DOWN_OPPONENT:
-                shooter = await userhelper.player_from_token(game, event.arguments[0])
-                shooter_player = await Player.filter(entity_id=shooter.entity_id).first()
-                shooter_elo = shooter_player.sm5_rating
-                shooter_elo_role = shooter_player.get_role_rating(shooter.role)
+    winner_omega = (0.0 + (1 - share)) * (sigma_squared / c)
+    winner_delta = (0.0 + share * (1 - share)) * (sigma_squared / c ** 2)
+    winner_delta *= math.sqrt(sigma_squared) / c
 
-                target = await userhelper.player_from_token(game, event.arguments[2])
-                target_player = await Player.filter(entity_id=target.entity_id).first()
-                target_elo = target_player.sm5_rating
-                target_elo_role = target_player.get_role_rating(target.role)
+    loser_omega = (0.0 - share) * (sigma_squared / c)
+    loser_delta = (0.0 + share * (1 - share)) * (sigma_squared / c ** 2)
+    loser_delta *= math.sqrt(sigma_squared) / c
 
-                general_out = model.rate([[shooter_elo], [target_elo]], ranks=[0, 1])
-                role_out = model.rate([[shooter_elo_role], [target_elo_role]], ranks=[0, 1])
+    mu += (sigma ** 2 / sigma_squared) * winner_omega
+    sigma *= math.sqrt(max(1 - (sigma ** 2 / sigma_squared) * winner_delta, config.kappa))
 
-                weight_mu = SM5_MISSILE_WEIGHT_MU # default for missiles
-                weight_sigma = SM5_MISSILE_WEIGHT_SIGMA
-                if target.role == IntRole.MEDIC:
-                    weight_mu = SM5_MISSILE_MEDIC_WEIGHT_MU # give more weight to medic missiles
-                    weight_sigma = SM5_MISSILE_MEDIC_WEIGHT_SIGMA
+    mu += (sigma ** 2 / sigma_squared) * loser_omega
+    sigma *= math.sqrt(max(1 - (sigma ** 2 / sigma_squared) * loser_delta, config.kappa))
 
-                # update general ratings with weights
-                shooter_player.sm5_mu += (general_out[0][0].mu - shooter_player.sm5_mu) * weight_mu
-                shooter_player.sm5_sigma += (general_out[0][0].sigma - shooter_player.sm5_sigma) * weight_sigma
+    return mu, sigma
 
-                # update role ratings with weights
 
-                shooter_role_weight_mu, shooter_role_weight_sigma = SM5_ROLE_WEIGHT_MULTIPLIERS[shooter.role]
+def rate_1v1_events(mu: MutableSequence[float], sigma: MutableSequence[float],
+                    events: Iterable[Tuple[int, int, float, float, float, float]],
+                    config: RatingConfig = DEFAULT_CONFIG, scale_mu: Optional[Sequence[float]] = None,
+                    scale_sigma: Optional[Sequence[float]] = None) -> None:
+    """
+    Applies a sequence of one on one events, in order, to ratings stored by slot (lists, arrays, ...).
 
-                setattr(shooter_player, f"{str(shooter.role).lower()}_mu", getattr(shooter_player, f"{str(shooter.role).lower()}_mu") + (role_out[0][0].mu - getattr(shooter_player, f"{str(shooter.role).lower()}_mu")) * weight_mu * shooter_role_weight_mu)
-                setattr(shooter_player, f"{str(shooter.role).lower()}_sigma", getattr(shooter_player, f"{str(shooter.role).lower()}_sigma") + (role_out[0][0].sigma - getattr(shooter_player, f"{str(shooter.role).lower()}_sigma")) * weight_sigma * shooter_role_weight_sigma)
+    events: (winner slot, loser slot, winner weight mu, winner weight sigma, loser weight mu, loser weight sigma),
+    each rating is moved towards the result of rate_1v1() by its weight times the scale of its slot (1 if not given),
+    see sm5_hit_events(). An event with the same slot as winner and loser (a laserball goal) rates it against itself
+    like rate_against_self(), by the winner weights.
 
-                if target.role == IntRole.MEDIC:
-                    # don't penalize medics extra just for being medic
-                    weight_mu = SM5_MISSILE_WEIGHT_MU
-                    weight_sigma = SM5_MISSILE_WEIGHT_SIGMA
+    Every event depends on the ratings the ones before it left, so they're applied one after the other.
+    """
+    if scale_mu is None:
+        scale_mu = [1.0] * len(mu)
+    if scale_sigma is None:
+        scale_sigma = [1.0] * len(sigma)
+
+    for winner, loser, winner_weight_mu, winner_weight_sigma, loser_weight_mu, loser_weight_sigma in events:
+        if winner == loser:
+            winner_mu, winner_sigma = rate_against_self(mu[winner], sigma[winner], config)
+        else:
+            winner_mu, winner_sigma, loser_mu, loser_sigma = rate_1v1(mu[winner], sigma[winner],
+                                                                      mu[loser], sigma[loser], config)
 
-                # update general ratings with weights
-                target_player.sm5_mu += (general_out[1][0].mu - target_player.sm5_mu) * weight_mu
-                target_player.sm5_sigma += (general_out[1][0].sigma - target_player.sm5_sigma) * weight_sigma
+            mu[loser] += (loser_mu - mu[loser]) * loser_weight_mu * scale_mu[loser]
+            sigma[loser] += (loser_sigma - sigma[loser]) * loser_weight_sigma * scale_sigma[loser]
 
-                # update role ratings with weights
+        mu[winner] += (winner_mu - mu[winner]) * winner_weight_mu * scale_mu[winner]
+        sigma[winner] += (winner_sigma - sigma[winner]) * winner_weight_sigma * scale_sigma[winner]
 
-                target_role_weight_mu, target_role_weight_sigma = SM5_ROLE_WEIGHT_MULTIPLIERS[target.role]
 
-                setattr(target_player, f"{str(target.role).lower()}_mu", getattr(target_player, f"{str(target.role).lower()}_mu") + (role_out[1][0].mu - getattr(target_player, f"{str(target.role).lower()}_mu")) * weight_mu * target_role_weight_mu)
-                setattr(target_player, f"{str(target.role).lower()}_sigma", getattr(target_player, f"{str(target.role).lower()}_sigma") + (role_out[1][0].sigma - getattr(target_player, f"{str(target.role).lower()}_sigma")) * weight_sigma * target_role_weight_sigma)
+# sm5 elo helper functions
 
-                await shooter_player.save()
-                await target_player.save()
+# the rating math below only touches Player objects in memory, it's shared by the per game updates and the replay
+# in recalculate_sm5_ratings()/recalculate_laserball_ratings() so both always give the same result
 
-    # rate game
+SM5_HIT_EVENTS = [EventType.DAMAGED_OPPONENT, EventType.DOWNED_OPPONENT]
+SM5_MISSILE_EVENTS = [EventType.MISSILE_DAMAGE_OPPONENT, EventType.MISSILE_DOWN_OPPONENT]
+SM5_RATING_EVENTS = SM5_HIT_EVENTS + SM5_MISSILE_EVENTS + [EventType.RESUPPLY_LIVES, EventType.RESUPPLY_AMMO]
 
-    team1 = []
-    team2 = []
+LASERBALL_RATING_EVENTS = [EventType.STEAL, EventType.GOAL, EventType.ASSIST]
 
-    teams = await game.get_teams()
 
-    for player in await game.entity_starts.filter(type="player"):
-        team_color = (await player.team).color_name
-        if team_color == (teams[0].color_name):
-            team1.append(await Player.filter(entity_id=player.entity_id).first())
-        else:
-            team2.append(await Player.filter(entity_id=player.entity_id).first())
+# in slot arrays, a player has SM5_SLOTS consecutive slots: their general rating first, then the rating of each role
+# at its IntRole value, in the order of SM5_RATING_FIELDS
+SM5_SLOTS = 1 + len(SM5_ROLE_WEIGHT_MULTIPLIERS)
 
-    team1_elo = list(map(lambda x: Rating(x.sm5_mu, x.sm5_sigma), team1))
-    team2_elo = list(map(lambda x: Rating(x.sm5_mu, x.sm5_sigma), team2))
 
-    if game.winner == teams[0].enum:
-        team1_new, team2_new = model.rate([team1_elo, team2_elo], ranks=[0, 1])
-    else:
-        team1_new, team2_new = model.rate([team1_elo, team2_elo], ranks=[1, 0])
+def sm5_hit_events(missile: bool, shooter: int, shooter_role: IntRole, target: int, target_role: IntRole,
+                   config: RatingConfig = DEFAULT_CONFIG) -> Tuple[Tuple[int, int, float, float, float, float], ...]:
+    """
+    The events of rate_1v1_events() for a damage, down or missile event, between the general ratings and between the
+    role ratings of the players whose first slots are `shooter` and `target`
 
-    for player, rating in zip(team1, team1_new):
-        player.sm5_mu = rating.mu
-        player.sm5_sigma = rating.sigma
-        await player.save()
+    The role ratings move by the role weight multipliers on top, see sm5_weight_scales()
+    """
+    if missile:
+        weight_mu = config.sm5_missile_weight_mu # default for missiles
+        weight_sigma = config.sm5_missile_weight_sigma
+        shooter_weight_mu = config.sm5_missile_medic_weight_mu # give more weight to medic missiles
+        shooter_weight_sigma = config.sm5_missile_medic_weight_sigma
+    else:
+        weight_mu = config.sm5_hit_weight_mu # default for damage and downed events
+        weight_sigma = config.sm5_hit_weight_sigma
+        shooter_weight_mu = config.sm5_hit_medic_weight_mu # give more weight to medic hits
+        shooter_weight_sigma = config.sm5_hit_medic_weight_sigma
 
-    for player, rating in zip(team2, team2_new):
-        player.sm5_mu = rating.mu
-        player.sm5_sigma = rating.sigma
-        await player.save()
+    if target_role != IntRole.MEDIC:
+        shooter_weight_mu = weight_mu
+        shooter_weight_sigma = weight_sigma
 
-    # need to update current rating and for each entity end object
+    # don't penalize medics extra just for being medic
+    # (give people hitting medics more ranking, but don't give medics less ranking because it's a medic hit)
+    return (
+        (shooter, target, shooter_weight_mu, shooter_weight_sigma, weight_mu, weight_sigma),
+        (shooter + shooter_role, target + target_role, shooter_weight_mu, shooter_weight_sigma, weight_mu, weight_sigma),
+    )
 
-    for entity_end in await game.entity_ends.filter(entity__type="player"):
-        entity_start = await entity_end.entity
-        player = await Player.filter(entity_id=entity_start.entity_id).first()
 
-        entity_end.current_rating_mu = player.sm5_mu
-        entity_end.current_rating_sigma = player.sm5_sigma
-        entity_end.current_role_rating_mu = player.get_role_rating(entity_start.role).mu
-        entity_end.current_role_rating_sigma = player.get_role_rating(entity_start.role).sigma
-        await entity_end.save()
+def sm5_weight_scales(player_count: int, config: RatingConfig = DEFAULT_CONFIG) -> Tuple[List[float], List[float]]:
+    """
+    The scales of rate_1v1_events() for `player_count` players in sm5 slots, 1 for the general ratings and the role
+    weight multipliers for the role ratings
+    """
+    scale_mu = [1.0] * SM5_SLOTS
+    scale_sigma = [1.0] * SM5_SLOTS
+    for role, (role_weight_mu, role_weight_sigma) in config.sm5_role_weight_multipliers.items():
+        scale_mu[role] = role_weight_mu
+        scale_sigma[role] = role_weight_sigma
 
-    return True
+    return scale_mu * player_count, scale_sigma * player_count
 
 
-async def update_laserball_ratings(game: LaserballGame) -> bool:
+def load_sm5_slots(players: List[Player]) -> Tuple[List[float], List[float]]:
     """
-    Updates the laserball ratings for a game
-    it first calculates the individual player ratings
-    then it calculates the team ratings
-    then it updates the player ratings through openskill
+    The sm5 ratings (mu, sigma) of `players` in slot arrays, the first slot of players[i] is i * SM5_SLOTS
 
-    returns: True if successful, False if not
-    it could return False if the game is not ranked
+    Only the rating fields of the players are used, so anything with sm5_mu, sm5_sigma, commander_mu, ... works
     """
+    mu = []
+    sigma = []
+    for player in players:
+        for i in range(0, len(SM5_RATING_FIELDS), 2):
+            mu.append(getattr(player, SM5_RATING_FIELDS[i]))
+            sigma.append(getattr(player, SM5_RATING_FIELDS[i + 1]))
 
-    if not game.ranked:
-        return False
+    return mu, sigma
 
-    # need to update current rating and for each entity end object
 
-    for entity_end in await game.entity_ends.filter(entity__type="player"):
-        player = await Player.filter(entity_id=(await entity_end.entity).entity_id).first()
-        entity_end.previous_rating_mu = player.laserball_mu
-        entity_end.previous_rating_sigma = player.laserball_sigma
-        await entity_end.save()
+def store_sm5_slots(players: List[Player], mu: Sequence[float], sigma: Sequence[float]) -> None:
+    """
+    Sets the sm5 ratings of `players` from slot arrays made by load_sm5_slots()
+    """
+    for index, player in enumerate(players):
+        for i in range(0, len(SM5_RATING_FIELDS), 2):
+            slot = index * SM5_SLOTS + i // 2
+            setattr(player, SM5_RATING_FIELDS[i], mu[slot])
+            setattr(player, SM5_RATING_FIELDS[i + 1], sigma[slot])
 
-    # go through all events for each game
 
-    events: List[Events] = await game.events.filter(type__in=
-                                                    [EventType.STEAL, EventType.GOAL, EventType.ASSIST]
-                                                    ).order_by("time").all()  # only get the events that we need
+def rate_teams(team1: List[Player], team2: List[Player], team1_won: bool, mode: GameType = GameType.SM5,
+               config: RatingConfig = DEFAULT_CONFIG) -> None:
+    """
+    Rates the outcome of a game, team1 and team2 can contain the same player more than once
+    in which case the last rating wins
+    """
 
-    for event in events:
-        if "@" in event.arguments[0] or (len(event.arguments) > 3) and "@" in event.arguments[2]:
-            continue
-        match event.type:
-            # laserball events (steals, goals, assists)
-            # NOTE: assist event was not implemented until 2/26/24 (the tdf does not include a ASSIST event, so i have to make it myself)
-            case EventType.STEAL:
-                stealer = await userhelper.player_from_token(game, event.arguments[0])
-                stealer_player = await Player.filter(entity_id=stealer.entity_id).first()
-                stealer_elo = Rating(stealer_player.laserball_mu, stealer_player.laserball_sigma)
+    mode = mode.value
 
-                stolen = await userhelper.player_from_token(game, event.arguments[2])
-                stolen_player = await Player.filter(entity_id=stolen.entity_id).first()
-                stolen_elo = Rating(stolen_player.laserball_mu, stolen_player.laserball_sigma)
+    team1_elo = list(map(lambda x: Rating(getattr(x, f"{mode}_mu"), getattr(x, f"{mode}_sigma")), team1))
+    team2_elo = list(map(lambda x: Rating(getattr(x, f"{mode}_mu"), getattr(x, f"{mode}_sigma")), team2))
 
-                out = model.rate([[stealer_elo], [stolen_elo]], ranks=[0, 1])
+    for player, rating in zip(team1 + team2, _rate_team_ratings(team1_elo, team2_elo, team1_won, config)):
+        setattr(player, f"{mode}_mu", rating.mu)
+        setattr(player, f"{mode}_sigma", rating.sigma)
 
-                stealer_player.laserball_mu += (out[0][0].mu - stealer_player.laserball_mu) * LB_STEAL_WEIGHT_MU
-                stealer_player.laserball_sigma += (out[0][0].sigma - stealer_player.laserball_sigma) * LB_STEAL_WEIGHT_SIGMA
 
-                stolen_player.laserball_mu += (out[1][0].mu - stolen_player.laserball_mu) * LB_STEAL_WEIGHT_MU
-                stolen_player.laserball_sigma += (out[1][0].sigma - stolen_player.laserball_sigma) * LB_STEAL_WEIGHT_SIGMA
+def rate_team_slots(mu: MutableSequence[float], sigma: MutableSequence[float], team1: List[int], team2: List[int],
+                    team1_won: bool, config: RatingConfig = DEFAULT_CONFIG) -> None:
+    """
+    rate_teams() for ratings stored by slot, team1 and team2 are slots
+    """
+    team1_elo = [Rating(mu[slot], sigma[slot]) for slot in team1]
+    team2_elo = [Rating(mu[slot], sigma[slot]) for slot in team2]
 
-                await stealer_player.save()
-                await stolen_player.save()
-            case EventType.GOAL:
-                scorer = await userhelper.player_from_token(game, event.arguments[0])
-                scorer_player = await Player.filter(entity_id=scorer.entity_id).first()
-                scorer_elo = Rating(scorer_player.laserball_mu, scorer_player.laserball_sigma)
+    for slot, rating in zip(team1 + team2, _rate_team_ratings(team1_elo, team2_elo, team1_won, config)):
+        mu[slot] = rating.mu
+        sigma[slot] = rating.sigma
 
-                out = model.rate([[scorer_elo], [scorer_elo]], ranks=[0, 1])
 
-                scorer_player.laserball_mu += (out[0][0].mu - scorer_player.laserball_mu) * LB_GOAL_WEIGHT_MU
-                scorer_player.laserball_sigma += (out[0][0].sigma - scorer_player.laserball_sigma) * LB_GOAL_WEIGHT_SIGMA
+def _rate_team_ratings(team1: List[Rating], team2: List[Rating], team1_won: bool,
+                       config: RatingConfig) -> List[Rating]:
+    if team1_won:
+        team1_new, team2_new = config.model.rate([team1, team2], ranks=[0, 1])
+    else:
+        team1_new, team2_new = config.model.rate([team1, team2], ranks=[1, 0])
 
-                await scorer_player.save()
-            case EventType.ASSIST:
-                assister = await userhelper.player_from_token(game, event.arguments[0])
-                assister_player = await Player.filter(entity_id=assister.entity_id).first()
-                assister_elo = Rating(assister_player.laserball_mu, assister_player.laserball_sigma)
+    return team1_new + team2_new
 
-                scorer = await userhelper.player_from_token(game, event.arguments[2])
-                scorer_player = await Player.filter(entity_id=scorer.entity_id).first()
-                scorer_elo = Rating(scorer_player.laserball_mu, scorer_player.laserball_sigma)
 
-                out = model.rate([[assister_elo], [scorer_elo]], ranks=[0, 1])
+async def update_sm5_ratings(game: SM5Game, invalidate_cache: bool = True) -> bool:
+    """
+    Updates the sm5 ratings for a game
+    it first calculates the individual player ratings
+    then it calculates the team ratings
+    then it updates the player ratings through openskill
 
-                assister_player.laserball_mu += (out[0][0].mu - assister_player.laserball_mu) * LB_ASSIST_WEIGHT_MU
-                assister_player.laserball_sigma += (out[0][0].sigma - assister_player.laserball_sigma) * LB_ASSIST_WEIGHT_SIGMA
+    The entities and players of the game are loaded once and the ratings are updated in memory,
+    each player is saved once at the end
 
-    # rate game
+    With invalidate_cache=False nothing cached is dropped, for dry runs that are rolled back
 
-    team1 = []
-    team2 = []
+    returns: True if successful, False if not
+    it could return False if the game is not ranked
+    """
+    if not game.ranked:
+        return False
 
-    teams = await game.get_teams()
+    await _rate_game(game, GameType.SM5, invalidate_cache)
 
-    for player in await game.entity_starts.filter(type="player"):
-        if (await player.team).color_name == (teams[0].color_name):
-            team1.append(await Player.filter(entity_id=player.entity_id).first())
-        else:
-            team2.append(await Player.filter(entity_id=player.entity_id).first())
+    return True
 
-    team1_elo = list(map(lambda x: Rating(x.laserball_mu, x.laserball_sigma), team1))
-    team2_elo = list(map(lambda x: Rating(x.laserball_mu, x.laserball_sigma), team2))
 
-    if game.winner == teams[0].enum:
-        team1_new, team2_new = model.rate([team1_elo, team2_elo], ranks=[0, 1])
-    else:
-        team1_new, team2_new = model.rate([team1_elo, team2_elo], ranks=[1, 0])
+async def update_laserball_ratings(game: LaserballGame, invalidate_cache: bool = True) -> bool:
+    """
+    Updates the laserball ratings for a game
+    it first calculates the individual player ratings
+    then it calculates the team ratings
+    then it updates the player ratings through openskill
 
-    for player, rating in zip(team1, team1_new):
-        player.laserball_mu = rating.mu
-        player.laserball_sigma = rating.sigma
-        await player.save()
+    The entities and players of the game are loaded once and the ratings are updated in memory,
+    each player is saved once at the end
 
-    for player, rating in zip(team2, team2_new):
-        player.laserball_mu = rating.mu
-        player.laserball_sigma = rating.sigma
-        await player.save()
+    With invalidate_cache=False nothing cached is dropped, for dry runs that are rolled back
 
-    # need to update current rating and for each entity end object
+    returns: True if successful, False if not
+    it could return False if the game is not ranked
+    """
 
-    for entity_end in await game.entity_ends.filter(entity__type="player"):
-        player = await Player.filter(entity_id=(await entity_end.entity).entity_id).first()
-        entity_end.current_rating_mu = player.laserball_mu
-        entity_end.current_rating_sigma = player.laserball_sigma
-        await entity_end.save()
+    if not game.ranked:
+        return False
+
+    await _rate_game(game, GameType.LASERBALL, invalidate_cache)
 
     return True
 
@@ -918,11 +952,484 @@ def get_draw_chance(team1, team2, mode: GameType = GameType.SM5) -> float:
     return model.predict_draw([team1, team2])
 
 
-async def recalculate_sm5_ratings(*, _sample_size: int=99999) -> None:
+# replaying the whole history, used by recalculate_sm5_ratings() and recalculate_laserball_ratings()
+
+_REPLAY_BATCH_SIZE = 200  # games loaded per round of queries
+_WRITE_BATCH_SIZE = 1000  # rows written per bulk_update query
+
+SM5_RATING_FIELDS = ["sm5_mu", "sm5_sigma"] + [
+    f"{str(role).lower()}_{value}" for role in IntRole if role != IntRole.OTHER for value in ("mu", "sigma")
+]
+LASERBALL_RATING_FIELDS = ["laserball_mu", "laserball_sigma"]
+
+
+@dataclass
+class ReplayGame:
+    """
+    Everything the replay needs to know about a game, loaded for a whole batch of games at once
+    """
+    game: Union[SM5Game, LaserballGame]
+    teams: List[dict] = field(default_factory=list)  # ordered by id, without the neutral teams
+    entity_starts: Dict[int, dict] = field(default_factory=dict)  # key: EntityStarts id, ordered by id
+    entity_ends: List[EntityEnds] = field(default_factory=list)  # player entity ends only
+    events: List[dict] = field(default_factory=list)  # ordered by time
+
+    def player_for(self, players: Dict[str, Player], entity_end: EntityEnds) -> Optional[Player]:
+        return players.get(self.entity_starts[entity_end.entity_id]["entity_id"])
+
+    def get_teams(self, players: Dict[str, Player]) -> Tuple[List[Player], List[Player]]:
+        """
+        Splits the players into the first team and everyone else
+        """
+        team1 = []
+        team2 = []
+
+        for entity_start in self.entity_starts.values():
+            if entity_start["type"] != "player":
+                continue
+            if entity_start["team__color_name"] == self.teams[0]["color_name"]:
+                team1.append(players[entity_start["entity_id"]])
+            else:
+                team2.append(players[entity_start["entity_id"]])
+
+        return team1, team2
+
+    @property
+    def player_entity_ids(self) -> Set[str]:
+        return {entity_start["entity_id"] for entity_start in self.entity_starts.values()
+                if entity_start["type"] == "player"}
+
+    @property
+    def team1_won(self) -> bool:
+        return self.game.winner == NAME_TO_TEAM[self.teams[0]["color_name"]]
+
+    @property
+    def tokens(self) -> Dict[str, dict]:
+        """
+        The entity start each token resolves to, the first one with the token as entity_id
+        """
+        tokens = {}
+        for entity_start in self.entity_starts.values():
+            tokens.setdefault(entity_start["entity_id"], entity_start)
+        return tokens
+
+
+async def load_replay_games(games: List[Union[SM5Game, LaserballGame]], related_name: str,
+                            event_types: List[EventType]) -> List[ReplayGame]:
+    """
+    Loads the teams, entity starts, player entity ends and rating events of `games` with one query each
+    """
+    replays = {game.id: ReplayGame(game) for game in games}
+    game_filter = {f"{related_name}__id__in": list(replays)}
+    game_key = f"{related_name}__id"
+
+    for team in await Teams.filter(**game_filter).order_by("id").values("id", "name", "color_name", game_key):
+        if team["name"] not in ["Neutral", "None"]:
+            replays[team[game_key]].teams.append(team)
+
+    for entity_start in await EntityStarts.filter(**game_filter).order_by("id").values(
+            "id", "entity_id", "type", "role", "team__color_name", game_key):
+        replays[entity_start[game_key]].entity_starts[entity_start["id"]] = entity_start
+
+    entity_end_games = dict(await EntityEnds.filter(**game_filter, entity__type="player").values_list("id", game_key))
+    for entity_end in await EntityEnds.filter(id__in=list(entity_end_games)).order_by("id"):
+        replays[entity_end_games[entity_end.id]].entity_ends.append(entity_end)
+
+    for event in await Events.filter(**game_filter, type__in=event_types).order_by("time", "id").values(
+            "type", "arguments", game_key):
+        replays[event[game_key]].events.append(event)
+
+    return list(replays.values())
+
+
+def _replay_sm5_game(replay: ReplayGame, players: Dict[str, Player], config: RatingConfig = DEFAULT_CONFIG) -> None:
+    """
+    Rates a game on the players in memory, or for an unranked game records the ratings it was played with
+    """
+    if not replay.game.ranked:  # still need to add current_rating and previous_rating
+        for entity_end in replay.entity_ends:
+            player = replay.player_for(players, entity_end)
+            if not player or not player.entity_id.startswith("#"):
+                continue
+
+            entity_end.previous_rating_mu = player.sm5_mu
+            entity_end.previous_rating_sigma = player.sm5_sigma
+            entity_end.current_rating_mu = player.sm5_mu
+            entity_end.current_rating_sigma = player.sm5_sigma
+        return
+
+    for entity_end in replay.entity_ends:
+        if replay.entity_starts[entity_end.entity_id]["entity_id"].startswith("#"):
+            player = replay.player_for(players, entity_end)
+            entity_end.previous_rating_mu = player.sm5_mu
+            entity_end.previous_rating_sigma = player.sm5_sigma
+
+    tokens = replay.tokens
+
+    # the players with events get sm5 slots in the order they're first seen
+    rated_players: List[Player] = []
+    first_slots: Dict[str, int] = {}
+    events = []
+
+    def first_slot(entity_id: str) -> int:
+        if entity_id not in first_slots:
+            first_slots[entity_id] = len(rated_players) * SM5_SLOTS
+            rated_players.append(players[entity_id])
+        return first_slots[entity_id]
+
+    for event in replay.events:
+        arguments = event["arguments"]
+        if "@" in arguments[0] or "@" in arguments[2]:
+            continue
+        if event["type"] in SM5_HIT_EVENTS or event["type"] in SM5_MISSILE_EVENTS:
+            shooter = tokens[arguments[0]]
+            target = tokens[arguments[2]]
+
+            events.extend(sm5_hit_events(event["type"] in SM5_MISSILE_EVENTS,
+                                         first_slot(shooter["entity_id"]), shooter["role"],
+                                         first_slot(target["entity_id"]), target["role"], config))
+
+    if events:
+        mu, sigma = load_sm5_slots(rated_players)
+        rate_1v1_events(mu, sigma, events, config, *sm5_weight_scales(len(rated_players), config))
+        store_sm5_slots(rated_players, mu, sigma)
+
+    team1, team2 = replay.get_teams(players)
+    rate_teams(team1, team2, replay.team1_won, GameType.SM5, config)
+
+    for entity_end in replay.entity_ends:
+        player = replay.player_for(players, entity_end)
+        role = replay.entity_starts[entity_end.entity_id]["role"]
+
+        entity_end.current_rating_mu = player.sm5_mu
+        entity_end.current_rating_sigma = player.sm5_sigma
+        entity_end.current_role_rating_mu = player.get_role_rating(role).mu
+        entity_end.current_role_rating_sigma = player.get_role_rating(role).sigma
+
+
+def _replay_laserball_game(replay: ReplayGame, players: Dict[str, Player],
+                           config: RatingConfig = DEFAULT_CONFIG) -> None:
+    """
+    Rates a game on the players in memory, or for an unranked game records the ratings it was played with
+    """
+    if not replay.game.ranked:
+        for entity_end in replay.entity_ends:
+            player = replay.player_for(players, entity_end)
+            if not player or not player.entity_id.startswith("#"):
+                continue
+
+            entity_end.previous_rating_mu = player.laserball_mu
+            entity_end.previous_rating_sigma = player.laserball_sigma
+            entity_end.current_rating_mu = player.laserball_mu
+            entity_end.current_rating_sigma = player.laserball_sigma
+        return
+
+    for entity_end in replay.entity_ends:
+        player = replay.player_for(players, entity_end)
+        entity_end.previous_rating_mu = player.laserball_mu
+        entity_end.previous_rating_sigma = player.laserball_sigma
+
+    tokens = replay.tokens
+
+    # the players with events get a slot each, in the order they're first seen
+    rated_players: List[Player] = []
+    slots: Dict[str, int] = {}
+    events = []
+
+    def slot(token: str) -> int:
+        entity_id = tokens[token]["entity_id"]
+        if entity_id not in slots:
+            slots[entity_id] = len(rated_players)
+            rated_players.append(players[entity_id])
+        return slots[entity_id]
+
+    for event in replay.events:
+        arguments = event["arguments"]
+        if "@" in arguments[0] or (len(arguments) > 3) and "@" in arguments[2]:
+            continue
+        match event["type"]:
+            case EventType.STEAL:
+                events.append((slot(arguments[0]), slot(arguments[2]), config.lb_steal_weight_mu,
+                               config.lb_steal_weight_sigma, config.lb_steal_weight_mu, config.lb_steal_weight_sigma))
+            case EventType.GOAL:
+                # rated against themselves
+                scorer = slot(arguments[0])
+                events.append((scorer, scorer, config.lb_goal_weight_mu, config.lb_goal_weight_sigma, 0, 0))
+            case EventType.ASSIST:
+                # assists have never been saved, the assister's rating was computed and then dropped, so they
+                # don't change any ratings. LB_ASSIST_WEIGHT_* are kept for when they're rated for real
+                pass
+
+    if events:
+        mu = [player.laserball_mu for player in rated_players]
+        sigma = [player.laserball_sigma for player in rated_players]
+        rate_1v1_events(mu, sigma, events, config)
+        for player, player_mu, player_sigma in zip(rated_players, mu, sigma):
+            player.laserball_mu = player_mu
+            player.laserball_sigma = player_sigma
+
+    team1, team2 = replay.get_teams(players)
+    rate_teams(team1, team2, replay.team1_won, GameType.LASERBALL, config)
+
+    for entity_end in replay.entity_ends:
+        player = replay.player_for(players, entity_end)
+        entity_end.current_rating_mu = player.laserball_mu
+        entity_end.current_rating_sigma = player.laserball_sigma
+
+
+@dataclass(frozen=True)
+class _ReplayMode:
+    game_model: type
+    related_name: str  # of the many-to-many fields of the game model
+    event_types: List[EventType]
+    replay_game: Callable[[ReplayGame, Dict[str, Player], RatingConfig], None]
+    player_fields: List[str]
+    entity_end_fields: List[str]
+
+
+_REPLAY_MODES = {
+    GameType.SM5: _ReplayMode(SM5Game, "sm5games", SM5_RATING_EVENTS, _replay_sm5_game, SM5_RATING_FIELDS,
+                              ["previous_rating_mu", "previous_rating_sigma", "current_rating_mu",
+                               "current_rating_sigma", "current_role_rating_mu", "current_role_rating_sigma"]),
+    GameType.LASERBALL: _ReplayMode(LaserballGame, "laserballgames", LASERBALL_RATING_EVENTS, _replay_laserball_game,
+                                    LASERBALL_RATING_FIELDS, ["previous_rating_mu", "previous_rating_sigma",
+                                                              "current_rating_mu", "current_rating_sigma"]),
+}
+
+
+async def _load_players(entity_ids: Iterable[str], players: Dict[str, Player]) -> List[Player]:
+    """
+    Adds the players with `entity_ids` that aren't in `players` yet, keyed by entity_id.
+    Like Player.filter(entity_id=...).first(), the first player with an entity_id wins.
+
+    returns: the players that were added
+    """
+    added = []
+
+    for player in await Player.filter(entity_id__in=list(set(entity_ids) - players.keys())).order_by("id"):
+        if player.entity_id not in players:
+            players[player.entity_id] = player
+            added.append(player)
+
+    return added
+
+
+async def _rate_game(game: Union[SM5Game, LaserballGame], mode: GameType, invalidate_cache: bool = True) -> None:
+    """
+    Rates a single ranked game with its entities and players loaded up front,
+    every player and entity end in it is written once at the end
+    """
+    settings = _REPLAY_MODES[mode]
+
+    replays = await load_replay_games([game], settings.related_name, settings.event_types)
+    players = {}
+    await _load_players(replays[0].player_entity_ids, players)
+
+    settings.replay_game(replays[0], players)
+
+    if replays[0].entity_ends:
+        await EntityEnds.bulk_update(replays[0].entity_ends, fields=settings.entity_end_fields)
+    if players:
+        await Player.bulk_update(list(players.values()), fields=settings.player_fields)
+
+    await game.mark_edited(invalidate_cache)
+
+
+async def _mark_edited(mode: GameType, game_ids: List[int], entity_ids: Iterable[str],
+                       invalidate_cache: bool = True) -> None:
+    """
+    What mark_edited() does, for many games at once
+    """
+    game_model = _REPLAY_MODES[mode].game_model
+
+    for i in range(0, len(game_ids), _WRITE_BATCH_SIZE):
+        await game_model.filter(id__in=game_ids[i:i + _WRITE_BATCH_SIZE]).update(edit_version=F("edit_version") + 1)
+
+    if invalidate_cache and cachehelper.function_cache_enabled and game_ids:
+        await cachehelper.invalidate(*[cachehelper.game_tag(mode.value, game_id) for game_id in game_ids],
+                                     *[cachehelper.entity_tag(entity_id) for entity_id in entity_ids])
+        await cachehelper.mark_stale(cachehelper.TAG_LEADERBOARD, cachehelper.TAG_STATS, cachehelper.TAG_GAMES)
+
+
+async def _replay_games(games: List[Union[SM5Game, LaserballGame]], mode: GameType,
+                        config: RatingConfig = DEFAULT_CONFIG) -> None:
+    """
+    Replays the rating updates of `games` (ordered by start time) in memory, keyed by entity_id,
+    and writes the ratings of the players and the entity ends back in bulk.
+
+    The players have to be reset before, the result is the same as calling update_*_ratings() for every ranked game.
+    """
+    settings = _REPLAY_MODES[mode]
+
+    players: Dict[str, Player] = {}
+    ranked_game_ids = []
+
+    for i in range(0, len(games), _REPLAY_BATCH_SIZE):
+        replays = await load_replay_games(games[i:i + _REPLAY_BATCH_SIZE], settings.related_name,
+                                          settings.event_types)
+        await _load_players(set().union(*[replay.player_entity_ids for replay in replays]), players)
+
+        for replay in replays:
+            settings.replay_game(replay, players, config)
+
+        entity_ends = [entity_end for replay in replays for entity_end in replay.entity_ends]
+        if entity_ends:
+            await EntityEnds.bulk_update(entity_ends, fields=settings.entity_end_fields, batch_size=_WRITE_BATCH_SIZE)
+
+        ranked_game_ids += [replay.game.id for replay in replays if replay.game.ranked]
+
+        logger.info(f"Replayed {min(i + _REPLAY_BATCH_SIZE, len(games))}/{len(games)} {mode.value} games")
+
+    if players:
+        await Player.bulk_update(list(players.values()), fields=settings.player_fields, batch_size=_WRITE_BATCH_SIZE)
+
+    await _mark_edited(mode, ranked_game_ids, players)
+
+
+# correcting the ratings after one game changed, without replaying everything
+
+def _after(start_time: datetime.datetime, game_id: int, inclusive: bool = True) -> Q:
+    """
+    The games that come after (start_time, game_id) in the order ratings are calculated in
+    """
+    if inclusive:
+        return Q(start_time__gt=start_time) | Q(start_time=start_time, id__gte=game_id)
+    return Q(start_time__gt=start_time) | Q(start_time=start_time, id__gt=game_id)
+
+
+async def _restore_players(mode: GameType, entity_ids: Iterable[str], start_time: datetime.datetime, game_id: int,
+                           players: Dict[str, Player]) -> None:
+    """
+    Adds the players with `entity_ids` to `players` with the ratings they had before the game at (start_time, game_id).
+
+    Those are the current ratings stored with the entity ends of their last game before it (for role ratings their
+    last game in that role), players without one start over.
+    """
+    settings = _REPLAY_MODES[mode]
+    game_key = settings.related_name
+
+    added = await _load_players(entity_ids, players)
+    if not added:
+        return
+
+    before = Q(**{f"{game_key}__start_time__lt": start_time}) | \
+        Q(**{f"{game_key}__start_time": start_time, f"{game_key}__id__lt": game_id})
+
+    checkpoints = await EntityEnds.filter(
+        before, entity__type="player", entity__entity_id__in=[player.entity_id for player in added],
+        current_rating_mu__isnull=False
+    ).values("entity__entity_id", "entity__role", "current_rating_mu", "current_rating_sigma",
+             "current_role_rating_mu", "current_role_rating_sigma", f"{game_key}__start_time", f"{game_key}__id")
+
+    ratings = {player.entity_id: {field: MU if field.endswith("_mu") else SIGMA for field in settings.player_fields}
+               for player in added}
+
+    # oldest first so the last game wins
+    for checkpoint in sorted(checkpoints, key=lambda x: (x[f"{game_key}__start_time"], x[f"{game_key}__id"])):
+        player_ratings = ratings[checkpoint["entity__entity_id"]]
+
+        player_ratings[f"{mode.value}_mu"] = checkpoint["current_rating_mu"]
+        player_ratings[f"{mode.value}_sigma"] = checkpoint["current_rating_sigma"]
+
+        role = checkpoint["entity__role"]
+        if mode == GameType.SM5 and role in SM5_ROLE_WEIGHT_MULTIPLIERS and \
+                checkpoint["current_role_rating_mu"] is not None:
+            player_ratings[f"{str(role).lower()}_mu"] = checkpoint["current_role_rating_mu"]
+            player_ratings[f"{str(role).lower()}_sigma"] = checkpoint["current_role_rating_sigma"]
+
+    for player in added:
+        for field_name, value in ratings[player.entity_id].items():
+            setattr(player, field_name, value)
+
+
+async def correct_ratings_from(mode: GameType, start_time: datetime.datetime, game_id: int,
+                               entity_ids: Iterable[str], invalidate_cache: bool = True) -> int:
+    """
+    Fixes the ratings after the game at (start_time, game_id) was ranked, unranked, deleted or imported
+    after newer games, without recalculating all of them.
+
+    The players in `entity_ids` start from the ratings stored with their last game before it. Every game from there on
+    with one of them in it is replayed in order, and the players of the replayed games are followed from then on too,
+    so only the part of the history that can have changed is replayed.
+
+    With invalidate_cache=False nothing cached is dropped, for dry runs that are rolled back
+
+    returns: the number of games replayed
+    """
+    settings = _REPLAY_MODES[mode]
+
+    affected = set(entity_ids)
+    players: Dict[str, Player] = {}  # everyone whose games are replayed, with their ratings as of the current game
+    loaded: Dict[int, ReplayGame] = {}
+    edited_game_ids = []
+    position = _after(start_time, game_id)
+
+    while affected:
+        # the next games with an affected player in them, has to be asked again whenever new players are affected
+        games = await settings.game_model.filter(
+            position, entity_starts__type="player", entity_starts__entity_id__in=list(affected)
+        ).distinct().order_by("start_time", "id").limit(_REPLAY_BATCH_SIZE).values_list("id", "start_time")
+
+        if not games:
+            break
+
+        new_games = await settings.game_model.filter(id__in=[id for id, _ in games if id not in loaded])
+        for replay in await load_replay_games(new_games, settings.related_name, settings.event_types):
+            loaded[replay.game.id] = replay
+
+        replayed = []
+
+        for id, game_start_time in games:
+            replay = loaded.pop(id)
+
+            await _restore_players(mode, replay.player_entity_ids, game_start_time, id, players)
+            settings.replay_game(replay, players)
+
+            replayed.append(replay)
+            position = _after(game_start_time, id, inclusive=False)
+
+            if not replay.player_entity_ids <= affected:
+                affected |= replay.player_entity_ids
+                break
+
+        entity_ends = [entity_end for replay in replayed for entity_end in replay.entity_ends]
+        if entity_ends:
+            await EntityEnds.bulk_update(entity_ends, fields=settings.entity_end_fields, batch_size=_WRITE_BATCH_SIZE)
+
+        edited_game_ids += [replay.game.id for replay in replayed]
+
+    # affected players that don't have any games left to replay (when a game was deleted)
+    await _restore_players(mode, affected, start_time, game_id, players)
+
+    if players:
+        await Player.bulk_update(list(players.values()), fields=settings.player_fields, batch_size=_WRITE_BATCH_SIZE)
+
+    await _mark_edited(mode, edited_game_ids, players, invalidate_cache)
+
+    logger.info(f"Corrected the ratings of {len(players)} players by replaying {len(edited_game_ids)} {mode.value} games")
+
+    return len(edited_game_ids)
+
+
+async def correct_ratings(game: Union[SM5Game, LaserballGame], invalidate_cache: bool = True) -> int:
+    """
+    Fixes the ratings after `game` was ranked, unranked or imported after newer games, see correct_ratings_from()
+
+    returns: the number of games replayed
+    """
+    entity_ids = await game.entity_starts.filter(type="player").values_list("entity_id", flat=True)
+
+    return await correct_ratings_from(GameType(game.short_type), game.start_time, game.id, entity_ids,
+                                      invalidate_cache)
+
+
+async def recalculate_sm5_ratings(*, config: RatingConfig = DEFAULT_CONFIG, _sample_size: int=99999) -> None:
     try:
         """
         Recalculates sm5 ratings
 
+        config: the rating model parameters to use, the defaults if not given
+
         _sample_size is for testing purposes only, it limits the number of games to recalculate
         """
 
@@ -930,7 +1437,7 @@ async def recalculate_sm5_ratings(*, _sample_size: int=99999) -> None:
 
         logger.info("Resetting sm5 general ratings")
 
-        await Player.all().update(sm5_mu=MU, sm5_sigma=SIGMA)
+        await Player.all().update(sm5_mu=config.mu, sm5_sigma=config.sigma)
 
         # reset per-role ratings
 
@@ -938,71 +1445,32 @@ async def recalculate_sm5_ratings(*, _sample_size: int=99999) -> None:
             if role == IntRole.OTHER:
                 continue
             logger.info(f"Resetting {str(role).lower()} ratings")
-            await Player.all().update(**{f"{str(role).lower()}_mu": MU, f"{str(role).lower()}_sigma": SIGMA})
-
-        # get all games and recalculate ratings
-
-        sm5_games = await SM5Game.all().order_by("start_time").limit(_sample_size)
-
-        for game in sm5_games:
-            if game.ranked:
-                logger.info(f"Updating player ranking for game {game.id}")
-
-                if await update_sm5_ratings(game):
-                    logger.info(f"Updated player rankings for game {game.id}")
-                else:
-                    logger.error(f"Failed to update player rankings for game {game.id}")
-            else:  # still need to add current_rating and previous_rating
-                for entity_end in await game.entity_ends.filter(entity__type="player", entity__entity_id__startswith="#"):
-                    entity_id = (await entity_end.entity).entity_id
-
-                    player = await Player.filter(entity_id=entity_id).first()
+            await Player.all().update(**{f"{str(role).lower()}_mu": config.mu, f"{str(role).lower()}_sigma": config.sigma})
 
-                    if not player:
-                        continue
+        # get all games and replay their ratings
 
-                    entity_end.previous_rating_mu = player.sm5_mu
-                    entity_end.previous_rating_sigma = player.sm5_sigma
-                    entity_end.current_rating_mu = player.sm5_mu
-                    entity_end.current_rating_sigma = player.sm5_sigma
+        sm5_games = await SM5Game.all().order_by("start_time", "id").limit(_sample_size)
 
-                    await entity_end.save()
+        await _replay_games(sm5_games, GameType.SM5, config)
     except Exception as e:
         logger.error(f"Error recalculating sm5 ratings: {e}")
         raise e
 
 
-async def recalculate_laserball_ratings(*, _sample_size: int=99999) -> None:
+async def recalculate_laserball_ratings(*, config: RatingConfig = DEFAULT_CONFIG, _sample_size: int=99999) -> None:
     """
     Recalculates laserball ratings
+
+    config: the rating model parameters to use, the defaults if not given
     """
 
     # reset laserball ratings
 
-    await Player.all().update(laserball_mu=MU, laserball_sigma=SIGMA)
-
-    lb_games = await LaserballGame.all().order_by("start_time").limit(_sample_size)
-
-    for game in lb_games:
-        if game.ranked:
-            logger.info(f"Updating player ranking for game {game.id}")
-
-            if await update_laserball_ratings(game):
-                logger.info(f"Updated player rankings for game {game.id}")
-            else:
-                logger.error(f"Failed to update player rankings for game {game.id}")
-        else:
-            for entity_end in await game.entity_ends.filter(entity__type="player", entity__entity_id__startswith="#"):
-                entity_id = (await entity_end.entity).entity_id
-
-                player = await Player.filter(entity_id=entity_id).first()
+    await Player.all().update(laserball_mu=config.mu, laserball_sigma=config.sigma)
 
-                entity_end.previous_rating_mu = player.laserball_mu
-                entity_end.previous_rating_sigma = player.laserball_sigma
-                entity_end.current_rating_mu = player.laserball_mu
-                entity_end.current_rating_sigma = player.laserball_sigma
+    lb_games = await LaserballGame.all().order_by("start_time", "id").limit(_sample_size)
 
-                await entity_end.save()
+    await _replay_games(lb_games, GameType.LASERBALL, config)
 
 
 async def recalculate_ratings() -> None:
@@ -17,7 +17,7 @@ from helpers.gamehelper import get_team_rosters, SM5_STATE_LABEL_MAP, SM5_STATE_
 from helpers.statshelper import PlayerCoreGameStats, get_player_state_distribution, get_sm5_score_components, \
     count_zaps, count_missiles, TeamCoreGameStats, get_sm5_player_alive_times, get_sm5_player_alive_labels, \
     get_player_state_distribution_pie_chart, get_sm5_player_alive_colors, TimeSeriesRawData, TimeSeriesDataPoint, \
-    NotableEvent, sort_notable_events
+    NotableEvent, sort_notable_events, get_game_summary
 
 # TODO: A lot of stuff from statshelper.py should be moved here. But let's do that separately to keep the commit size
 #  reasonable.
@@ -306,7 +306,10 @@ async def get_sm5_player_stats(game: SM5Game, main_player: Optional[EntityStarts
     teams = []
     all_players = {}
 
-    game_duration = await game.get_game_duration()
+    # computed when the game was imported, older games might not have one yet
+    summary = await get_game_summary(game)
+
+    game_duration = summary.duration if summary else await game.get_game_duration()
 
     team_rosters = await get_team_rosters(game.entity_starts, game.entity_ends)
     live_over_time_per_player = {}
@@ -350,12 +353,18 @@ async def get_sm5_player_stats(game: SM5Game, main_player: Optional[EntityStarts
                 # This player might have been kicked before the game was over. Don't include in the actual result.
                 continue
 
-            score_components = await get_sm5_score_components(game, stats, player.entity_start)
+            player_summary = summary.get_player(player.entity_start) if summary else None
+
+            if player_summary and "score_components" in player_summary:
+                score_components = player_summary["score_components"]
+                state_distribution = player_summary["state_distribution"]
+            else:
+                score_components = await get_sm5_score_components(game, stats, player.entity_start)
 
-            state_distribution = await get_player_state_distribution(player.entity_start, player.entity_end,
-                                                                     game.player_states,
-                                                                     game.events,
-                                                                     SM5_STATE_LABEL_MAP)
+                state_distribution = await get_player_state_distribution(player.entity_start, player.entity_end,
+                                                                         game.player_states,
+                                                                         game.events,
+                                                                         SM5_STATE_LABEL_MAP)
 
             zapped_main_player = None
             zapped_by_main_player = None
@@ -384,7 +393,7 @@ async def get_sm5_player_stats(game: SM5Game, main_player: Optional[EntityStarts
                                           " eliminated_player" if stats.lives_left == 0 else ""),
                 state_distribution=state_distribution,
                 score_components=score_components,
-                mvp_points=await stats.mvp_points(),
+                mvp_points=await stats.mvp_points(summary),
                 shots_fired=stats.shots_fired,
                 shots_hit=stats.shots_hit,
                 lives_over_time=lives_over_time,
@@ -489,12 +498,12 @@ async def get_sm5_player_stats(game: SM5Game, main_player: Optional[EntityStarts
         teams.append(
             TeamSm5GameStats(
                 team=team,
-                score=await game.get_team_score(team),
+                score=summary.get_team_score(team) if summary else await game.get_team_score(team),
                 score_adjustment=game.get_team_score_adjustment(team),
                 players=players,
                 sum_player=sum_player,
                 lives_over_time=lives_over_time_team_average,
-                doubles_percent=await game.get_team_doubles_percent(team)
+                doubles_percent=await game.get_team_doubles_percent(team, summary)
             )
         )
 
@@ -1,18 +1,19 @@
 from dataclasses import dataclass
 from datetime import datetime, timedelta
-from typing import List, Tuple, Optional, Callable, Any
+from typing import List, Tuple, Optional, Callable, Any, Union
 
 from sentry_sdk import Hub, start_transaction
 from tortoise.expressions import Q, F
 from tortoise.fields import ManyToManyRelation
 from tortoise.functions import Sum
 
-from db.game import EntityEnds, EntityStarts, PlayerInfo
+from db.game import EntityEnds, EntityStarts, PlayerInfo, GameSummary
 from db.laserball import LaserballGame, LaserballStats
 from db.sm5 import SM5Game, SM5Stats
 from db.types import IntRole, EventType, PlayerStateDetailType, PlayerStateType, PlayerStateEvent, Team, PieChartData
 from db.player import Player
 from helpers.cachehelper import cache, precache
+from helpers.gamehelper import get_team_rosters, SM5_STATE_LABEL_MAP
 
 # stats helpers
 
@@ -955,6 +956,56 @@ def get_player_state_distribution_pie_chart(distribution: dict[str, int],
     )
 
 
+# bump this when build_game_summary() changes, existing summaries are ignored until the backfill recomputes them
+GAME_SUMMARY_VERSION = 1
+
+
+async def build_game_summary(game: Union[SM5Game, LaserballGame]) -> GameSummary:
+    """Computes the values of a game that don't change after it's imported and saves them as its summary.
+
+    Called when a game is imported, and by the admin backfill for older games. Replaces the summary the game had.
+    """
+    is_sm5 = isinstance(game, SM5Game)
+    team_rosters = await get_team_rosters(await game.entity_starts.all(), await game.entity_ends.all())
+    teams = list(team_rosters.keys())
+
+    players = {}
+
+    for roster in team_rosters.values():
+        for player in roster:
+            player_summary = {
+                "state_distribution": await get_player_state_distribution(player.entity_start, player.entity_end,
+                                                                          game.player_states, game.events,
+                                                                          SM5_STATE_LABEL_MAP),
+            }
+
+            if is_sm5 and (stats := await SM5Stats.filter(entity_id=player.entity_start.id).first()):
+                player_summary["score_components"] = await get_sm5_score_components(game, stats, player.entity_start)
+
+            players[str(player.entity_start.id)] = player_summary
+
+    summary, _ = await GameSummary.update_or_create(
+        game_type=game.short_type, game_id=game.id,
+        defaults={
+            "version": GAME_SUMMARY_VERSION,
+            # laserball games always show the full mission duration
+            "duration": await game.get_game_duration() if is_sm5 else game.mission_duration,
+            "team_scores": {team.element: await game.get_team_score(team) for team in teams},
+            "eliminated_teams": [team.element for team in teams if is_sm5 and await game.get_team_eliminated(team)],
+            "medic_death_times": {team.element: await game.get_medic_death_time(team) for team in teams} if is_sm5
+            else {},
+            "players": players,
+        }
+    )
+
+    return summary
+
+
+async def get_game_summary(game: Union[SM5Game, LaserballGame]) -> Optional[GameSummary]:
+    """Returns the summary of a game, or None if it doesn't have an up-to-date one yet (see build_game_summary())."""
+    return await GameSummary.filter(game_type=game.short_type, game_id=game.id, version=GAME_SUMMARY_VERSION).first()
+
+
 def sort_notable_events(events: list[NotableEvent]):
     """Sorts a list of notable events in place."""
     events.sort(key=lambda event: event.seconds)
@@ -0,0 +1,244 @@
+"""
+Trying out rating model parameters against the ranked sm5 history.
+
+The history is loaded from the database once by load_sweep_history() into plain lists and arrays, so worker processes
+can each keep a copy. evaluate() then replays it in memory for one RatingConfig and scores the predictions the same
+way statshelper.get_predictive_accuracy(), get_brier_score() and get_margin_prediction_error() would after
+recalculate_sm5_ratings(config=config). sweep() does that for many configs in parallel.
+"""
+import itertools
+import time
+from array import array
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass, field, replace
+from typing import Dict, List, Optional
+
+from db.game import GameSummary
+from db.sm5 import SM5Game
+from db.types import GameType, IntRole, Team
+from helpers.ratinghelper import DEFAULT_CONFIG, SM5_HIT_EVENTS, SM5_MISSILE_EVENTS, SM5_SLOTS, Rating, RatingConfig, \
+    ReplayGame, load_replay_games, rate_1v1_events, rate_team_slots, sm5_hit_events, sm5_weight_scales
+from helpers.statshelper import GAME_SUMMARY_VERSION
+
+_LOAD_BATCH_SIZE = 200  # games loaded per round of queries
+
+# an event is stored as (missile, shooter slot, shooter role, target slot, target role)
+_EVENT_SIZE = 5
+
+# the slot of a non-member player in SweepGame.predicted_team*, they're predicted with the default rating
+NON_MEMBER = -1
+
+
+@dataclass
+class SweepGame:
+    """
+    A ranked sm5 game, the players are slots in SweepHistory
+    """
+    # the players rated as the first team and everyone else, see ReplayGame.get_teams()
+    team1: List[int]
+    team2: List[int]
+    team1_won: bool
+    # the players the win chance is predicted for, like Game.get_win_chance_before_game()
+    predicted_team1: List[int]
+    predicted_team2: List[int]
+    red_score: int
+    green_score: int
+    # only games with even teams count for the accuracy
+    even_teams: bool
+    # _EVENT_SIZE values per hit or missile, in the order they're rated
+    events: array = field(default_factory=lambda: array("i"))
+
+
+@dataclass
+class SweepHistory:
+    games: List[SweepGame] = field(default_factory=list)  # ordered by start time
+    player_count: int = 0
+
+
+@dataclass
+class SweepResult:
+    config: RatingConfig
+    accuracy: float
+    brier_score: float
+    margin_error: float
+    seconds: float
+
+
+def _compile_game(replay: ReplayGame, slots: Dict[str, int], red_score: int, green_score: int) -> SweepGame:
+    """
+    Turns a game loaded for the replay into a SweepGame, players get a slot the first time they're seen
+    """
+    def slot(entity_id: str) -> int:
+        return slots.setdefault(entity_id, len(slots))
+
+    def predicted_slot(entity_start: dict) -> int:
+        return NON_MEMBER if entity_start["entity_id"].startswith("@") else slot(entity_start["entity_id"])
+
+    team1 = []
+    team2 = []
+    for entity_start in replay.entity_starts.values():
+        if entity_start["type"] != "player":
+            continue
+        if entity_start["team__color_name"] == replay.teams[0]["color_name"]:
+            team1.append(slot(entity_start["entity_id"]))
+        else:
+            team2.append(slot(entity_start["entity_id"]))
+
+    entity_end_starts = [replay.entity_starts[entity_end.entity_id] for entity_end in replay.entity_ends]
+
+    game = SweepGame(
+        team1=team1,
+        team2=team2,
+        team1_won=replay.team1_won,
+        predicted_team1=[predicted_slot(entity_start) for entity_start in entity_end_starts
+                         if entity_start["team__color_name"] == replay.teams[0]["color_name"]],
+        predicted_team2=[predicted_slot(entity_start) for entity_start in entity_end_starts
+                         if entity_start["team__color_name"] == replay.teams[1]["color_name"]],
+        red_score=red_score,
+        green_score=green_score,
+        even_teams=replay.game.team1_size == replay.game.team2_size,
+    )
+
+    tokens = replay.tokens
+
+    for event in replay.events:
+        arguments = event["arguments"]
+        if "@" in arguments[0] or "@" in arguments[2]:
+            continue
+        shooter = tokens[arguments[0]]
+        target = tokens[arguments[2]]
+
+        game.events.extend((event["type"] in SM5_MISSILE_EVENTS, slot(shooter["entity_id"]), shooter["role"],
+                            slot(target["entity_id"]), target["role"]))
+
+    return game
+
+
+async def load_sweep_history(*, _sample_size: int=99999) -> SweepHistory:
+    """
+    Loads the ranked sm5 games in the order their ratings are calculated in
+
+    _sample_size is for testing purposes only, it limits the number of games
+    """
+    history = SweepHistory()
+    slots = {}
+
+    games = await SM5Game.filter(ranked=True).order_by("start_time", "id").limit(_sample_size)
+
+    for i in range(0, len(games), _LOAD_BATCH_SIZE):
+        batch = games[i:i + _LOAD_BATCH_SIZE]
+
+        team_scores = dict(await GameSummary.filter(
+            game_type=GameType.SM5.value, game_id__in=[game.id for game in batch], version=GAME_SUMMARY_VERSION
+        ).values_list("game_id", "team_scores"))
+
+        for replay in await load_replay_games(batch, "sm5games", SM5_HIT_EVENTS + SM5_MISSILE_EVENTS):
+            if replay.game.id in team_scores:
+                red_score = team_scores[replay.game.id].get(Team.RED.element, 0)
+                green_score = team_scores[replay.game.id].get(Team.GREEN.element, 0)
+            else:
+                red_score = await replay.game.get_team_score(Team.RED)
+                green_score = await replay.game.get_team_score(Team.GREEN)
+
+            history.games.append(_compile_game(replay, slots, red_score, green_score))
+
+    history.player_count = len(slots)
+
+    return history
+
+
+def evaluate(history: SweepHistory, config: RatingConfig = DEFAULT_CONFIG) -> SweepResult:
+    """
+    Replays the history with `config` from scratch and scores the win chance it gave before each game
+    """
+    start = time.perf_counter()
+
+    # the sm5 ratings of every player, player slot p has the rating slots p * SM5_SLOTS and on, see SM5_SLOTS
+    mu = [config.mu] * (history.player_count * SM5_SLOTS)
+    sigma = [config.sigma] * (history.player_count * SM5_SLOTS)
+    scale_mu, scale_sigma = sm5_weight_scales(history.player_count, config)
+
+    def get_rating(slot: int) -> Rating:
+        if slot == NON_MEMBER:
+            return Rating(config.mu, config.sigma)
+        return Rating(mu[slot * SM5_SLOTS], sigma[slot * SM5_SLOTS])
+
+    correct = 0
+    accuracy_games = 0
+    brier_sum = 0.0
+    margin_error_sum = 0.0
+    margin_games = 0
+
+    for game in history.games:
+        red_chance, green_chance = config.model.predict_win([
+            [get_rating(slot) for slot in game.predicted_team1],
+            [get_rating(slot) for slot in game.predicted_team2]
+        ])
+        red_score = game.red_score
+        green_score = game.green_score
+
+        # the same scores as in statshelper
+        if game.even_teams:
+            if abs(red_chance - green_chance) <= 0.2 and abs(red_score - green_score) <= 0.10*(red_score + green_score):
+                correct += 1
+            elif red_chance > green_chance and red_score > green_score:
+                correct += 1
+            elif green_chance > red_chance and green_score > red_score:
+                correct += 1
+            accuracy_games += 1
+
+        brier_sum += (red_chance - (1 if red_score > green_score else 0)) ** 2
+
+        if red_score + green_score != 0:
+            margin_error_sum += (2 * red_chance - 1 - (red_score - green_score) / (red_score + green_score)) ** 2
+            margin_games += 1
+
+        # then rate the game, like ratinghelper._replay_sm5_game()
+        events = game.events
+        rate_1v1_events(mu, sigma, (
+            hit
+            for i in range(0, len(events), _EVENT_SIZE)
+            for hit in sm5_hit_events(bool(events[i]), events[i + 1] * SM5_SLOTS, IntRole(events[i + 2]),
+                                      events[i + 3] * SM5_SLOTS, IntRole(events[i + 4]), config)
+        ), config, scale_mu, scale_sigma)
+
+        rate_team_slots(mu, sigma, [slot * SM5_SLOTS for slot in game.team1],
+                        [slot * SM5_SLOTS for slot in game.team2], game.team1_won, config)
+
+    return SweepResult(
+        config=config,
+        accuracy=correct / accuracy_games if accuracy_games != 0 else 0,
+        brier_score=brier_sum / len(history.games) if history.games else 0.0,
+        margin_error=margin_error_sum / margin_games if margin_games > 0 else 0.0,
+        seconds=time.perf_counter() - start,
+    )
+
+
+def config_grid(values: Dict[str, List[float]], base: RatingConfig = DEFAULT_CONFIG) -> List[RatingConfig]:
+    """
+    Every combination of `values` (key: a RatingConfig field), the other fields are the ones of `base`
+    """
+    return [replace(base, **dict(zip(values, combination))) for combination in itertools.product(*values.values())]
+
+
+# the history of the worker process, set once when it starts so it isn't sent along with every config
+_worker_history: Optional[SweepHistory] = None
+
+
+def _init_worker(history: SweepHistory) -> None:
+    global _worker_history
+    _worker_history = history
+
+
+def _evaluate_in_worker(config: RatingConfig) -> SweepResult:
+    return evaluate(_worker_history, config)
+
+
+def sweep(history: SweepHistory, configs: List[RatingConfig], workers: Optional[int] = None) -> List[SweepResult]:
+    """
+    Evaluates every config in `workers` processes (default: one per CPU)
+
+    returns: the results in the order of `configs`
+    """
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(history,)) as pool:
+        return list(pool.map(_evaluate_in_worker, configs))
@@ -1,23 +1,34 @@
+import asyncio
+import gzip
 import json
+import shutil
 import sys
 import os
+import time
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass, field
 from datetime import datetime
-from typing import List, Dict, Optional
+from typing import List, Dict, Optional, Union, Tuple, Type, Iterator, Iterable, Awaitable, TextIO
 
 import sentry_sdk
+from pypika import Table
 from sanic.log import logger
 from sanic import Request
+from tortoise import BaseDBAsyncClient, Model
+from tortoise.expressions import Q
+from tortoise.transactions import in_transaction
 
-from db.game import EntityEnds, EntityStarts, Events, Scores, PlayerStates, Teams
+from db.game import EntityEnds, EntityStarts, Events, Scores, PlayerStates, Teams, Game
 from db.laserball import LaserballGame, LaserballStats
 from db.player import Player
 from db.sm5 import IntRole, SM5_LASERRANK_VERSION
 from db.sm5 import SM5Game, SM5Stats
 from db.types import EventType, PlayerStateType, Team, Permission
 from helpers import ratinghelper
-from helpers import sm5helper, laserballhelper
+from helpers import sm5helper, laserballhelper, statshelper
 from helpers.ratinghelper import MU, SIGMA
-from helpers.cachehelper import _precache_template
+from helpers import cachehelper
 
 
 def element_to_color(element: str) -> str:
@@ -60,8 +71,449 @@ async def precache_game(type: str, id: int) -> None:
     logger.debug(f"Precached game {type} {id}")
 
 
-async def parse_sm5_game(file_location: str) -> Optional[SM5Game]:
-    file = open(file_location, "r", encoding="utf-16")
+# archived tdf files are gzip compressed, with this added to their name
+COMPRESSED_SUFFIX = ".gz"
+
+_GZIP_MAGIC = b"\x1f\x8b"
+
+
+def is_tdf_file(file_name: str) -> bool:
+    return file_name.endswith(".tdf") or file_name.endswith(".tdf" + COMPRESSED_SUFFIX)
+
+
+def get_tdf_name(file_location: str) -> str:
+    """Returns the name of a TDF file as stored in Game.tdf_name, which doesn't change when the file is compressed."""
+    return os.path.basename(file_location).removesuffix(COMPRESSED_SUFFIX)
+
+
+def get_tdf_path(folder: str, tdf_name: str) -> str:
+    """Returns where the file of a game is, compressed or not."""
+    path = os.path.join(folder, tdf_name)
+    if os.path.exists(path + COMPRESSED_SUFFIX):
+        return path + COMPRESSED_SUFFIX
+    return path
+
+
+def open_tdf(file_location: str, mode: str = "r") -> TextIO:
+    """Opens a TDF file as text ("r" or "w"), compressed or not."""
+    if file_location.endswith(COMPRESSED_SUFFIX):
+        return gzip.open(file_location, mode + "t", encoding="utf-16")
+    return open(file_location, mode, encoding="utf-16")
+
+
+def compress_tdf(file_location: str) -> str:
+    """Replaces an uncompressed TDF file with a compressed one and returns its path."""
+    target = file_location + COMPRESSED_SUFFIX
+
+    # write to a temporary file first, so there is always a complete copy of the file
+    with open(file_location, "rb") as source, open(target + ".part", "wb") as raw, \
+            gzip.GzipFile(filename=os.path.basename(file_location), mode="wb", fileobj=raw) as compressed:
+        shutil.copyfileobj(source, compressed)
+    os.replace(target + ".part", target)
+    os.remove(file_location)
+
+    return target
+
+
+@dataclass(slots=True)
+class SystemInfoRecord:
+    """Line type 0."""
+    file_version: str
+    program_version: str
+    arena: str
+
+
+@dataclass(slots=True)
+class GameInfoRecord:
+    """Line type 1."""
+    mission_type: int
+    mission_name: str
+    # as written in the file, "%Y%m%d%H%M%S"
+    start_time: str
+    mission_duration: int
+
+
+@dataclass(slots=True)
+class TeamRecord:
+    """Line type 2."""
+    index: int
+    name: str
+    color_enum: int
+    color_name: str
+
+
+@dataclass(slots=True)
+class EntityStartRecord:
+    """Line type 3."""
+    time: int
+    entity_id: str
+    type: str
+    # with the whitespace some names have at the end
+    name: str
+    team: int
+    level: int
+    role: int
+    battlesuit: str
+    # only in newer files, or when the option to include it is enabled
+    member_id: Optional[str]
+
+
+@dataclass(slots=True)
+class EventRecord:
+    """Line type 4."""
+    time: int
+    type: EventType
+    arguments: List[str]
+
+
+@dataclass(slots=True)
+class ScoreRecord:
+    """Line type 5."""
+    time: int
+    entity: str
+    old: int
+    delta: int
+    new: int
+
+
+@dataclass(slots=True)
+class EntityEndRecord:
+    """Line type 6."""
+    time: int
+    entity: str
+    type: int
+    score: int
+
+
+# the columns of SM5Stats in the order of a type 7 line, after the entity
+SM5_STATS_COLUMNS = (
+    "shots_hit", "shots_fired", "times_zapped", "times_missiled", "missile_hits", "nukes_detonated", "nukes_activated",
+    "nuke_cancels", "medic_hits", "own_medic_hits", "medic_nukes", "scout_rapid_fires", "life_boosts", "ammo_boosts",
+    "lives_left", "shots_left", "penalties", "shot_3_hits", "own_nuke_cancels", "shot_opponent", "shot_team",
+    "missiled_opponent", "missiled_team",
+)
+
+
+@dataclass(slots=True)
+class SM5StatsRecord:
+    """Line type 7."""
+    entity: str
+    # key: a name from SM5_STATS_COLUMNS
+    stats: Dict[str, int]
+
+
+@dataclass(slots=True)
+class PlayerStateRecord:
+    """Line type 9."""
+    time: int
+    entity: str
+    state: PlayerStateType
+
+
+TdfRecord = Union[SystemInfoRecord, GameInfoRecord, TeamRecord, EntityStartRecord, EventRecord, ScoreRecord,
+                  EntityEndRecord, SM5StatsRecord, PlayerStateRecord]
+
+
+class TdfReader:
+    """
+    Reads the lines of a TDF file as records, one at a time.
+
+    The source is either the path to the file, its content or the records read from it before. Comments and line
+    types we don't use are skipped.
+    Parsers should call set_sentry_context() if something goes wrong so the report shows the line it happened on:
+
+        reader = TdfReader(file_location)
+        try:
+            for record in reader:
+                ...
+        except Exception:
+            reader.set_sentry_context()
+            raise
+    """
+
+    def __init__(self, source: Union[str, bytes, List[TdfRecord]]) -> None:
+        self.source = source
+        # the line that was read last, 1-based
+        self.line_number = 0
+        self.fields: List[str] = []
+
+    def __iter__(self) -> Iterator[TdfRecord]:
+        if isinstance(self.source, list):
+            yield from self.source
+        elif isinstance(self.source, bytes):
+            content = gzip.decompress(self.source) if self.source.startswith(_GZIP_MAGIC) else self.source
+            yield from self._read_lines(content.decode("utf-16").splitlines())
+        else:
+            with open_tdf(self.source) as file:
+                yield from self._read_lines(file)
+
+    def _read_lines(self, lines: Iterable[str]) -> Iterator[TdfRecord]:
+        for line in lines:
+            self.line_number += 1
+            data = self.fields = line.rstrip("\n").split("\t")
+
+            match data[0]:  # switch on the first element of the line
+                case "0":  # system info
+                    yield SystemInfoRecord(data[1], data[2], data[3])
+                case "1":  # game info
+                    yield GameInfoRecord(int(data[1]), data[2], data[3], int(data[4]))
+                case "2":  # team info
+                    yield TeamRecord(int(data[1]), data[2], int(data[3]), data[4])
+                case "3":  # entity start
+                    yield EntityStartRecord(int(data[1]), data[2], data[3], data[4], int(data[5]), int(data[6]),
+                                            int(data[7]), data[8], data[9] if len(data) > 9 else None)
+                case "4":  # event
+                    yield EventRecord(int(data[1]), EventType(data[2]), data[3:])
+                case "5":  # score
+                    yield ScoreRecord(int(data[1]), data[2], int(data[3]), int(data[4]), int(data[5]))
+                case "6":  # entity end
+                    yield EntityEndRecord(int(data[1]), data[2], int(data[3]), int(data[4]))
+                case "7":  # sm5 stats
+                    yield SM5StatsRecord(data[1], dict(zip(SM5_STATS_COLUMNS, map(int, data[2:25]))))
+                case "9":  # player state
+                    yield PlayerStateRecord(int(data[1]), data[2], PlayerStateType(int(data[3])))
+
+    def set_sentry_context(self) -> None:
+        sentry_sdk.set_context("tdf_line", {"line_number": self.line_number, "fields": self.fields})
+
+
+@dataclass
+class ParsedGame:
+    """
+    A game read from a TDF file by read_sm5_game() or read_laserball_game(), not saved yet.
+
+    Every row is a model instance without an id. Relations between them (the team of an entity start,
+    the entity of a score...) are set on the instances and resolved when persist_game() gives them ids.
+    """
+    game: Union[SM5Game, LaserballGame]
+    teams: List[Teams] = field(default_factory=list)
+    entity_starts: List[EntityStarts] = field(default_factory=list)
+    events: List[Events] = field(default_factory=list)
+    scores: List[Scores] = field(default_factory=list)
+    player_states: List[PlayerStates] = field(default_factory=list)
+    entity_ends: List[EntityEnds] = field(default_factory=list)
+    # SM5Stats or LaserballStats, depending on the game
+    stats: List[Union[SM5Stats, LaserballStats]] = field(default_factory=list)
+    # why the game isn't ranked, empty if it is
+    unranked_reasons: List[str] = field(default_factory=list)
+
+    @property
+    def row_count(self) -> int:
+        return 1 + len(self.teams) + len(self.entity_starts) + len(self.events) + len(self.scores) + \
+            len(self.player_states) + len(self.entity_ends) + len(self.stats)
+
+
+# rows per INSERT statement when persisting a game
+_BULK_BATCH_SIZE = 500
+
+
+def _with_relation(instance: Model, **relations: Model) -> Model:
+    # the constructor refuses relations to rows that aren't saved, the attribute setter doesn't
+    for name, value in relations.items():
+        setattr(instance, name, value)
+    return instance
+
+
+def _team_size(entity_ends: List[EntityEnds], team: Optional[Teams]) -> int:
+    return len([end for end in entity_ends if end.entity.type == "player" and end.entity.team is team])
+
+
+def _get_playing_teams(teams: List[Teams]) -> Tuple[Optional[Teams], Optional[Teams]]:
+    # the first team that isn't neutral, and the last one
+    playing_teams = [team for team in teams if team.color_name and team.color_enum and team.name != "Neutral"]
+    return (playing_teams[0] if len(playing_teams) > 0 else None,
+            playing_teams[-1] if len(playing_teams) > 1 else None)
+
+
+def get_role_counts(entity_starts: List[EntityStarts], team: Teams) -> Dict[IntRole, int]:
+    """Returns how many players of each role are on a team."""
+    return Counter(e.role for e in entity_starts if e.type == "player" and e.team is team)
+
+
+def _find_non_member(entity_starts: List[EntityStarts]) -> Optional[EntityStarts]:
+    for e in entity_starts:
+        if e.type == "player" and e.entity_id.startswith("@") and e.name == e.battlesuit:
+            return e
+    return None
+
+
+def get_sm5_unranked_reasons(teams: List[Teams], entity_starts: List[EntityStarts],
+                             entity_ends: List[EntityEnds]) -> List[str]:
+    """Returns why an SM5 game can't be ranked automatically, or an empty list if it can."""
+    reasons = []
+
+    team1, team2 = _get_playing_teams(teams)
+
+    # 5 < team size < 7 and teams are not of unequal size (ratings are not tested for unequal team sizes)
+
+    team1_len = _team_size(entity_ends, team1)
+    team2_len = _team_size(entity_ends, team2)
+
+    if team1_len > 7 or team2_len > 7 or team1_len < 5 or team2_len < 5 or team1_len != team2_len:
+        reasons.append(f"Teams have {team1_len} and {team2_len} players, they need the same size between 5 and 7")
+
+    # also check that our roles are correct
+    # ex: a standard sm5 team has 1 commander, 1 heavy, 1 scout, 1 medic, 1 ammo, and 1-3 scouts
+
+    for t in teams:
+        role_counts = get_role_counts(entity_starts, t)
+
+        if not role_counts:  # probably a neutral team
+            continue
+
+        # sometimes we have 2 ammos, but for ranking purposes we only want games with 1
+        if role_counts[IntRole.COMMANDER] != 1 or role_counts[IntRole.HEAVY] != 1 or role_counts[IntRole.AMMO] != 1 or \
+                role_counts[IntRole.MEDIC] != 1 or not 1 <= role_counts[IntRole.SCOUT] <= 3:
+            roles = ", ".join(f"{count} {role}" for role, count in sorted(role_counts.items()))
+            reasons.append(f"{t.name} team has {roles}")
+
+    # check if there are any non-member players
+
+    if non_member := _find_non_member(entity_starts):
+        reasons.append(f"{non_member.name} is not a member")
+
+    return reasons
+
+
+def get_laserball_unranked_reasons(teams: List[Teams], entity_starts: List[EntityStarts],
+                                   entity_ends: List[EntityEnds]) -> List[str]:
+    """Returns why a Laserball game can't be ranked automatically, or an empty list if it can."""
+    reasons = []
+
+    team1, team2 = _get_playing_teams(teams)
+
+    # we don't have to check for exact team sizes because laserball is slightly more
+    # flexible with team sizes
+
+    team1_len = _team_size(entity_ends, team1)
+    team2_len = _team_size(entity_ends, team2)
+
+    if team1_len < 2 or team2_len < 2:
+        logger.debug("One of the teams has less than 2 players, unranking game")
+        reasons.append(f"Teams have {team1_len} and {team2_len} players, they need at least 2")
+
+    # check if there are any non-member players
+
+    if non_member := _find_non_member(entity_starts):
+        logger.debug(f"Found non-member player {non_member.name}, unranking game")
+        reasons.append(f"{non_member.name} is not a member")
+
+    return reasons
+
+
+async def _allocate_ids(model: Type[Model], instances: List[Model], connection: BaseDBAsyncClient) -> None:
+    """
+    Gives `instances` the ids following the highest id in the table.
+
+    Must run in the transaction that inserts them. The locking read keeps another import from taking the same ids
+    until that transaction is done (MySQL, sqlite imports never run concurrently).
+    """
+    if not instances:
+        return
+
+    last = await model.all().using_db(connection).select_for_update().order_by("-id").only("id").first()
+    next_id = last.id + 1 if last else 1
+
+    for instance in instances:
+        instance.id = next_id
+        # insert the id we picked instead of letting the database generate one
+        instance._custom_generated_pk = True
+        next_id += 1
+
+
+def _resolve_relations(instances: List[Model], *names: str) -> None:
+    # setting a relation copies the id of the related row, which it may not have had when the relation was set
+    for instance in instances:
+        for name in names:
+            setattr(instance, name, getattr(instance, name))
+
+
+async def _bulk_insert(model: Type[Model], instances: List[Model], connection: BaseDBAsyncClient) -> None:
+    if not instances:
+        return
+
+    await model.bulk_create(instances, batch_size=_BULK_BATCH_SIZE, using_db=connection)
+    for instance in instances:
+        instance._saved_in_db = True
+
+
+async def _bulk_link(game: Game, relation: str, instances: List[Model], connection: BaseDBAsyncClient) -> None:
+    # Game.<relation>.add() first selects the links that already exist and needs each row to be saved through the
+    # model. The game is new, so there are none and the links can be inserted right away.
+    if not instances:
+        return
+
+    relation_field = game._meta.fields_map[relation]
+    through_table = Table(relation_field.through)
+
+    for start in range(0, len(instances), _BULK_BATCH_SIZE):
+        query = connection.query_class.into(through_table).columns(
+            through_table[relation_field.backward_key],
+            through_table[relation_field.forward_key],
+        )
+        for instance in instances[start:start + _BULK_BATCH_SIZE]:
+            query = query.insert(game.id, instance.id)
+        await connection.execute_query(str(query))
+
+
+async def persist_game(parsed: ParsedGame) -> Union[SM5Game, LaserballGame]:
+    """
+    Saves a game read by read_sm5_game() or read_laserball_game() and all of its rows.
+
+    Everything is written in one transaction with one INSERT per table (per _BULK_BATCH_SIZE rows), so a failure
+    doesn't leave parts of the game behind. The winner is determined in the same transaction.
+    """
+    game = parsed.game
+    stats_model = SM5Stats if isinstance(game, SM5Game) else LaserballStats
+    stats_relation = "sm5_stats" if isinstance(game, SM5Game) else "laserball_stats"
+
+    async with in_transaction() as connection:
+        await game.save(using_db=connection)
+
+        await _allocate_ids(Teams, parsed.teams, connection)
+        await _bulk_insert(Teams, parsed.teams, connection)
+
+        _resolve_relations(parsed.entity_starts, "team")
+        await _allocate_ids(EntityStarts, parsed.entity_starts, connection)
+        await _bulk_insert(EntityStarts, parsed.entity_starts, connection)
+
+        await _allocate_ids(Events, parsed.events, connection)
+        await _bulk_insert(Events, parsed.events, connection)
+
+        for model, instances in [(Scores, parsed.scores), (PlayerStates, parsed.player_states),
+                                 (EntityEnds, parsed.entity_ends), (stats_model, parsed.stats)]:
+            _resolve_relations(instances, "entity")
+            await _allocate_ids(model, instances, connection)
+            await _bulk_insert(model, instances, connection)
+
+        for relation, instances in [("teams", parsed.teams), ("entity_starts", parsed.entity_starts),
+                                    ("events", parsed.events), ("player_states", parsed.player_states),
+                                    ("scores", parsed.scores), ("entity_ends", parsed.entity_ends),
+                                    (stats_relation, parsed.stats)]:
+            await _bulk_link(game, relation, instances, connection)
+
+        sentry_sdk.set_context("game", {"id": game.id})
+        logger.debug("Inital game save complete")
+
+        if isinstance(game, SM5Game):
+            await sm5helper.update_winner(game)
+        else:
+            await laserballhelper.update_winner(game)
+        await game.save(using_db=connection)
+
+    logger.debug(f"Winner: {game.winner_color}")
+
+    return game
+
+
+def read_sm5_game(file_location: str, content: Union[bytes, List[TdfRecord], None] = None) -> Optional[ParsedGame]:
+    """
+    Reads an SM5 game from a TDF file without touching the database.
+
+    The file is read from `content` if given (its bytes or the records TdfReader read from it), `file_location` is
+    still used for its name.
+    Returns None if the file isn't an SM5 game or if the game was a false start. See persist_game().
+    """
     logger.info(f"Parsing {file_location}...")
 
     file_version = ""
@@ -93,253 +545,131 @@ async def parse_sm5_game(file_location: str) -> Optional[SM5Game]:
 
     # default values, will be changed later
 
-    ranked = True
     ended_early = True  # will be changed to false if there's a mission end event
 
-    linenum = 0
-    while True:
-        linenum += 1
-        line = file.readline()
-        if not line:
-            break
-
-        data = line.rstrip("\n").split("\t")
-        match data[0]:  # switch on the first element of the line
-            case ";":
-                continue  # comment
-            case "0":  # system info
-                sentry_sdk.set_context("system_info",
-                                       {"file_version": data[1], "program_version": data[2], "arena": data[3]})
-
-                file_version = data[1]
-                program_version = data[2]
-                arena = data[3]
-                logger.debug(
-                    f"System Info: file version: {file_version}, program version: {program_version}, arena: {arena}")
-            case "1":  # game info
-                sentry_sdk.set_context("game_info",
-                                       {"mission_type": data[1], "mission_name": data[2], "start_time": data[3],
-                                        "mission_duration": data[4]})
-
-                mission_type = int(data[1])
-                mission_name = data[2]
-                start_time = data[3]
-                mission_duration = int(data[4])
-
-                logger.debug(
-                    f"Game Info: mission type: {mission_type}, mission name: {mission_name}, start time: {start_time}, mission duration: {mission_duration}")
-
-                # check if game already exists
-                if game := await SM5Game.filter(start_time=start_time, arena=arena).first():
-
-                    # triple check it because since the timestamp gets rounded, it's possible for
-                    # games to start at nearly the same time
-
-                    if file_location == "sm5_tdf/" + game.tdf_name:
-                        logger.warning(f"Game {game.id} already exists, skipping")
-                        return game
-                    
-                if mission_type != 5:
-                    # only parse sm5 games (mission type 5)
-
-                    logger.warning(f"Game at {file_location} is not an SM5 game (mission type {mission_type}), skipping")
-                    return None
-
-            case "2":  # team info
-                sentry_sdk.set_context("team_info", {"index": data[1], "name": data[2], "color_enum": data[3],
-                                                     "color_name": data[4]})
-
-                teams.append(
-                    await Teams.create(index=int(data[1]), name=data[2], color_enum=data[3], color_name=data[4],
-                                       real_color_name=element_to_color(data[4])))
-                logger.debug(
-                    f"Team Info: index: {data[1]}, name: {data[2]}, color enum: {data[3]}, color name: {data[4]}")
-            case "3":  # entity start
-                team = None
-
-                # what team is this player on?
-                # iterate through teams until we find the right one and save it to "team"
-                for t in teams:
-                    if t.index == int(data[5]):
-                        team = t
-                        break
-
-                if team is None:
-                    raise Exception("Team not found, invalid tdf file")
-
-                # has index 9
-                try:
-                    member_id = data[9]
-                except (ValueError, IndexError):
-                    member_id = None
-
-                sentry_sdk.set_context(
-                    "entity_start", {
-                        "time": data[1],
-                        "entity_id": data[2],
-                        "type": data[3],
-                        "name": data[4],
-                        "team": data[5],
-                        "level": data[6],
-                        "role": data[7],
-                        "battlesuit": data[8],
-                        "member_id": member_id
-                    }
-                )
-
-                name = data[4].strip()  # remove whitespace (some names have trailing whitespace for some reason)
-
-                entity_start = await EntityStarts.create(time=int(data[1]), entity_id=data[2], type=data[3], name=name,
-                                                         team=team, level=int(data[6]), role=int(data[7]),
-                                                         battlesuit=data[8], member_id=member_id)
-
-                entity_starts.append(entity_start)
-                token_to_entity[data[2]] = entity_start
-
-                # if this is a player, determine if they can gain specials (heavies can't gain specials and scouts can't gain specials until they get rapid fire)
-                if entity_start.type == "player":
-                    if entity_start.role == IntRole.HEAVY:
-                        player_can_gain_specials[data[2]] = False
-                    else:
-                        player_can_gain_specials[data[2]] = True
-                    player_special_points[data[2]] = 0  # initialize special points to 0
-            case "4":  # event
-                sentry_sdk.set_context("event", {"time": data[1], "type": data[2], "arguments": data[3:]})
-                
-                events.append(await create_event_from_data(data))
-
-                event_type = EventType(data[2])
-
-                if event_type == EventType.MISSION_END:  # game ended naturally
-                    ended_early = False
-
-                logger.debug(f"Event: time: {data[1]}, type: {event_type}, arguments: {data[3:]}")
-
-                # handle special points
-                if player_can_gain_specials.get(data[3], True): # if player can gain specials (not heavy or doesn't have rapid fire on)
-                    match event_type:
-                        # give specials
-                        case EventType.DAMAGED_OPPONENT | EventType.DOWNED_OPPONENT:
-                            # only enemies (damaged/downed opponent still is used for teammates)
-                            if token_to_entity[data[3]].team != token_to_entity[data[5]].team:
-                                player_special_points[data[3]] = min(player_special_points.get(data[3], 0) + 1, 99)
-                        case EventType.MISSILE_DOWN_OPPONENT:
-                            if token_to_entity[data[3]].team != token_to_entity[data[5]].team:
-                                player_special_points[data[3]] = min(player_special_points.get(data[3], 0) + 2, 99)
-
-                        # remove specials
-                        case EventType.ACTIVATE_NUKE:
-                            player_special_points[data[3]] = min(player_special_points.get(data[3], 0) - 20, 99)
-                        case EventType.AMMO_BOOST:
-                            player_special_points[data[3]] = min(player_special_points.get(data[3], 0) - 15, 99)
-                        case EventType.LIFE_BOOST:
-                            player_special_points[data[3]] = min(player_special_points.get(data[3], 0) - 10, 99)
-
-                # scouts can get sp from bases even with rapid
-                if event_type in [EventType.DESTROY_BASE, EventType.MISSILE_BASE_DESTROY, EventType.BASE_AWARDED] and token_to_entity[data[3]].role != IntRole.HEAVY:
-                    player_special_points[data[3]] = min(player_special_points.get(data[3], 0) + 5, 99)
-
-                # scout activated rapid
-                if event_type == EventType.ACTIVATE_RAPID_FIRE:
-                    # rapid fire turned on, specials can't be gained until it's turned off
-                    player_special_points[data[3]] = min(player_special_points.get(data[3], 0) - 10, 99)
-                    player_can_gain_specials[data[3]] = False
-
-                # scout deactivated rapid from being resupplied ammo or lives
-                if event_type in [EventType.RESUPPLY_AMMO, EventType.RESUPPLY_LIVES]:
-                    if token_to_entity[data[5]].role == IntRole.SCOUT:
-                        # rapid fire turned off, specials can be gained again
-                        player_can_gain_specials[data[5]] = True
-
-            case "5":  # score
-                sentry_sdk.set_context("score", {"time": data[1], "entity": data[2], "old": data[3], "delta": data[4],
-                                                 "new": data[5]})
-
-                scores.append(await Scores.create(time=int(data[1]), entity=token_to_entity[data[2]], old=int(data[3]),
-                                                  delta=int(data[4]), new=int(data[5])))
-                logger.debug(
-                    f"Score: time: {data[1]}, entity: {token_to_entity[data[2]]}, old: {data[3]}, delta: {data[4]}, new: {data[5]}")
-            case "6":  # entity end
-                sentry_sdk.set_context("entity_end",
-                                       {"time": data[1], "entity": data[2], "type": data[3], "score": data[4]})
-
-                entity_ends.append(await EntityEnds.create(time=int(data[1]), entity=token_to_entity[data[2]],
-                                                           type=int(data[3]), score=int(data[4])))
-                logger.debug(
-                    f"Entity End: time: {data[1]}, entity: {token_to_entity[data[2]]}, type: {data[3]}, score: {data[4]}")
-            case "7":  # sm5 stats
-                sentry_sdk.set_context(
-                    "sm5_stats", {
-                        "entity": data[1],
-                        "shots_hit": data[2],
-                        "shots_fired": data[3],
-                        "times_zapped": data[4],
-                        "times_missiled": data[5],
-                        "missile_hits": data[6],
-                        "nukes_detonated": data[7],
-                        "nukes_activated": data[8],
-                        "nuke_cancels": data[9],
-                        "medic_hits": data[10],
-                        "own_medic_hits": data[11],
-                        "medic_nukes": data[12],
-                        "scout_rapid_fires": data[13],
-                        "life_boosts": data[14],
-                        "ammo_boosts": data[15],
-                        "lives_left": data[16],
-                        "shots_left": data[17],
-                        "penalties": data[18],
-                        "shot_3_hits": data[19],
-                        "own_nuke_cancels": data[20],
-                        "shot_opponent": data[21],
-                        "shot_team": data[22],
-                        "missiled_opponent": data[23],
-                        "missiled_team": data[24],
-                        # custom addition not in tdf
-                        "special_points": player_special_points.get(data[1], 0)
-                    }
-                )
-
-                sm5_stats.append(await SM5Stats.create(entity=token_to_entity[data[1]],
-                                                       shots_hit=int(data[2]), shots_fired=int(data[3]),
-                                                       times_zapped=int(data[4]), times_missiled=int(data[5]),
-                                                       missile_hits=int(data[6]), nukes_detonated=int(data[7]),
-                                                       nukes_activated=int(data[8]), nuke_cancels=int(data[9]),
-                                                       medic_hits=int(data[10]), own_medic_hits=int(data[11]),
-                                                       medic_nukes=int(data[12]), scout_rapid_fires=int(data[13]),
-                                                       life_boosts=int(data[14]), ammo_boosts=int(data[15]),
-                                                       lives_left=int(data[16]), shots_left=int(data[17]),
-                                                       penalties=int(data[18]), shot_3_hits=int(data[19]),
-                                                       own_nuke_cancels=int(data[20]), shot_opponent=int(data[21]),
-                                                       shot_team=int(data[22]), missiled_opponent=int(data[23]),
-                                                       missiled_team=int(data[24]), special_points=player_special_points.get(data[1], 0)))
-
-                logger.debug(
-                    f"SM5 Stats: entity: {token_to_entity[data[1]]}, shots hit: {data[2]}, shots fired: {data[3]}, times zapped: {data[4]}, times missiled: {data[5]}, missile hits: {data[6]}, nukes detonated: {data[7]}, nukes activated: {data[8]}, nuke cancels: {data[9]}, medic hits: {data[10]}, own medic hits: {data[11]}, medic nukes: {data[12]}, scout rapid fires: {data[13]}, life boosts: {data[14]}, ammo boosts: {data[15]}, lives left: {data[16]}, shots left: {data[17]}, penalties: {data[18]}, shot 3 hits: {data[19]}, own nuke cancels: {data[20]}, shot opponent: {data[21]}, shot team: {data[22]}, missiled opponent: {data[23]}, missiled team: {data[24]}, special points: {player_special_points.get(data[1], 0)}")
-            case "9":  # player state
-                sentry_sdk.set_context("player_state", {"time": data[1], "entity": data[2], "state": data[3]})
-
-                player_states.append(await PlayerStates.create(time=int(data[1]), entity=token_to_entity[data[2]],
-                                                               state=PlayerStateType(int(data[3]))))
-                logger.debug(
-                    f"Player State: time: {int(data[1])}, entity: {token_to_entity[data[2]]}, state: {data[3]}")
+    reader = TdfReader(content if content is not None else file_location)
+    try:
+        for record in reader:
+            match record:
+                case SystemInfoRecord():
+                    file_version = record.file_version
+                    program_version = record.program_version
+                    arena = record.arena
+                    logger.debug(
+                        f"System Info: file version: {file_version}, program version: {program_version}, arena: {arena}")
+                case GameInfoRecord():
+                    mission_type = record.mission_type
+                    mission_name = record.mission_name
+                    start_time = record.start_time
+                    mission_duration = record.mission_duration
+
+                    logger.debug(
+                        f"Game Info: mission type: {mission_type}, mission name: {mission_name}, start time: {start_time}, mission duration: {mission_duration}")
+
+                    if mission_type != 5:
+                        # only parse sm5 games (mission type 5)
+
+                        logger.warning(f"Game at {file_location} is not an SM5 game (mission type {mission_type}), skipping")
+                        return None
+                case TeamRecord():
+                    teams.append(Teams(index=record.index, name=record.name, color_enum=record.color_enum,
+                                       color_name=record.color_name, real_color_name=element_to_color(record.color_name)))
+                case EntityStartRecord():
+                    team = None
+
+                    # what team is this player on?
+                    # iterate through teams until we find the right one and save it to "team"
+                    for t in teams:
+                        if t.index == record.team:
+                            team = t
+                            break
+
+                    if team is None:
+                        raise Exception("Team not found, invalid tdf file")
+
+                    name = record.name.strip()  # remove whitespace (some names have trailing whitespace for some reason)
+
+                    entity_start = _with_relation(EntityStarts(time=record.time, entity_id=record.entity_id,
+                                                               type=record.type, name=name, level=record.level,
+                                                               role=record.role, battlesuit=record.battlesuit,
+                                                               member_id=record.member_id), team=team)
+
+                    entity_starts.append(entity_start)
+                    token_to_entity[record.entity_id] = entity_start
+
+                    # if this is a player, determine if they can gain specials (heavies can't gain specials and scouts can't gain specials until they get rapid fire)
+                    if entity_start.type == "player":
+                        if entity_start.role == IntRole.HEAVY:
+                            player_can_gain_specials[record.entity_id] = False
+                        else:
+                            player_can_gain_specials[record.entity_id] = True
+                        player_special_points[record.entity_id] = 0  # initialize special points to 0
+                case EventRecord():
+                    events.append(event_from_record(record))
+
+                    event_type = record.type
+                    args = record.arguments
+
+                    if event_type == EventType.MISSION_END:  # game ended naturally
+                        ended_early = False
+
+                    # handle special points
+                    if player_can_gain_specials.get(args[0], True): # if player can gain specials (not heavy or doesn't have rapid fire on)
+                        match event_type:
+                            # give specials
+                            case EventType.DAMAGED_OPPONENT | EventType.DOWNED_OPPONENT:
+                                # only enemies (damaged/downed opponent still is used for teammates)
+                                if token_to_entity[args[0]].team is not token_to_entity[args[2]].team:
+                                    player_special_points[args[0]] = min(player_special_points.get(args[0], 0) + 1, 99)
+                            case EventType.MISSILE_DOWN_OPPONENT:
+                                if token_to_entity[args[0]].team is not token_to_entity[args[2]].team:
+                                    player_special_points[args[0]] = min(player_special_points.get(args[0], 0) + 2, 99)
+
+                            # remove specials
+                            case EventType.ACTIVATE_NUKE:
+                                player_special_points[args[0]] = min(player_special_points.get(args[0], 0) - 20, 99)
+                            case EventType.AMMO_BOOST:
+                                player_special_points[args[0]] = min(player_special_points.get(args[0], 0) - 15, 99)
+                            case EventType.LIFE_BOOST:
+                                player_special_points[args[0]] = min(player_special_points.get(args[0], 0) - 10, 99)
+
+                    # scouts can get sp from bases even with rapid
+                    if event_type in [EventType.DESTROY_BASE, EventType.MISSILE_BASE_DESTROY, EventType.BASE_AWARDED] and token_to_entity[args[0]].role != IntRole.HEAVY:
+                        player_special_points[args[0]] = min(player_special_points.get(args[0], 0) + 5, 99)
+
+                    # scout activated rapid
+                    if event_type == EventType.ACTIVATE_RAPID_FIRE:
+                        # rapid fire turned on, specials can't be gained until it's turned off
+                        player_special_points[args[0]] = min(player_special_points.get(args[0], 0) - 10, 99)
+                        player_can_gain_specials[args[0]] = False
+
+                    # scout deactivated rapid from being resupplied ammo or lives
+                    if event_type in [EventType.RESUPPLY_AMMO, EventType.RESUPPLY_LIVES]:
+                        if token_to_entity[args[2]].role == IntRole.SCOUT:
+                            # rapid fire turned off, specials can be gained again
+                            player_can_gain_specials[args[2]] = True
+                case ScoreRecord():
+                    scores.append(_with_relation(Scores(time=record.time, old=record.old, delta=record.delta,
+                                                        new=record.new), entity=token_to_entity[record.entity]))
+                case EntityEndRecord():
+                    entity_ends.append(_with_relation(EntityEnds(time=record.time, type=record.type,
+                                                                 score=record.score),
+                                                      entity=token_to_entity[record.entity]))
+                case SM5StatsRecord():
+                    # special points are a custom addition not in tdf
+                    sm5_stats.append(_with_relation(SM5Stats(**record.stats,
+                                                             special_points=player_special_points.get(record.entity, 0)),
+                                                    entity=token_to_entity[record.entity]))
+                case PlayerStateRecord():
+                    player_states.append(_with_relation(PlayerStates(time=record.time, state=record.state),
+                                                        entity=token_to_entity[record.entity]))
+    except Exception:
+        reader.set_sentry_context()
+        raise
 
     # get teams for later use
 
-    team1 = None
-    team2 = None
-
-    index = 1
-
-    for t in teams:
-        if not t.color_name or not t.color_enum or t.name == "Neutral":
-            continue
-
-        if index == 1:
-            team1 = t
-        else:  # 2
-            team2 = t
-
-        index += 1
+    team1, team2 = _get_playing_teams(teams)
 
     # before creating the game, we need to make sure this game wasn't a false start
     # which means that game ended early and it lasted less than 3 minutes
@@ -348,152 +678,181 @@ async def parse_sm5_game(file_location: str) -> Optional[SM5Game]:
         logger.warning("Game ended early and lasted less than 3 minutes, skipping")
         return None
 
-    game = await SM5Game.create(winner=Team.NONE, winner_color="none", tdf_name=os.path.basename(file_location),
-                                file_version=file_version, ranked=ranked,
-                                software_version=program_version, arena=arena, mission_type=mission_type,
-                                mission_name=mission_name,
-                                start_time=datetime.strptime(start_time, "%Y%m%d%H%M%S"),
-                                mission_duration=mission_duration, ended_early=ended_early)
+    # determine if the game should be ranked automatically
+
+    team1_len = _team_size(entity_ends, team1)
+    team2_len = _team_size(entity_ends, team2)
+
+    unranked_reasons = get_sm5_unranked_reasons(teams, entity_starts, entity_ends)
+    ranked = not unranked_reasons
+
+    # check if game was ended early (but not by elimination)
+
+    # ended_early = if there's a mission end event (natural end by time or elim)
+    # value set in event parsing
 
-    sentry_sdk.set_context("game", {"id": game.id})
+    sentry_sdk.set_context("game_info", {"ranked": ranked, "ended_early": ended_early})
 
-    await game.teams.add(*teams)
-    await game.entity_starts.add(*entity_starts)
-    await game.events.add(*events)
-    await game.player_states.add(*player_states)
-    await game.scores.add(*scores)
-    await game.entity_ends.add(*entity_ends)
-    await game.sm5_stats.add(*sm5_stats)
+    logger.debug(f"Ranked={ranked}, Ended Early={ended_early}")
 
-    await game.save()
+    game = SM5Game(winner=Team.NONE, winner_color="none", tdf_name=get_tdf_name(file_location),
+                   file_version=file_version, ranked=ranked,
+                   software_version=program_version, arena=arena, mission_type=mission_type,
+                   mission_name=mission_name,
+                   start_time=datetime.strptime(start_time, "%Y%m%d%H%M%S"),
+                   mission_duration=mission_duration, ended_early=ended_early,
+                   laserrank_version=SM5_LASERRANK_VERSION, team1_size=team1_len, team2_size=team2_len)
 
-    logger.debug("Inital game save complete")
-    await sm5helper.update_winner(game)
+    return ParsedGame(game=game, teams=teams, entity_starts=entity_starts, events=events, scores=scores,
+                      player_states=player_states, entity_ends=entity_ends, stats=sm5_stats,
+                      unranked_reasons=unranked_reasons)
 
-    game.laserrank_version = SM5_LASERRANK_VERSION
-    await game.save()
 
-    logger.debug(f"Winner: {game.winner_color}")
+_RATING_SNAPSHOT_FIELDS = ["previous_rating_mu", "previous_rating_sigma", "current_rating_mu", "current_rating_sigma"]
+_ROLE_RATING_SNAPSHOT_FIELDS = ["previous_role_rating_mu", "previous_role_rating_sigma", "current_role_rating_mu",
+                                "current_role_rating_sigma"]
 
-    # determine if the game should be ranked automatically
 
-    # 5 < team size < 7 and teams are not of unequal size (ratings are not tested for unequal team sizes)
+def _player_key(value: str) -> str:
+    """
+    The key two codenames or entity ids are the same player by, the database compares them case-insensitively
+    """
+    return value.casefold()
 
-    team1_len = await game.entity_ends.filter(entity__team=team1, entity__type="player").count()
-    team2_len = await game.entity_ends.filter(entity__team=team2, entity__type="player").count()
 
-    if team1_len > 7 or team2_len > 7 or team1_len < 5 or team2_len < 5 or team1_len != team2_len:
-        ranked = False
+async def resolve_players(entity_starts: List[EntityStarts]) -> Dict[str, Player]:
+    """
+    Links the players of a game to the player table, creating the ones we haven't seen before.
 
-    # also check that our roles are correct
-    # ex: a standard sm5 team has 1 commander, 1 heavy, 1 scout, 1 medic, 1 ammo, and 1-3 scouts
+    All candidates are loaded with one query and the changes are written back with one bulk update and one bulk insert.
+    Names and entity ids are matched case-insensitively, like the database does.
+    Returns the players by entity id (players created here don't have an id yet).
+    """
+    entities = [e for e in entity_starts
+                # is a player and not a non-member (logged in players have a name that isn't the battlesuit)
+                if e.type == "player" and not (e.entity_id.startswith("@") and e.name == e.battlesuit)]
 
-    # for each team
-    for t in teams:
-        total_count = 0
-        commander_count = 0
-        heavy_count = 0
-        scout_count = 0
-        ammo_count = 0
-        medic_count = 0
-
-        for e in entity_starts:
-            if e.type == "player" and e.team == t:
-                total_count += 1
-                if e.role == IntRole.COMMANDER:
-                    commander_count += 1
-                elif e.role == IntRole.HEAVY:
-                    heavy_count += 1
-                elif e.role == IntRole.SCOUT:
-                    scout_count += 1
-                elif e.role == IntRole.AMMO:  # sometimes we have 2 ammos, but for ranking purposes we only want games with 1
-                    ammo_count += 1
-                elif e.role == IntRole.MEDIC:
-                    medic_count += 1
-
-        if total_count == 0:  # probably a neutral team
-            continue
+    if not entities:
+        return {}
 
-        if commander_count != 1 or heavy_count != 1 or ammo_count != 1 or medic_count != 1 or scout_count < 1 or scout_count > 3:
-            ranked = False
+    names = {e.name for e in entities}
+    entity_ids = {e.entity_id for e in entities}
 
-    # check if there are any non-member players
+    # key: _player_key() of the codename or entity id
+    by_codename: Dict[str, Player] = {}
+    by_entity_id: Dict[str, Player] = {}
 
-    for e in entity_starts:
-        if e.type == "player" and e.entity_id.startswith("@") and e.name == e.battlesuit:
-            ranked = False
-            break
+    for player in await Player.filter(Q(codename__in=names) | Q(entity_id__in=entity_ids)).order_by("id"):
+        # keep the first match, like Player.filter(...).first()
+        by_codename.setdefault(_player_key(player.codename), player)
+        by_entity_id.setdefault(_player_key(player.entity_id), player)
 
-    # check if game was ended early (but not by elimination)
+    # key: id() of the player, so the same player is only updated once
+    updated: Dict[int, Player] = {}
+    created: List[Player] = []
 
-    # ended_early = if there's a mission end event (natural end by time or elim)
-    # value set in event parsing
+    for e in entities:
+        db_member_id = e.member_id if e.member_id else ""
+        player_by_codename = by_codename.get(_player_key(e.name))
+        player_by_entity_id = by_entity_id.get(_player_key(e.entity_id))
+
+        # update entity_id if it's empty
+        if player_by_codename and player_by_codename.entity_id == "":
+            player_by_codename.entity_id = e.entity_id
+            player_by_codename.player_id = db_member_id
+            by_entity_id.setdefault(_player_key(e.entity_id), player_by_codename)
+            updated[id(player_by_codename)] = player_by_codename
+        # update player name if we have a new one and we have entity_id
+        elif player_by_entity_id and player_by_entity_id.codename != e.name:
+            if by_codename.get(_player_key(player_by_entity_id.codename)) is player_by_entity_id:
+                del by_codename[_player_key(player_by_entity_id.codename)]
+            player_by_entity_id.codename = e.name
+            player_by_entity_id.player_id = db_member_id
+            by_codename.setdefault(_player_key(e.name), player_by_entity_id)
+            updated[id(player_by_entity_id)] = player_by_entity_id
+        # update player_id if we have entity_id and don't have player_id
+        elif player_by_entity_id and player_by_entity_id.player_id == "":
+            player_by_entity_id.player_id = db_member_id
+            updated[id(player_by_entity_id)] = player_by_entity_id
+        # create new player if we don't have a name or entity_id
+        elif not player_by_codename and not player_by_entity_id:
+            player = Player(player_id=db_member_id, codename=e.name, entity_id=e.entity_id)
+            by_codename[_player_key(e.name)] = player
+            by_entity_id[_player_key(e.entity_id)] = player
+            created.append(player)
+
+    # players created here are inserted with their latest values
+    updated_players = [player for player in updated.values() if player.id is not None]
+
+    if updated_players:
+        await Player.bulk_update(updated_players, fields=["codename", "entity_id", "player_id"])
+    if created:
+        await Player.bulk_create(created)
+
+    return {e.entity_id: by_entity_id[_player_key(e.entity_id)] for e in entities
+            if _player_key(e.entity_id) in by_entity_id}
 
-    sentry_sdk.set_context("game_info", {"ranked": ranked, "ended_early": ended_early})
 
-    logger.debug(f"Ranked={ranked}, Ended Early={ended_early}")
+async def parse_sm5_game(file_location: str) -> Optional[SM5Game]:
+    parsed = read_sm5_game(file_location)
+    if parsed is None:
+        return None
 
-    game.ranked = ranked
-    game.ended_early = ended_early
-    game.team1_size = team1_len
-    game.team2_size = team2_len
+    return await save_sm5_game(parsed, file_location)
 
-    await game.save()
 
-    logger.info("Resyncing player table")
+async def save_sm5_game(parsed: ParsedGame, file_location: str, update_ratings: bool = True,
+                        invalidate_cache: bool = True) -> SM5Game:
+    """
+    Saves a game read by read_sm5_game() unless it exists already, and adds its players to the player table.
+
+    With update_ratings=False the game isn't rated and nothing is cached, the caller has to recalculate the ratings
+    of all games afterwards (see bulk_import_tdfs()). With invalidate_cache=False the game is rated, but nothing
+    cached is dropped and the game isn't precached, for saves that are rolled back (see check_tdf()).
+    """
+    # check if game already exists
+    if game := await SM5Game.filter(start_time=parsed.game.start_time, arena=parsed.game.arena).first():
 
-    # add new players to the database
+        # triple check it because since the timestamp gets rounded, it's possible for
+        # games to start at nearly the same time
 
-    for e in entity_starts:
-        # is a player and logged in
-        if e.entity_id.startswith("@") and e.name == e.battlesuit:
-            continue
+        if get_tdf_name(file_location) == game.tdf_name:
+            logger.warning(f"Game {game.id} already exists, skipping")
+            return game
 
-        db_member_id = e.member_id if e.member_id else ""
+    game = await persist_game(parsed)
 
-        if e.type == "player":
-            # update entity_id if it's empty
-            if await Player.filter(codename=e.name).exists() and (
-                    await Player.filter(codename=e.name).first()).entity_id == "":
-                player = await Player.filter(codename=e.name).first()
-                player.entity_id = e.entity_id
-                player.player_id = db_member_id
-                await player.save()
-            # update player name if we have a new one and we have entity_id
-            elif await Player.filter(entity_id=e.entity_id).exists() and (
-                    await Player.filter(entity_id=e.entity_id).first()).codename != e.name:
-                player = await Player.filter(entity_id=e.entity_id).first()
-                player.codename = e.name
-                player.player_id = db_member_id
-                await player.save()
-            # update player_id if we have entity_id and don't have player_id
-            elif await Player.filter(entity_id=e.entity_id).exists() and (
-                    await Player.filter(entity_id=e.entity_id).first()).player_id == "":
-                player = await Player.filter(entity_id=e.entity_id).first()
-                player.player_id = db_member_id
-                await player.save()
-            # create new player if we don't have a name or entity_id
-            elif not await Player.filter(codename=e.name).exists() and not await Player.filter(
-                    entity_id=e.entity_id).exists():
-                await Player.create(player_id=db_member_id, codename=e.name, entity_id=e.entity_id)
+    logger.info("Resyncing player table")
+
+    players = await resolve_players(parsed.entity_starts)
+
+    await statshelper.build_game_summary(game)
+
+    if not update_ratings:
+        logger.info(f"Finished parsing {file_location} (game {game.id})")
+        return game
 
     # update player rankings
 
-    if ranked:
+    if game.ranked and await SM5Game.filter(start_time__gt=game.start_time).exists():
+        # imported after newer games, they have to be rated again with this one before them
+        logger.info(f"Correcting player rankings after game {game.id}")
+
+        await ratinghelper.correct_ratings(game, invalidate_cache)
+    elif game.ranked:
         logger.info(f"Updating player ranking for game {game.id}")
 
-        if await ratinghelper.update_sm5_ratings(game):
+        if await ratinghelper.update_sm5_ratings(game, invalidate_cache):
             logger.info(f"Updated player rankings for game {game.id}")
         else:
             logger.error(f"Failed to update player rankings for game {game.id}")
     else:  # still need to add current_rating and previous_rating
-        for entity_end in await game.entity_ends.filter(entity__type="player"):
-            entity_start = await entity_end.entity
-            entity_id = entity_start.entity_id
-            if entity_id.startswith("@"):
-                continue
+        entity_ends = [entity_end for entity_end in parsed.entity_ends
+                       if entity_end.entity.type == "player" and not entity_end.entity.entity_id.startswith("@")]
 
-            player = await Player.filter(entity_id=entity_id).first()
+        for entity_end in entity_ends:
+            entity_start = entity_end.entity
+            player = players.get(entity_start.entity_id)
 
             try:
                 entity_end.previous_rating_mu = player.sm5_mu
@@ -516,19 +875,30 @@ async def parse_sm5_game(file_location: str) -> Optional[SM5Game]:
                 entity_end.current_role_rating_mu = MU
                 entity_end.current_role_rating_sigma = SIGMA
 
-            await entity_end.save()
+        if entity_ends:
+            await EntityEnds.bulk_update(entity_ends, fields=_RATING_SNAPSHOT_FIELDS + _ROLE_RATING_SNAPSHOT_FIELDS)
 
     logger.info(f"Finished parsing {file_location} (game {game.id})")
 
-    # precache the game so it's available immediately
+    if not invalidate_cache:
+        return game
 
+    # drop whatever was cached for the players in this game, then precache the game so it's available immediately
+
+    await cachehelper.invalidate_game(game)
     await precache_game("sm5", game.id)
 
     return game
 
 
-async def parse_laserball_game(file_location: str) -> Optional[LaserballGame]:
-    file = open(file_location, "r", encoding="utf-16")
+def read_laserball_game(file_location: str, content: Union[bytes, List[TdfRecord], None] = None) -> Optional[ParsedGame]:
+    """
+    Reads a Laserball game from a TDF file without touching the database.
+
+    The file is read from `content` if given (its bytes or the records TdfReader read from it), `file_location` is
+    still used for its name.
+    Returns None if the file isn't a Laserball game or if the game was a false start. See persist_game().
+    """
     logger.info(f"Parsing {file_location}...")
 
     file_version = ""
@@ -540,297 +910,170 @@ async def parse_laserball_game(file_location: str) -> Optional[LaserballGame]:
     start_time: str = ""
     mission_duration = 0
 
-    teams: Teams = []
-    entity_starts: EntityStarts = []
-    events: Events = []
-    player_states: PlayerStates = []
-    scores: Scores = []
-    entity_ends: EntityEnds = []
+    teams: List[Teams] = []
+    entity_starts: List[EntityStarts] = []
+    events: List[Events] = []
+    player_states: List[PlayerStates] = []
+    scores: List[Scores] = []
+    entity_ends: List[EntityEnds] = []
 
     laserball_stats: Dict[str, LaserballStats] = {}
     number_of_rounds = 0
+    # the last pass since the last steal or round start, the one a goal might be an assist from
+    last_pass: Optional[EventRecord] = None
 
     token_to_entity = {}
 
     # default values, will be changed later
 
-    ranked = True
     ended_early = True  # will be changed to false if there's a mission end event
 
-    linenum = 0
-    while True:
-        linenum += 1
-        line = file.readline()
-        if not line:
-            break
-
-        data = line.rstrip("\n").split("\t")
-        match data[0]:  # switch on the first element of the line
-            case ";":
-                continue  # comment
-            case "0":  # system info
-                sentry_sdk.set_context("system_info",
-                                       {"file_version": data[1], "program_version": data[2], "arena": data[3]})
-
-                file_version = data[1]
-                program_version = data[2]
-                arena = data[3]
-                logger.debug(
-                    f"System Info: file version: {file_version}, program version: {program_version}, arena: {arena}")
-            case "1":  # game info
-                sentry_sdk.set_context("game_info",
-                                       {"mission_type": data[1], "mission_name": data[2], "start_time": data[3],
-                                        "mission_duration": data[4]})
-
-                mission_type = int(data[1])
-                mission_name = data[2]
-                start_time = data[3]
-                mission_duration = int(data[4])
-
-                logger.debug(
-                    f"Game Info: mission type: {mission_type}, mission name: {mission_name}, start time: {start_time}, mission duration: {mission_duration}")
-
-                # check if game already exists
-                if game := await LaserballGame.filter(start_time=start_time, arena=arena).first():
-                    logger.warning(f"Game {game.id} already exists, skipping")
-                    return game
-                
-                if mission_type != 28:
-                    # only parse laserball games (mission type 28)
-
-                    logger.warning(f"Game at {file_location} is not a Laserball game (mission type {mission_type}), skipping")
-                    return None
-
-            case "2":  # team info
-                sentry_sdk.set_context("team_info", {"index": data[1], "name": data[2], "color_enum": data[3],
-                                                     "color_name": data[4]})
-
-                # TODO: remove hardcode purple (this is nessacery for now because purple's "color_name" is red for some reason)
-                if data[2] == "Purple":
-                    data[3] = 1
-                    data[4] = "Purple"
-
-                teams.append(
-                    await Teams.create(index=int(data[1]), name=data[2], color_enum=data[3], color_name=data[4],
-                                       real_color_name=element_to_color(data[4])))
-                logger.debug(
-                    f"Team Info: index: {data[1]}, name: {data[2]}, color enum: {data[3]}, color name: {data[4]}")
-            case "3":  # entity start
-                team = None
-
-                for t in teams:
-                    if t.index == int(data[5]):
-                        team = t
-                        break
-
-                if team is None:
-                    raise Exception("Team not found, invalid tdf file")
-
-                # has index 9 (member id, but is only available when the setting is enabled)
-                try:
-                    member_id = int(data[9])
-                except (ValueError, IndexError):
-                    member_id = None
-
-                name = data[4].strip()  # remove whitespace (some names have trailing whitespace for some reason)
-
-                sentry_sdk.set_context(
-                    "entity_start", {
-                        "time": data[1],
-                        "entity_id": data[2],
-                        "type": data[3],
-                        "name": data[4],
-                        "team": data[5],
-                        "level": data[6],
-                        "role": data[7],
-                        "battlesuit": data[8],
-                        "member_id": member_id
-                    }
-                )
-
-                entity_start = await EntityStarts.create(time=int(data[1]), entity_id=data[2], type=data[3], name=name,
-                                                         team=team, level=int(data[6]), role=int(data[7]),
-                                                         battlesuit=data[8], member_id=member_id)
-
-                entity_starts.append(entity_start)
-                token_to_entity[data[2]] = entity_start
-
-                if entity_start.type == "player":
-                    laserball_stats[entity_start.entity_id] = await LaserballStats.create(
-                        entity=entity_start,
-                        goals=0,
-                        assists=0,
-                        passes=0,
-                        steals=0,
-                        clears=0,
-                        blocks=0,
-                        started_with_ball=0,
-                        times_stolen=0,
-                        times_blocked=0,
-                        passes_received=0,
-                        shots_fired=0,
-                        shots_hit=0
-                    )
-
-                logger.debug(
-                    f"Entity Start: time: {data[1]}, entity id: {data[2]}, type: {data[3]}, name: {data[4]}, team: {data[5]}, level: {data[6]}, role: {data[7]}, battlesuit: {data[8]}")
-            case "4":  # event
-                sentry_sdk.set_context("event", {"time": data[1], "type": data[2], "arguments": data[3:]})
-
-                # handle special laserball events
-
-                event_type = EventType(data[2])
-                args = data[3:]
-
-                if event_type == EventType.GETS_BALL:
-                    laserball_stats[args[0]].started_with_ball += 1
-                    await laserball_stats[args[0]].save()
-                elif event_type == EventType.GOAL:
-                    laserball_stats[args[0]].goals += 1
-                    laserball_stats[args[0]].shots_fired += 1
-                    laserball_stats[args[0]].shots_hit += 1
-                    await laserball_stats[args[0]].save()
-                elif event_type == EventType.STEAL:
-                    laserball_stats[args[0]].steals += 1
-                    laserball_stats[args[0]].blocks += 1
-                    laserball_stats[args[0]].shots_fired += 1
-                    laserball_stats[args[0]].shots_hit += 1
-                    laserball_stats[args[2]].times_stolen += 1
-                    await laserball_stats[args[0]].save()
-                    await laserball_stats[args[2]].save()
-                elif event_type == EventType.CLEAR:
-                    laserball_stats[args[0]].clears += 1
-                    await laserball_stats[args[0]].save()
-                elif event_type == EventType.BLOCK:
-                    laserball_stats[args[0]].blocks += 1
-                    laserball_stats[args[0]].shots_fired += 1
-                    laserball_stats[args[0]].shots_hit += 1
-                    laserball_stats[args[2]].times_blocked += 1
-                    await laserball_stats[args[0]].save()
-                    await laserball_stats[args[2]].save()
-                elif event_type == EventType.PASS:
-                    laserball_stats[args[0]].passes += 1
-                    laserball_stats[args[0]].shots_fired += 1
-                    laserball_stats[args[0]].shots_hit += 1
-                    laserball_stats[args[2]].passes_received += 1
-                    await laserball_stats[args[0]].save()
-                    await laserball_stats[args[2]].save()
-                elif event_type == EventType.ROUND_END:
-                    number_of_rounds += 1
-                elif event_type == EventType.MISS:
-                    laserball_stats[args[0]].shots_fired += 1
-                    await laserball_stats[args[0]].save()
-                elif event_type == EventType.MISSION_END:  # game ended naturally
-                    ended_early = False
-
-                events.append(await Events.create(time=int(data[1]), type=event_type, arguments=json.dumps(data[3:])))
-
-                logger.debug(f"Event: time: {data[1]}, type: {event_type}, arguments: {data[3:]}")
-            case "5":  # score
-                sentry_sdk.set_context("score", {"time": data[1], "entity": data[2], "old": data[3], "delta": data[4],
-                                                 "new": data[5]})
-
-                scores.append(await Scores.create(time=int(data[1]), entity=token_to_entity[data[2]], old=int(data[3]),
-                                                  delta=int(data[4]), new=int(data[5])))
-                logger.debug(
-                    f"Score: time: {data[1]}, entity: {token_to_entity[data[2]]}, old: {data[3]}, delta: {data[4]}, new: {data[5]}")
-            case "6":  # entity end
-                sentry_sdk.set_context("entity_end",
-                                       {"time": data[1], "entity": data[2], "type": data[3], "score": data[4]})
-
-                entity_ends.append(await EntityEnds.create(time=int(data[1]), entity=token_to_entity[data[2]],
-                                                           type=int(data[3]), score=int(data[4])))
-                logger.debug(
-                    f"Entity End: time: {data[1]}, entity: {token_to_entity[data[2]]}, type: {data[3]}, score: {data[4]}")
-            case "9":  # player state
-                sentry_sdk.set_context("player_state", {"time": data[1], "entity": data[2], "state": data[3]})
-
-                player_states.append(await PlayerStates.create(time=int(data[1]), entity=token_to_entity[data[2]],
-                                                               state=PlayerStateType(int(data[3]))))
-                logger.debug(
-                    f"Player State: time: {int(data[1])}, entity: {token_to_entity[data[2]]}, state: {data[3]}")
-
-    # calculate assists (when a player passes to a player who scores)
-    # so we need to find all the goals, and then find the pass that happened before it
-    # this probably isn't 100% accurate but it's the best we can do
-
-    logger.debug("Calculating assists")
-
-    events_reversed = events[::-1]
-
-    for e in events:
-        if e.type == EventType.GOAL:
-            # find the pass that happened before this goal
-            for e2 in events_reversed:  # iterate backwards
-                if e2.type == EventType.ROUND_START and e2.time < e.time:
-                    break
-                elif e2.type == EventType.PASS and e2.time < e.time:
-                    # check if the pass was to the same player
-                    if e2.arguments[2] == e.arguments[0]:
-                        laserball_stats[e2.arguments[0]].assists += 1
-                        await laserball_stats[e2.arguments[0]].save()
+    reader = TdfReader(content if content is not None else file_location)
+    try:
+        for record in reader:
+            match record:
+                case SystemInfoRecord():
+                    file_version = record.file_version
+                    program_version = record.program_version
+                    arena = record.arena
+                    logger.debug(
+                        f"System Info: file version: {file_version}, program version: {program_version}, arena: {arena}")
+                case GameInfoRecord():
+                    mission_type = record.mission_type
+                    mission_name = record.mission_name
+                    start_time = record.start_time
+                    mission_duration = record.mission_duration
+
+                    logger.debug(
+                        f"Game Info: mission type: {mission_type}, mission name: {mission_name}, start time: {start_time}, mission duration: {mission_duration}")
+
+                    if mission_type != 28:
+                        # only parse laserball games (mission type 28)
+
+                        logger.warning(f"Game at {file_location} is not a Laserball game (mission type {mission_type}), skipping")
+                        return None
+                case TeamRecord():
+                    color_enum = record.color_enum
+                    color_name = record.color_name
+
+                    # TODO: remove hardcode purple (this is nessacery for now because purple's "color_name" is red for some reason)
+                    if record.name == "Purple":
+                        color_enum = 1
+                        color_name = "Purple"
+
+                    teams.append(Teams(index=record.index, name=record.name, color_enum=color_enum,
+                                       color_name=color_name, real_color_name=element_to_color(color_name)))
+                case EntityStartRecord():
+                    team = None
+
+                    for t in teams:
+                        if t.index == record.team:
+                            team = t
+                            break
+
+                    if team is None:
+                        raise Exception("Team not found, invalid tdf file")
+
+                    # member id is only available when the setting is enabled
+                    try:
+                        member_id = int(record.member_id)
+                    except (ValueError, TypeError):
+                        member_id = None
+
+                    name = record.name.strip()  # remove whitespace (some names have trailing whitespace for some reason)
+
+                    entity_start = _with_relation(EntityStarts(time=record.time, entity_id=record.entity_id,
+                                                               type=record.type, name=name, level=record.level,
+                                                               role=record.role, battlesuit=record.battlesuit,
+                                                               member_id=member_id), team=team)
+
+                    entity_starts.append(entity_start)
+                    token_to_entity[record.entity_id] = entity_start
+
+                    if entity_start.type == "player":
+                        laserball_stats[entity_start.entity_id] = _with_relation(LaserballStats(
+                            goals=0,
+                            assists=0,
+                            passes=0,
+                            steals=0,
+                            clears=0,
+                            blocks=0,
+                            started_with_ball=0,
+                            times_stolen=0,
+                            times_blocked=0,
+                            passes_received=0,
+                            shots_fired=0,
+                            shots_hit=0
+                        ), entity=entity_start)
+                case EventRecord():
+                    # handle special laserball events
+
+                    event_type = record.type
+                    args = record.arguments
+
+                    if event_type == EventType.GETS_BALL:
+                        laserball_stats[args[0]].started_with_ball += 1
+                    elif event_type == EventType.GOAL:
+                        laserball_stats[args[0]].goals += 1
+                        laserball_stats[args[0]].shots_fired += 1
+                        laserball_stats[args[0]].shots_hit += 1
+                    elif event_type == EventType.STEAL:
+                        laserball_stats[args[0]].steals += 1
+                        laserball_stats[args[0]].blocks += 1
+                        laserball_stats[args[0]].shots_fired += 1
+                        laserball_stats[args[0]].shots_hit += 1
+                        laserball_stats[args[2]].times_stolen += 1
+                    elif event_type == EventType.CLEAR:
+                        laserball_stats[args[0]].clears += 1
+                    elif event_type == EventType.BLOCK:
+                        laserball_stats[args[0]].blocks += 1
+                        laserball_stats[args[0]].shots_fired += 1
+                        laserball_stats[args[0]].shots_hit += 1
+                        laserball_stats[args[2]].times_blocked += 1
+                    elif event_type == EventType.PASS:
+                        laserball_stats[args[0]].passes += 1
+                        laserball_stats[args[0]].shots_fired += 1
+                        laserball_stats[args[0]].shots_hit += 1
+                        laserball_stats[args[2]].passes_received += 1
+                    elif event_type == EventType.ROUND_END:
+                        number_of_rounds += 1
+                    elif event_type == EventType.MISS:
+                        laserball_stats[args[0]].shots_fired += 1
+                    elif event_type == EventType.MISSION_END:  # game ended naturally
+                        ended_early = False
+
+                    events.append(Events(time=record.time, type=event_type, arguments=json.dumps(args)))
+
+                    # calculate assists (when a player passes to a player who scores)
+                    # the pass has to be the last thing that happened to the ball, a steal or a new round in between
+                    # means it's not an assist. this probably isn't 100% accurate but it's the best we can do
+
+                    if event_type == EventType.PASS:
+                        last_pass = record
+                    elif event_type in (EventType.STEAL, EventType.ROUND_START):
+                        last_pass = None
+                    elif event_type == EventType.GOAL and last_pass is not None and last_pass.arguments[2] == args[0]:
+                        laserball_stats[last_pass.arguments[0]].assists += 1
                         # add event after the goal event
-                        events.append(
-                            await Events.create(
-                                time=e.time + 1,
-                                type=EventType.ASSIST,
-                                arguments=json.dumps([e2.arguments[0], "assists", e.arguments[0]])
-                            )
-                        )
-                        break
-                    else:
-                        # wasn't the most recent pass so it's not an assist
-                        break
-                elif e2.type == EventType.STEAL and e2.time < e.time:
-                    # if a steal happened before a valid pass, it can't be an assist
-                    break
-
-    # get the winner (goals scored is the only factor)
-
-    team1_score = 0
-    team1 = None
-    team2_score = 0
-    team2 = None
-
-    i = 0
-    for team in teams:
-        if not team.color_name or not team.color_enum or team.name == "Neutral":
-            continue
-
-        if i == 0:  # found first team
-            team1 = team
-        else:  # found second team
-            team2 = team
-
-        # TODO: optimize this
-        entities = await EntityStarts.filter(team=team, type="player").all()
-        for e in entities:
-            e_end = await EntityEnds.filter(entity__entity_id=e.entity_id).first()
-
-            if i == 1:
-                team1_score += e_end.score
-            elif i == 2:
-                team2_score += e_end.score
-
-        i += 1
-
-    if team1_score > team2_score:
-        winner_model = team1
-    elif team2_score > team1_score:
-        winner_model = team2
-    else:
-        winner_model = None
-
-    # calculate winner
-
-    winner = None
-
-    if winner_model is None:
-        winner = None  # tie (draw)
-    else:
-        winner = winner_model.enum
-
-    logger.debug(f"Winner: {winner}")
+                        events.append(Events(time=record.time + 1, type=EventType.ASSIST,
+                                             arguments=json.dumps([last_pass.arguments[0], "assists", args[0]])))
+                case ScoreRecord():
+                    scores.append(_with_relation(Scores(time=record.time, old=record.old, delta=record.delta,
+                                                        new=record.new), entity=token_to_entity[record.entity]))
+                case EntityEndRecord():
+                    entity_ends.append(_with_relation(EntityEnds(time=record.time, type=record.type,
+                                                                 score=record.score),
+                                                      entity=token_to_entity[record.entity]))
+                case PlayerStateRecord():
+                    player_states.append(_with_relation(PlayerStates(time=record.time, state=record.state),
+                                                        entity=token_to_entity[record.entity]))
+    except Exception:
+        reader.set_sentry_context()
+        raise
+
+    # the winner is determined from the scores when the game is saved (laserballhelper.update_winner())
+
+    team1, team2 = _get_playing_teams(teams)
 
     # before creating the game, we need to make sure this game wasn't a false start
     # which means that game ended early and it lasted less than 3 minutes
@@ -839,120 +1082,84 @@ async def parse_laserball_game(file_location: str) -> Optional[LaserballGame]:
         logger.warning("Game ended early and lasted less than 3 minutes, skipping")
         return None
 
-    game = await LaserballGame.create(winner=Team.NONE, winner_color="none" if winner else "none",
-                                      tdf_name=os.path.basename(file_location), file_version=file_version,
-                                      ranked=ranked,
-                                      software_version=program_version, arena=arena, mission_type=mission_type,
-                                      mission_name=mission_name,
-                                      start_time=datetime.strptime(start_time, "%Y%m%d%H%M%S"),
-                                      mission_duration=mission_duration, ended_early=ended_early)
-
-    sentry_sdk.set_context("game", {"id": game.id})
-
-    await game.teams.add(*teams)
-    await game.entity_starts.add(*entity_starts)
-    await game.events.add(*events)
-    await game.player_states.add(*player_states)
-    await game.scores.add(*scores)
-    await game.entity_ends.add(*entity_ends)
-    await game.laserball_stats.add(*laserball_stats.values())
-
-    await game.save()
-
-    logger.debug("Inital game save complete")
-
-    # determine winner
-
-    await laserballhelper.update_winner(game)
-
-    await game.save()
-
     # determine if the game should be ranked automatically
 
-    # we don't have to check for exact team sizes because laserball is slightly more
-    # flexible with team sizes
-
-    team1_len = await game.entity_ends.filter(entity__team=team1, entity__type="player").count()
-    team2_len = await game.entity_ends.filter(entity__team=team2, entity__type="player").count()
+    team1_len = _team_size(entity_ends, team1)
+    team2_len = _team_size(entity_ends, team2)
 
     logger.debug(f"Team 1 size: {team1_len}, Team 2 size: {team2_len}")
 
-    # team size < 1
-
-    if team1_len < 2 or team2_len < 2:
-        logger.debug("One of the teams has less than 2 players, unranking game")
-        ranked = False
-
-    # check if there are any non-member players
-
-    for e in entity_starts:
-        if e.type == "player" and e.entity_id.startswith("@") and e.name == e.battlesuit:
-            logger.debug(f"Found non-member player {e.name}, unranking game")
-            ranked = False
-            break
+    unranked_reasons = get_laserball_unranked_reasons(teams, entity_starts, entity_ends)
+    ranked = not unranked_reasons
 
     # check if game was ended early (but not by elimination)
 
     # ended_early = if there's a mission end event (natural end by time or elim)
     # value set in event parsing
 
-    game.ranked = ranked
-    game.ended_early = ended_early
-
     sentry_sdk.set_context("game_info", {"ranked": ranked, "ended_early": ended_early})
 
     logger.debug(f"Ranked={ranked}, Ended Early={ended_early}")
 
-    await game.save()
+    game = LaserballGame(winner=Team.NONE, winner_color="none", tdf_name=get_tdf_name(file_location),
+                         file_version=file_version, ranked=ranked,
+                         software_version=program_version, arena=arena, mission_type=mission_type,
+                         mission_name=mission_name,
+                         start_time=datetime.strptime(start_time, "%Y%m%d%H%M%S"),
+                         mission_duration=mission_duration, ended_early=ended_early)
+
+    return ParsedGame(game=game, teams=teams, entity_starts=entity_starts, events=events, scores=scores,
+                      player_states=player_states, entity_ends=entity_ends, stats=list(laserball_stats.values()),
+                      unranked_reasons=unranked_reasons)
+
+
+async def parse_laserball_game(file_location: str) -> Optional[LaserballGame]:
+    parsed = read_laserball_game(file_location)
+    if parsed is None:
+        return None
+
+    return await save_laserball_game(parsed, file_location)
+
+
+async def save_laserball_game(parsed: ParsedGame, file_location: str, update_ratings: bool = True,
+                              invalidate_cache: bool = True) -> LaserballGame:
+    """See save_sm5_game()."""
+    # check if game already exists
+    if game := await LaserballGame.filter(start_time=parsed.game.start_time, arena=parsed.game.arena).first():
+        logger.warning(f"Game {game.id} already exists, skipping")
+        return game
+
+    game = await persist_game(parsed)
 
     logger.info("Resyncing player table")
 
-    for e in entity_starts:
-        if e.entity_id.startswith("@") and e.name == e.battlesuit:
-            continue
+    players = await resolve_players(parsed.entity_starts)
 
-        db_member_id = e.member_id if e.member_id else ""
+    await statshelper.build_game_summary(game)
 
-        if e.type == "player":
-            # update entity_id if it's empty
-            if await Player.filter(codename=e.name).exists() and (
-                    await Player.filter(codename=e.name).first()).entity_id == "":
-                player = await Player.filter(codename=e.name).first()
-                player.entity_id = e.entity_id
-                player.player_id = db_member_id
-                await player.save()
-            # update player name if we have a new one and we have entity_id
-            elif await Player.filter(entity_id=e.entity_id).exists() and (
-                    await Player.filter(entity_id=e.entity_id).first()).codename != e.name:
-                player = await Player.filter(entity_id=e.entity_id).first()
-                player.name = e.name
-                player.player_id = db_member_id
-                await player.save()
-            # update player_id if we have entity_id and don't have player_id
-            elif await Player.filter(entity_id=e.entity_id).exists() and (
-                    await Player.filter(entity_id=e.entity_id).first()).player_id == "":
-                player = await Player.filter(entity_id=e.entity_id).first()
-                player.player_id = db_member_id
-                await player.save()
-            # create new player if we don't have a name or entity_id
-            elif not await Player.filter(codename=e.name).exists() and not await Player.filter(
-                    entity_id=e.entity_id).exists():
-                await Player.create(player_id=db_member_id, codename=e.name, entity_id=e.entity_id)
+    if not update_ratings:
+        logger.info(f"Finished parsing {file_location} (game {game.id})")
+        return game
 
     # update player rankings
 
-    if ranked:
+    if game.ranked and await LaserballGame.filter(start_time__gt=game.start_time).exists():
+        # imported after newer games, they have to be rated again with this one before them
+        logger.info(f"Correcting player rankings after game {game.id}")
+
+        await ratinghelper.correct_ratings(game, invalidate_cache)
+    elif game.ranked:
         logger.info(f"Updating player ranking for game {game.id}")
 
-        if await ratinghelper.update_laserball_ratings(game):
+        if await ratinghelper.update_laserball_ratings(game, invalidate_cache):
             logger.info(f"Updated player rankings for game {game.id}")
         else:
             logger.error(f"Failed to update player rankings for game {game.id}")
     else:  # still need to add current_rating and previous_rating
-        for entity_end in await game.entity_ends.filter(entity__type="player"):
-            entity_id = (await entity_end.entity).entity_id
+        entity_ends = [entity_end for entity_end in parsed.entity_ends if entity_end.entity.type == "player"]
 
-            player = await Player.filter(entity_id=entity_id).first()
+        for entity_end in entity_ends:
+            player = players.get(entity_end.entity.entity_id)
 
             try:
                 entity_end.previous_rating_mu = player.laserball_mu
@@ -965,12 +1172,17 @@ async def parse_laserball_game(file_location: str) -> Optional[LaserballGame]:
                 entity_end.current_rating_mu = MU
                 entity_end.current_rating_sigma = SIGMA
 
-            await entity_end.save()
+        if entity_ends:
+            await EntityEnds.bulk_update(entity_ends, fields=_RATING_SNAPSHOT_FIELDS)
 
     logger.info(f"Finished parsing {file_location} (game {game.id})")
 
-    # precache the game so it's available immediately
+    if not invalidate_cache:
+        return game
+
+    # drop whatever was cached for the players in this game, then precache the game so it's available immediately
 
+    await cachehelper.invalidate_game(game)
     await precache_game("laserball", game.id)
 
     return game
@@ -981,7 +1193,7 @@ async def parse_all_laserball_tdfs() -> None:  # iterate through laserball_tdf f
     directory.sort()  # first file is the oldest
 
     for file in directory:
-        if file.endswith(".tdf"):
+        if is_tdf_file(file):
             logger.info(f"Parsing {file}")
             await parse_laserball_game(os.path.join("laserball_tdf", file))
 
@@ -991,7 +1203,7 @@ async def parse_all_sm5_tdfs() -> None:  # iterate through sm5_tdf folder
     directory.sort()  # first file is the oldest
 
     for file in directory:
-        if file.endswith(".tdf"):
+        if is_tdf_file(file):
             logger.info(f"Parsing {file}")
             await parse_sm5_game(os.path.join("sm5_tdf", file))
 
@@ -1001,6 +1213,264 @@ async def parse_all_tdfs() -> None:
     await parse_all_laserball_tdfs()
 
 
+# key: game type, value: folder bulk_import_tdfs() reads the files of that type from
+BULK_IMPORT_FOLDERS = {
+    "sm5": "sm5_tdf",
+    "laserball": "laserball_tdf",
+}
+
+
+@dataclass
+class BulkImportResult:
+    files: int = 0
+    # games that were saved, not counting the ones that were skipped or existed already
+    games: int = 0
+    rows: int = 0
+    # files that couldn't be read or saved
+    failed: List[str] = field(default_factory=list)
+    seconds: float = 0
+
+    @property
+    def games_per_second(self) -> float:
+        return self.games / self.seconds if self.seconds else 0
+
+    @property
+    def rows_per_second(self) -> float:
+        return self.rows / self.seconds if self.seconds else 0
+
+
+def read_start_time(source: Union[str, bytes]) -> Optional[str]:
+    """Returns the start time of the game in a TDF file ("%Y%m%d%H%M%S"), or None if it doesn't have one."""
+    # the game info is on the second line, so this stops long before the end of the file
+    for record in TdfReader(source):
+        if isinstance(record, GameInfoRecord):
+            return record.start_time
+    return None
+
+
+def _read_game(type: str, file_location: str,
+               content: Union[bytes, List[TdfRecord], None] = None) -> Optional[ParsedGame]:
+    # runs in the worker processes of bulk_import_tdfs()
+    if type == "sm5":
+        return read_sm5_game(file_location, content)
+    return read_laserball_game(file_location, content)
+
+
+async def _save_game(type: str, file_location: str, parsed: ParsedGame) -> bool:
+    """Saves a game for bulk_import_tdfs(), returns False if it existed already."""
+    if type == "sm5":
+        game = await save_sm5_game(parsed, file_location, update_ratings=False)
+    else:
+        game = await save_laserball_game(parsed, file_location, update_ratings=False)
+
+    return game is parsed.game
+
+
+async def bulk_import_tdfs(workers: Optional[int] = None, batch_size: int = 50) -> BulkImportResult:
+    """
+    Imports every file in the folders of BULK_IMPORT_FOLDERS, like parse_all_tdfs() but faster.
+
+    The files are read by `workers` processes (one per CPU by default) and saved in the order the games started,
+    `batch_size` games per transaction. The next batch is read while one is saved. If a game of a batch can't be
+    saved, the batch is read again and saved one game per transaction, so only the files that fail are left out (see
+    BulkImportResult.failed).
+
+    Ratings are recalculated once all games are saved. The replay goes by start time and then id, and games that
+    started at the same time are saved in the order of their file names like parse_all_tdfs(), so the ratings come
+    out the same as when parsing one file at a time. Nothing is cached, restart the server or flush the cache
+    afterwards.
+    """
+    start = time.perf_counter()
+    result = BulkImportResult()
+
+    files = [(type, os.path.join(folder, name))
+             for type, folder in BULK_IMPORT_FOLDERS.items() if os.path.isdir(folder)
+             for name in sorted(os.listdir(folder)) if is_tdf_file(name)]
+    # start times are "%Y%m%d%H%M%S", so sorting them as strings puts them in chronological order (the sort is stable,
+    # so files of the same time stay in name order)
+    files.sort(key=lambda file: read_start_time(file[1]) or "")
+    result.files = len(files)
+    logger.info(f"Importing {len(files)} files")
+
+    batches = [files[i:i + batch_size] for i in range(0, len(files), batch_size)]
+    imported_types = set()
+    loop = asyncio.get_running_loop()
+
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        def read_batch(batch: List[Tuple[str, str]]) -> Awaitable[List[Union[ParsedGame, None, BaseException]]]:
+            return asyncio.gather(*[loop.run_in_executor(pool, _read_game, type, file_location)
+                                    for type, file_location in batch], return_exceptions=True)
+
+        next_batch = read_batch(batches[0]) if batches else None
+
+        for index, batch in enumerate(batches):
+            parsed_games = await next_batch
+            next_batch = read_batch(batches[index + 1]) if index + 1 < len(batches) else None
+
+            readable = []
+            for (type, file_location), parsed in zip(batch, parsed_games):
+                if isinstance(parsed, BaseException):
+                    logger.error(f"Failed to read {file_location}: {parsed!r}")
+                    result.failed.append(file_location)
+                elif parsed is not None:
+                    readable.append((type, file_location, parsed))
+
+            # the games that were saved and didn't exist already
+            saved = []
+
+            try:
+                async with in_transaction():
+                    for type, file_location, parsed in readable:
+                        if await _save_game(type, file_location, parsed):
+                            saved.append((type, parsed))
+            except Exception as e:
+                # the whole transaction was rolled back and the games read for it already have ids,
+                # so the files are read again and saved one at a time
+                logger.error(f"Failed to save batch {index + 1}, saving its games one at a time: {e!r}")
+                saved = []
+
+                reread_games = await read_batch([(type, file_location) for type, file_location, _ in readable])
+                for (type, file_location, _), parsed in zip(readable, reread_games):
+                    try:
+                        if isinstance(parsed, BaseException):
+                            raise parsed
+                        async with in_transaction():
+                            if parsed is not None and await _save_game(type, file_location, parsed):
+                                saved.append((type, parsed))
+                    except Exception as e:
+                        logger.error(f"Failed to save {file_location}: {e!r}")
+                        result.failed.append(file_location)
+
+            for type, parsed in saved:
+                result.games += 1
+                result.rows += parsed.row_count
+                imported_types.add(type)
+
+            elapsed = time.perf_counter() - start
+            logger.info(f"Imported {result.games} games from {min((index + 1) * batch_size, len(files))}/{len(files)}"
+                        f" files ({result.games / elapsed:.1f} games/s, {result.rows / elapsed:.0f} rows/s)")
+
+    # replay the ratings in the order the games were played
+
+    if "sm5" in imported_types:
+        logger.info("Recalculating sm5 ratings")
+        await ratinghelper.recalculate_sm5_ratings()
+    if "laserball" in imported_types:
+        logger.info("Recalculating laserball ratings")
+        await ratinghelper.recalculate_laserball_ratings()
+
+    result.seconds = time.perf_counter() - start
+
+    return result
+
+
+# key: mission type in the game info of a TDF file, value: game type
+MISSION_TYPES = {
+    5: "sm5",
+    28: "laserball",
+}
+
+
+@dataclass
+class TdfCheck:
+    """What check_tdf() found out about a file."""
+    file_location: str
+    # "sm5" or "laserball", None if it's neither
+    type: Optional[str] = None
+    mission_type: Optional[int] = None
+    # ended early and lasted less than 3 minutes, these aren't imported
+    false_start: bool = False
+    ranked: bool = False
+    unranked_reasons: List[str] = field(default_factory=list)
+    team_sizes: Tuple[int, int] = (0, 0)
+    # key: team name, value: number of players of each role
+    role_counts: Dict[str, Dict[IntRole, int]] = field(default_factory=dict)
+    # key: player name, value: special points at the end of the game (sm5 only, tdf doesn't save them)
+    special_points: Dict[str, int] = field(default_factory=dict)
+    winner_color: str = "none"
+    rows: int = 0
+    # key: phase, value: seconds
+    timings: Dict[str, float] = field(default_factory=dict)
+
+    @property
+    def seconds(self) -> float:
+        return sum(self.timings.values())
+
+
+class _DryRunFinished(Exception):
+    """Raised at the end of check_tdf() to roll back its transaction."""
+
+
+async def check_tdf(file_location: str, content: Optional[bytes] = None) -> TdfCheck:
+    """
+    Goes through everything an upload of a TDF file goes through and reports what would be imported, without keeping
+    anything.
+
+    Each phase is timed: "tokenize" reads the records, "checks" turns them into rows and runs the checks (false start,
+    ranked eligibility, special points), "save" inserts the rows and determines the winner, "summary" computes the
+    game summary, "rating" updates the ratings of the players. The last three run in a transaction of their own that
+    is rolled back at the end, so the database is left as it was, and nothing cached is dropped. Ratings start from the
+    ones of the players in that database.
+    """
+    check = TdfCheck(file_location)
+
+    start = time.perf_counter()
+    records = list(TdfReader(content if content is not None else file_location))
+    check.timings["tokenize"] = time.perf_counter() - start
+
+    check.mission_type = next((record.mission_type for record in records if isinstance(record, GameInfoRecord)), None)
+    check.type = MISSION_TYPES.get(check.mission_type)
+
+    if check.type is None:
+        return check
+
+    start = time.perf_counter()
+    parsed = _read_game(check.type, file_location, records)
+    check.timings["checks"] = time.perf_counter() - start
+
+    if parsed is None:
+        check.false_start = True
+        return check
+
+    game = parsed.game
+    team1, team2 = _get_playing_teams(parsed.teams)
+
+    check.ranked = game.ranked
+    check.unranked_reasons = parsed.unranked_reasons
+    check.team_sizes = (_team_size(parsed.entity_ends, team1), _team_size(parsed.entity_ends, team2))
+    check.role_counts = {team.name: dict(role_counts) for team in parsed.teams
+                         if (role_counts := get_role_counts(parsed.entity_starts, team))}
+    if check.type == "sm5":
+        check.special_points = {stats.entity.name: stats.special_points for stats in parsed.stats}
+    check.rows = parsed.row_count
+
+    try:
+        async with in_transaction():
+            start = time.perf_counter()
+            await persist_game(parsed)
+            await resolve_players(parsed.entity_starts)
+            check.timings["save"] = time.perf_counter() - start
+            check.winner_color = game.winner_color
+
+            start = time.perf_counter()
+            await statshelper.build_game_summary(game)
+            check.timings["summary"] = time.perf_counter() - start
+
+            start = time.perf_counter()
+            if check.type == "sm5":
+                await ratinghelper.update_sm5_ratings(game, invalidate_cache=False)
+            else:
+                await ratinghelper.update_laserball_ratings(game, invalidate_cache=False)
+            check.timings["rating"] = time.perf_counter() - start
+
+            # leaving the transaction with an exception rolls it back
+            raise _DryRunFinished()
+    except _DryRunFinished:
+        pass
+
+    return check
+
+
 def get_arguments_from_event(arguments: list[str]) -> dict[str, str]:
     """Extracts specific semantic arguments from a list of event arguments.
 
@@ -1043,26 +1513,38 @@ def get_arguments_from_event(arguments: list[str]) -> dict[str, str]:
     }
 
 
-async def create_event_from_data(data: list[str]) -> Events:
-    """Creates an Events object from arguments in an events table.
+def event_from_data(data: list[str]) -> Events:
+    """Creates an Events object from arguments in an events table, without saving it.
 
     Args:
         data: All strings in the line of the TDF file that define this event,
             so this should be a list of at least 4 strings (and the first one
             should be "4" to indicate that this is an event).
     """
-    arguments = json.dumps(data[3:])
+    return event_from_record(EventRecord(int(data[1]), EventType(data[2]), data[3:]))
+
 
-    if len(data) < 4:
+def event_from_record(record: EventRecord) -> Events:
+    """Creates an Events object from an event read by TdfReader, without saving it, see event_from_data()."""
+    arguments = json.dumps(record.arguments)
+
+    if not record.arguments:
         # There aren't really any events without arguments, so this is broken.
         # We should alert about that.
-        return await Events.create(time=int(data[1]), type=EventType(data[2]), arguments=arguments)
+        return Events(time=record.time, type=record.type, arguments=arguments)
+
+    semantic_arguments = get_arguments_from_event(record.arguments)
 
-    semantic_arguments = get_arguments_from_event(data[3:])
+    return Events(time=record.time, type=record.type, arguments=arguments,
+                  entity1=semantic_arguments["entity1"], action=semantic_arguments["action"],
+                  entity2=semantic_arguments["entity2"])
 
-    return await Events.create(time=int(data[1]), type=EventType(data[2]), arguments=arguments,
-                               entity1=semantic_arguments["entity1"], action=semantic_arguments["action"],
-                               entity2=semantic_arguments["entity2"])
+
+async def create_event_from_data(data: list[str]) -> Events:
+    """Creates an Events object from arguments in an events table and saves it, see event_from_data()."""
+    event = event_from_data(data)
+    await event.save()
+    return event
 
 
 async def create_event(time_ms: int, type: EventType,
@@ -0,0 +1,234 @@
+"""
+Queue for the TDF files uploaded through /util/upload_tdf.
+
+The upload handler only stores the file in SPOOL_DIRECTORY and adds an UploadJob, so the arena's upload script gets
+its answer right away. run_upload_worker() runs with the server and imports the jobs one at a time, in the order the
+games started, so imports never update the same players concurrently. Every server process calls
+start_upload_worker(), only the one that gets WORKER_LOCK_PATH runs the worker.
+"""
+import asyncio
+import hashlib
+import os
+from typing import Awaitable, Callable, Dict, Optional, Tuple, Type
+from uuid import uuid4
+
+import sentry_sdk
+from sanic.log import logger
+from tortoise import timezone
+from tortoise.exceptions import IntegrityError
+
+from db.game import Game
+from db.laserball import LaserballGame
+from db.sm5 import SM5Game
+from db.upload import UploadJob, UploadStatus
+from helpers.tdfhelper import parse_sm5_game, parse_laserball_game, read_start_time, compress_tdf, get_tdf_path, \
+    COMPRESSED_SUFFIX
+
+SPOOL_DIRECTORY = "tdf_spool"
+WORKER_LOCK_PATH = os.path.join(SPOOL_DIRECTORY, "worker.lock")
+
+# jobs added by other server processes don't set _job_added, so the worker also looks this often (in seconds)
+POLL_INTERVAL = 10
+
+# key: upload type, value: folder the file is kept in, and the function importing it (None if it isn't imported)
+UPLOAD_TYPES: Dict[str, Tuple[str, Optional[Callable[[str], Awaitable[Optional[Game]]]]]] = {
+    "sm5": ("sm5_tdf", parse_sm5_game),
+    "sm5_3team": ("sm5_3team_tdf", None),  # 3 team games are not supported yet
+    "laserball": ("laserball_tdf", parse_laserball_game),
+    "dnd": ("dnd_tdf", None),  # DnD games are not supported yet
+}
+
+# key: upload type, value: the model of the games its jobs import
+GAME_MODELS: Dict[str, Type[Game]] = {
+    "sm5": SM5Game,
+    "laserball": LaserballGame,
+}
+
+# set when a job is added, so the worker doesn't have to wait for the next poll
+_job_added = asyncio.Event()
+
+# the open lock file while this process runs the worker, the lock is released when the process exits
+_worker_lock_file = None
+
+
+async def enqueue_upload(type: str, file_name: str, content: bytes) -> Tuple[UploadJob, bool]:
+    """
+    Stores an uploaded file in the spool directory and adds the job that imports it.
+
+    Returns the job and whether it was added. If the same file was uploaded before, nothing is written and the job of
+    the first upload is returned, unless that job failed or the game it imported was deleted since, then it's queued
+    again.
+    """
+    sha256 = hashlib.sha256(content).hexdigest()
+
+    existing_job = await UploadJob.get_or_none(sha256=sha256)
+    if existing_job is not None and existing_job.status != UploadStatus.FAILED and \
+            not await _is_game_deleted(existing_job):
+        return existing_job, False
+
+    file_name = os.path.basename(file_name)
+
+    os.makedirs(SPOOL_DIRECTORY, exist_ok=True)
+    spool_path = os.path.join(SPOOL_DIRECTORY, f"{uuid4().hex}_{file_name}")
+
+    # write to a temporary file first, the job must not point to a partial file if the server stops
+    with open(spool_path + ".part", "wb") as file:
+        file.write(content)
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(spool_path + ".part", spool_path)
+
+    try:
+        start_time = read_start_time(content)
+    except Exception:
+        # the worker will fail the job with a proper error
+        start_time = None
+
+    if existing_job is not None:
+        existing_job.update_from_dict({"type": type, "file_name": file_name, "spool_path": spool_path,
+                                       "start_time": start_time, "status": UploadStatus.QUEUED, "error": None,
+                                       "game_id": None, "finished_at": None})
+        await existing_job.save()
+        job, created = existing_job, False
+    else:
+        try:
+            job = await UploadJob.create(type=type, file_name=file_name, spool_path=spool_path, start_time=start_time,
+                                         sha256=sha256)
+            created = True
+        except IntegrityError:
+            # the same file was uploaded at the same time
+            os.remove(spool_path)
+            return await UploadJob.get(sha256=sha256), False
+
+    _job_added.set()
+
+    return job, created
+
+
+async def _is_game_deleted(job: UploadJob) -> bool:
+    """Whether the job imported a game that doesn't exist anymore, like one deleted through /admin/game/.../delete."""
+    if job.status != UploadStatus.DONE or job.game_id is None or job.type not in GAME_MODELS:
+        return False
+
+    return not await GAME_MODELS[job.type].exists(id=job.game_id)
+
+
+async def get_queue_position(job: UploadJob) -> Optional[int]:
+    """Returns how many jobs will be processed before this one, or None if it isn't queued anymore."""
+    if job.status != UploadStatus.QUEUED:
+        return None
+
+    queued = await UploadJob.filter(status=UploadStatus.QUEUED).order_by("start_time", "id").values_list("id", flat=True)
+    return queued.index(job.id) if job.id in queued else None
+
+
+async def process_upload(job: UploadJob) -> None:
+    """Moves the file of a job to its folder and imports it. Errors are stored in the job instead of raised."""
+    job.status = UploadStatus.PROCESSING
+    await job.save()
+
+    folder, parse = UPLOAD_TYPES[job.type]
+    target_path = os.path.join(folder, job.file_name)
+
+    try:
+        os.makedirs(folder, exist_ok=True)
+        # the file was moved already if the server stopped while importing it
+        if os.path.exists(job.spool_path):
+            os.replace(job.spool_path, target_path)
+        # files are archived compressed
+        if not target_path.endswith(COMPRESSED_SUFFIX) and os.path.exists(target_path):
+            compress_tdf(target_path)
+
+        game = await parse(get_tdf_path(folder, job.file_name)) if parse else None
+    except Exception as e:
+        logger.exception(f"Failed to process upload job {job.id} ({job.file_name})")
+        sentry_sdk.capture_exception(e)
+
+        job.status = UploadStatus.FAILED
+        job.error = f"{e.__class__.__name__}: {e}"
+    else:
+        job.status = UploadStatus.DONE
+        job.game_id = game.id if game else None
+
+    job.finished_at = timezone.now()
+    await job.save()
+
+
+async def claim_next_job() -> Optional[UploadJob]:
+    """
+    Marks the next queued job as processing and returns it, or None if there is none.
+
+    The job is only changed if it's still queued, so a job is never claimed twice.
+    """
+    while True:
+        job = await UploadJob.filter(status=UploadStatus.QUEUED).order_by("start_time", "id").first()
+        if job is None:
+            return None
+
+        if await UploadJob.filter(id=job.id, status=UploadStatus.QUEUED).update(status=UploadStatus.PROCESSING):
+            job.status = UploadStatus.PROCESSING
+            return job
+
+
+def acquire_worker_lock() -> bool:
+    """Returns whether this process got to run the upload worker. Only one process can hold the lock at a time."""
+    global _worker_lock_file
+
+    if _worker_lock_file is not None:
+        # this process runs it already
+        return False
+
+    os.makedirs(SPOOL_DIRECTORY, exist_ok=True)
+    lock_file = open(WORKER_LOCK_PATH, "a")
+
+    try:
+        if os.name == "nt":
+            import msvcrt
+            msvcrt.locking(lock_file.fileno(), msvcrt.LK_NBLCK, 1)
+        else:
+            import fcntl
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        lock_file.close()
+        return False
+
+    _worker_lock_file = lock_file
+    return True
+
+
+def start_upload_worker(app) -> None:
+    """Starts the upload worker as a task of `app`, unless another server process or this one runs it already."""
+    if acquire_worker_lock():
+        logger.info("Starting the upload worker")
+        app.add_task(run_upload_worker(), name="Upload Worker")
+
+
+async def run_upload_worker() -> None:
+    """Processes queued upload jobs until the server stops. Only run it while holding the worker lock."""
+    try:
+        # jobs that were interrupted are done again, a game is saved in one transaction and existing games are skipped
+        await UploadJob.filter(status=UploadStatus.PROCESSING).update(status=UploadStatus.QUEUED)
+    except Exception as e:
+        logger.exception("Failed to requeue interrupted upload jobs")
+        sentry_sdk.capture_exception(e)
+
+    while True:
+        # clear before looking, so a job added in between wakes us up again
+        _job_added.clear()
+
+        try:
+            job = await claim_next_job()
+            if job is None:
+                try:
+                    await asyncio.wait_for(_job_added.wait(), POLL_INTERVAL)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            logger.info(f"Processing upload job {job.id} ({job.file_name})")
+            await process_upload(job)
+        except Exception as e:
+            # keep the worker running, the database might be back by the next try
+            logger.exception("Upload worker failed to process the queue")
+            sentry_sdk.capture_exception(e)
+            await asyncio.sleep(POLL_INTERVAL)
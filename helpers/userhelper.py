@@ -1,12 +1,18 @@
+import hashlib
 from statistics import median, StatisticsError
 from typing import List, Optional
 
 import bcrypt
+from tortoise.expressions import Q
+from tortoise.functions import Count, Max, Sum
 
 from db.game import EntityEnds, EntityStarts
+from db.laserball import LaserballGame
 from db.player import Player
 from db.sm5 import SM5Game
 from db.types import IntRole
+from helpers.cachehelper import cached_query, entity_tag, TAG_STATS
+from helpers.gamehelper import GAME_VERSION_TTL
 from sanic.log import logger
 
 
@@ -25,12 +31,15 @@ async def get_median_role_score(player: Optional[Player] = None) -> List[int]:
     for role in range(1, 6):
         try:
             if player:
-                score = median(await EntityEnds.filter(entity__entity_id=player.entity_id, entity__role=IntRole(role),
-                                                       entity__sm5games__ranked=True).values_list("score", flat=True))
+                score = median(await cached_query(
+                    EntityEnds.filter(entity__entity_id=player.entity_id, entity__role=IntRole(role),
+                                      entity__sm5games__ranked=True).values_list("score", flat=True),
+                    tags=[entity_tag(player.entity_id)]))
             else:
-                score = median(
-                    await EntityEnds.filter(entity__role=IntRole(role), entity__sm5games__ranked=True).values_list(
-                        "score", flat=True))
+                score = median(await cached_query(
+                    EntityEnds.filter(entity__role=IntRole(role), entity__sm5games__ranked=True).values_list(
+                        "score", flat=True),
+                    tags=[TAG_STATS]))
         except StatisticsError:
             # empty data, no median can be calculated
             score = 0
@@ -60,7 +69,7 @@ async def get_per_role_game_count(player: Player, ranked_only: bool) -> List[int
             else:
                 kwargs["sm5games__mission_name__icontains"] = "space marines"
 
-            game_count = await EntityEnds.filter(**kwargs).count()
+            game_count = await cached_query(EntityEnds.filter(**kwargs).count(), tags=[entity_tag(player.entity_id)])
         except Exception:
             game_count = 0
         data.append(game_count)
@@ -68,6 +77,43 @@ async def get_per_role_game_count(player: Player, ranked_only: bool) -> List[int
     return data
 
 
+async def get_player_etag(id: str) -> Optional[str]:
+    """
+    Returns the ETag for a player's page, or None if there is no such player.
+
+    `id` is looked up like the player page does (player_id, then codename, then entity_id). The page shows ranked and
+    unranked games, so the ETag covers all games of the player: it changes when one is imported (even if it started
+    before the others), deleted or edited.
+    """
+    players = await cached_query(
+        Player.filter(Q(player_id=id) | Q(codename=id) | Q(entity_id=id)).values_list("player_id", "codename",
+                                                                                    "entity_id"),
+        ttl=GAME_VERSION_TTL)
+
+    player = next((player for index in range(3) for player in players if player[index] == id), None)
+    if player is None:
+        return None
+
+    player_id, codename, entity_id = player
+    parts = [player_id, codename]
+
+    for game_class in [SM5Game, LaserballGame]:
+        # edit_version only ever goes up, so its sum changes whenever one of the games is edited, and the count
+        # and last id change with every import (even of a game that started before the others) or deletion
+        games = await cached_query(
+            game_class.filter(entity_starts__entity_id=entity_id)
+            .annotate(count=Count("id"), last_id=Max("id"), versions=Sum("edit_version"))
+            # one group, all rows have that entity_id
+            .group_by("entity_starts__entity_id")
+            .values_list("count", "last_id", "versions"),
+            ttl=GAME_VERSION_TTL, tags=[entity_tag(entity_id)])
+        parts.extend(games[0] if games else ["-", "-", "-"])
+
+    # codenames can contain anything, so they're hashed rather than put into the header as is
+    digest = hashlib.blake2b("|".join(str(part) for part in parts).encode("utf-8"), digest_size=16).hexdigest()
+    return f'"player-{digest}"'
+
+
 def hash_password(password: str) -> str:
     """
     Hashes a password using bcrypt
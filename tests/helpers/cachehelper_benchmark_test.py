@@ -0,0 +1,101 @@
+"""Micro-benchmark for the per-hit overhead of the function cache.
+
+Prints the time a cache hit spends building its key and going through the cache() wrapper, next to the key
+builder that stringified the whole request. Run with `pytest -s` to see the numbers, nothing is asserted about
+them since they depend on the machine.
+"""
+import asyncio
+import timeit
+import unittest
+
+from sanic.log import logger
+from sanic.request import Request
+
+from db.sm5 import SM5Game
+from helpers import cachehelper
+from helpers.cachehelper import BoundedCache, cache, _create_cache_key
+
+ITERATIONS = 20000
+
+
+def _legacy_cache_key(f, args, kwargs) -> str:
+    # the key builder cache() and cache_template() used before, kept here for comparison
+    key = f"{f.__name__}_{args}_{kwargs}"
+    if len(args) > 0 and isinstance(args[0], Request):
+        request: Request = args[0]
+        request_args = request.args
+        request_json = request.json
+        if request_args:
+            key += f"_{request_args}"
+        if request_json:
+            key += f"_{request_json}"
+        logger.debug(
+            f"Creating cache key for {f.__name__} with args: {args} and kwargs: {kwargs}, "
+            f"request_args: {request_args}, request_json: {request_json} => {key}"
+        )
+    else:
+        logger.debug(f"Creating cache key for {f.__name__} with args: {args} and kwargs: {kwargs} => {key}")
+
+    return key
+
+
+def _per_call_micros(statement) -> float:
+    return min(timeit.repeat(statement, number=ITERATIONS, repeat=3)) / ITERATIONS * 1_000_000
+
+
+class TestCacheKeyBenchmark(unittest.TestCase):
+    def setUp(self):
+        self.request = Request(b"/player/Commander?sm5page=1&role=heavy&role=scout", {}, "1.1", "GET", None, None)
+        self.game = SM5Game(id=1, mission_name="Space Marines 5", tdf_name="game.tdf", arena="4-43")
+
+        async def player_get(request, id):
+            pass
+
+        async def get_win_chance(game, timeframe=None):
+            pass
+
+        self.handler = player_get
+        self.function = get_win_chance
+
+    def test_request_key(self):
+        legacy = _per_call_micros(lambda: _legacy_cache_key(self.handler, (self.request,), {"id": "Commander"}))
+        current = _per_call_micros(lambda: _create_cache_key(self.handler, (self.request,), {"id": "Commander"}))
+
+        print(f"\nrequest key: legacy {legacy:.2f}us, current {current:.2f}us")
+
+    def test_model_key(self):
+        legacy = _per_call_micros(lambda: _legacy_cache_key(self.function, (self.game,), {"timeframe": "month"}))
+        current = _per_call_micros(lambda: _create_cache_key(self.function, (self.game,), {"timeframe": "month"}))
+
+        print(f"\nmodel key: legacy {legacy:.2f}us, current {current:.2f}us")
+
+
+class TestCacheHitBenchmark(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self._previous_backend = cachehelper.function_cache
+        cachehelper.set_cache_backends(function_backend=BoundedCache(max_entries=100))
+        cachehelper.function_cache_enabled = True
+
+    async def asyncTearDown(self):
+        cachehelper.function_cache_enabled = False
+        cachehelper.set_cache_backends(function_backend=self._previous_backend)
+
+    async def test_hit_overhead(self):
+        @cache(ttl=60 * 60)
+        async def handler(request, id):
+            return id
+
+        request = Request(b"/player/Commander?sm5page=1", {}, "1.1", "GET", None, None)
+        await handler(request, id="Commander")
+
+        start = asyncio.get_running_loop().time()
+        for _ in range(ITERATIONS):
+            await handler(request, id="Commander")
+        per_hit = (asyncio.get_running_loop().time() - start) / ITERATIONS * 1_000_000
+
+        print(f"\ncache hit: {per_hit:.2f}us")
+        self.assertEqual(ITERATIONS + 1, cachehelper.function_cache.hits + cachehelper.function_cache.misses)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,672 @@
+import asyncio
+import datetime
+import pickle
+import unittest
+import zlib
+
+from sanic.request import Request
+
+from db.sm5 import SM5Game
+from db.types import Team
+from helpers import cachehelper
+from helpers.cachehelper import BoundedCache, EVICTION_LFU, estimate_size, cache, InMemoryRedis, SharedCache, \
+    serialize_cache_value, deserialize_cache_value, add_cache_tags, invalidate, mark_stale, invalidate_game, \
+    game_tag, entity_tag, TAG_STATS, cached_query, cache_template, _create_cache_key, PrecacheScheduler, \
+    get_cache_stats, get_cache_entries, evict
+from tests.helpers.environment import setup_test_database, teardown_test_database, get_sm5_game_id, add_entity, \
+    get_red_team, ENTITY_ID_1
+
+
+class TestBoundedCache(unittest.TestCase):
+    def test_get_counts_hits_and_misses(self):
+        cache = BoundedCache(max_entries=10)
+        cache["a"] = 1
+
+        self.assertEqual(1, cache.get("a"))
+        self.assertIsNone(cache.get("b"))
+        self.assertEqual(1, cache.hits)
+        self.assertEqual(1, cache.misses)
+        self.assertEqual(0.5, cache.hit_ratio)
+
+    def test_lru_evicts_least_recently_used(self):
+        cache = BoundedCache(max_entries=2)
+        cache["a"] = 1
+        cache["b"] = 2
+        cache.get("a")
+        cache["c"] = 3
+
+        self.assertEqual(["a", "c"], sorted(cache.keys()))
+        self.assertEqual(1, cache.evictions)
+
+    def test_lfu_evicts_least_frequently_used(self):
+        cache = BoundedCache(max_entries=2, policy=EVICTION_LFU)
+        cache["a"] = 1
+        cache["b"] = 2
+        cache.get("a")
+        cache.get("a")
+        cache.get("b")
+        cache["c"] = 3
+
+        self.assertEqual(["a", "c"], sorted(cache.keys()))
+
+    def test_byte_budget(self):
+        cache = BoundedCache(max_bytes=100, sizeof=lambda value: value)
+        cache["a"] = 40
+        cache["b"] = 40
+        cache["c"] = 40
+
+        self.assertEqual(["b", "c"], sorted(cache.keys()))
+        self.assertEqual(80, cache.total_bytes)
+
+    def test_entry_larger_than_budget_is_dropped(self):
+        cache = BoundedCache(max_bytes=100, sizeof=lambda value: value)
+        cache["a"] = 500
+
+        self.assertNotIn("a", cache)
+        self.assertEqual(0, cache.total_bytes)
+
+    def test_overwrite_updates_size(self):
+        cache = BoundedCache(max_bytes=100, sizeof=lambda value: value)
+        cache["a"] = 10
+        cache["a"] = 30
+
+        self.assertEqual(30, cache.total_bytes)
+        del cache["a"]
+        self.assertEqual(0, cache.total_bytes)
+
+    def test_estimate_size_counts_nested_values(self):
+        self.assertGreater(estimate_size({"key": ["x" * 1000]}), 1000)
+
+
+class TestCacheDecorator(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self._previous_backend = cachehelper.function_cache
+        cachehelper.set_cache_backends(function_backend=BoundedCache(max_entries=100))
+        cachehelper.function_cache_enabled = True
+        cachehelper.coalesced_waiters = 0
+        cachehelper.coalesced_refreshes = 0
+
+    async def asyncTearDown(self):
+        cachehelper.function_cache_enabled = False
+        cachehelper.set_cache_backends(function_backend=self._previous_backend)
+
+    async def test_concurrent_misses_are_coalesced(self):
+        calls = []
+
+        @cache()
+        async def slow(value):
+            calls.append(value)
+            await asyncio.sleep(0.01)
+            return value * 2
+
+        results = await asyncio.gather(*[slow(21) for _ in range(5)])
+
+        self.assertEqual([42] * 5, results)
+        self.assertEqual(1, len(calls))
+        self.assertEqual(4, cachehelper.coalesced_waiters)
+        self.assertEqual(0, len(cachehelper._inflight))
+
+    async def test_stale_hits_schedule_one_refresh(self):
+        calls = []
+        release = asyncio.Event()
+
+        @cache(ttl=0)
+        async def value():
+            calls.append(1)
+            if len(calls) > 1:
+                await release.wait()
+            return len(calls)
+
+        self.assertEqual(1, await value())
+
+        # every hit is stale (ttl=0), but only one refresh may run at a time
+        for _ in range(3):
+            self.assertEqual(1, await value())
+            await asyncio.sleep(0)
+
+        self.assertEqual(2, len(calls))
+        self.assertEqual(2, cachehelper.coalesced_refreshes)
+
+        release.set()
+        await asyncio.sleep(0.01)
+        self.assertEqual(2, await value())
+
+    async def test_errors_propagate_to_all_waiters(self):
+        @cache()
+        async def broken():
+            await asyncio.sleep(0.01)
+            raise ValueError("broken")
+
+        results = await asyncio.gather(broken(), broken(), return_exceptions=True)
+
+        self.assertTrue(all(isinstance(result, ValueError) for result in results))
+        self.assertEqual(0, len(cachehelper.function_cache))
+
+
+class TestCacheStats(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self._previous_backend = cachehelper.function_cache
+        cachehelper.set_cache_backends(function_backend=BoundedCache(max_entries=100))
+        cachehelper.function_cache_enabled = True
+        cachehelper.function_stats.clear()
+
+    async def asyncTearDown(self):
+        cachehelper.function_cache_enabled = False
+        cachehelper.set_cache_backends(function_backend=self._previous_backend)
+        cachehelper.function_stats.clear()
+
+    async def test_stats_per_function(self):
+        @cache(ttl=60 * 60, tags=[TAG_STATS])
+        async def double(value):
+            return value * 2
+
+        await double(1)
+        await double(1)
+        await double(1)
+        await double(2)
+
+        functions = get_cache_stats()["functions"]
+        self.assertEqual(1, len(functions))
+        name, stats = next(iter(functions.items()))
+        self.assertTrue(name.endswith(".double"))
+        self.assertEqual(2, stats["entries"])
+        self.assertEqual(2, stats["hits"])
+        self.assertEqual(2, stats["misses"])
+        self.assertEqual(0.5, stats["hit_ratio"])
+        self.assertGreater(stats["bytes"], 0)
+
+        entries = get_cache_entries()
+        self.assertEqual(2, len(entries))
+        self.assertTrue(all(entry["cache"] == "function" for entry in entries))
+        self.assertTrue(all(0 <= entry["age"] < 60 for entry in entries))
+        self.assertTrue(all(60 * 59 < entry["ttl_left"] <= 60 * 60 for entry in entries))
+        self.assertEqual([TAG_STATS], entries[0]["tags"])
+
+    async def test_stale_hits_are_counted_separately(self):
+        @cache(ttl=0, refresh_in_background=False)
+        async def value():
+            return 1
+
+        await value()
+        await asyncio.sleep(0.01)
+        await value()
+
+        stats = next(iter(get_cache_stats()["functions"].values()))
+        self.assertEqual([0, 1, 1], [stats["hits"], stats["stale_hits"], stats["misses"]])
+
+    async def test_evict_single_key(self):
+        calls = []
+
+        @cache(ttl=60 * 60)
+        async def value(index):
+            calls.append(index)
+            return index
+
+        await value(1)
+        await value(2)
+
+        key = get_cache_entries()[0]["key"]
+        self.assertTrue(await evict(key))
+        self.assertFalse(await evict(key))
+        self.assertEqual(1, len(get_cache_entries()))
+
+        await value(1)
+        await value(2)
+        self.assertEqual(3, len(calls))
+
+
+class TestSharedCache(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        await setup_test_database()
+        self._previous_backend = cachehelper.function_cache
+        cachehelper.set_cache_backends(function_backend=BoundedCache(max_entries=100))
+        cachehelper.function_cache_enabled = True
+        self.redis = InMemoryRedis()
+        cachehelper.use_shared_cache(self.redis)
+
+    async def asyncTearDown(self):
+        cachehelper.shared_cache = None
+        cachehelper.function_cache_enabled = False
+        cachehelper.set_cache_backends(function_backend=self._previous_backend)
+        await teardown_test_database()
+
+    async def test_plain_data_round_trip(self):
+        value = {
+            Team.RED: [1, 2.5, None],
+            "rendered": (["<p>", ("region", "admin", "<a>"), ("fragment", "login")], "etag"),
+            "start_time": datetime.datetime(2024, 1, 14, 20, 57, 10),
+            (1, "a"): {"nested": True},
+        }
+
+        self.assertEqual(value, deserialize_cache_value(serialize_cache_value(value)))
+
+    async def test_models_are_not_serialized(self):
+        game = await SM5Game.filter(id=get_sm5_game_id()).first()
+
+        with self.assertRaises(TypeError):
+            serialize_cache_value({"game": game})
+
+    async def test_only_plain_data_is_loaded(self):
+        # anything else in redis (like a pickle) is an error, which the shared cache treats as a miss
+        with self.assertRaises(Exception):
+            deserialize_cache_value(zlib.compress(pickle.dumps(Team.RED)))
+        with self.assertRaises(ValueError):
+            deserialize_cache_value(zlib.compress(b'{"__object__": "os.system"}'))
+
+    async def test_invalidated_computation_is_not_shared(self):
+        started = asyncio.Event()
+        release = asyncio.Event()
+
+        @cache(ttl=60, tags=["t"])
+        async def value():
+            started.set()
+            await release.wait()
+            return "old"
+
+        running = asyncio.ensure_future(value())
+        await started.wait()
+        await invalidate("t")
+        release.set()
+        await running
+
+        self.assertEqual(0, cachehelper.shared_cache.writes)
+        self.assertEqual(0, len(cachehelper.function_cache))
+
+    async def test_other_worker_loads_from_shared_cache(self):
+        calls = []
+
+        @cache(ttl=60)
+        async def value(game_id):
+            calls.append(game_id)
+            game = await SM5Game.filter(id=game_id).first()
+            return {"id": game.id, "winner": game.winner, "start_time": game.start_time}
+
+        expected = await value(get_sm5_game_id())
+
+        # a new worker starts with an empty in-process cache
+        cachehelper.set_cache_backends(function_backend=BoundedCache(max_entries=100))
+        restored = await value(get_sm5_game_id())
+
+        self.assertEqual(1, len(calls))
+        self.assertEqual(expected, restored)
+        self.assertEqual(1, cachehelper.shared_cache.hits)
+
+    async def test_precached_functions_are_stored_whole(self):
+        async def total():
+            return 42
+
+        await cachehelper._precache_function(total)
+        entry = await cachehelper.shared_cache.get(cachehelper._create_cache_key(total, (), {}))
+
+        self.assertEqual(42, entry[0])
+
+    async def test_unserializable_values_stay_in_process(self):
+        @cache(ttl=60)
+        async def value():
+            return await SM5Game.filter(id=get_sm5_game_id()).first()
+
+        await value()
+
+        self.assertEqual(1, cachehelper.shared_cache.unserializable)
+        self.assertEqual(1, len(cachehelper.function_cache))
+
+    async def test_redis_errors_are_misses(self):
+        class BrokenRedis(InMemoryRedis):
+            async def get(self, key):
+                raise ConnectionError("redis is down")
+
+        shared = SharedCache(BrokenRedis())
+
+        self.assertIsNone(await shared.get("key"))
+        self.assertEqual(1, shared.errors)
+
+
+class TestCacheTags(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        await setup_test_database()
+        self._previous_backend = cachehelper.function_cache
+        cachehelper.set_cache_backends(function_backend=BoundedCache(max_entries=100))
+        cachehelper.function_cache_enabled = True
+
+    async def asyncTearDown(self):
+        cachehelper.function_cache_enabled = False
+        cachehelper.set_cache_backends(function_backend=self._previous_backend)
+        cachehelper._tag_keys.clear()
+        cachehelper._key_tags.clear()
+        await teardown_test_database()
+
+    async def test_invalidate_drops_only_tagged_entries(self):
+        calls = []
+
+        @cache(ttl=60, tags=lambda value: [f"value:{value}"])
+        async def tagged(value):
+            calls.append(value)
+            return value
+
+        await tagged(1)
+        await tagged(2)
+
+        self.assertEqual(1, await invalidate("value:1"))
+        await tagged(1)
+        await tagged(2)
+
+        self.assertEqual([1, 2, 1], calls)
+
+    async def test_games_passed_as_arguments_are_tags(self):
+        game = await SM5Game.filter(id=get_sm5_game_id()).first()
+
+        @cache(ttl=60)
+        async def by_game(game):
+            return game.id
+
+        await by_game(game)
+        await invalidate_game(game)
+
+        self.assertEqual(0, len(cachehelper.function_cache))
+
+    async def test_entities_of_a_game_are_invalidated_with_it(self):
+        game = await SM5Game.filter(id=get_sm5_game_id()).first()
+        await add_entity(ENTITY_ID_1, get_red_team(), sm5_game=game)
+        entity_id = ENTITY_ID_1
+
+        @cache(ttl=60)
+        async def player_page():
+            add_cache_tags(entity_tag(entity_id))
+            return entity_id
+
+        @cache(ttl=60)
+        async def unrelated():
+            return None
+
+        await player_page()
+        await unrelated()
+        await invalidate_game(game)
+
+        self.assertEqual(1, len(cachehelper.function_cache))
+
+    async def test_mark_stale_keeps_serving_until_refreshed(self):
+        calls = []
+
+        @cache(ttl=60, tags=[TAG_STATS])
+        async def stats():
+            calls.append(1)
+            return len(calls)
+
+        await stats()
+        self.assertEqual(1, await mark_stale(TAG_STATS))
+
+        self.assertEqual(1, await stats())
+        await asyncio.sleep(0.01)
+        self.assertEqual(2, await stats())
+
+    async def test_mark_stale_keeps_the_eviction_order(self):
+        cachehelper.set_cache_backends(function_backend=BoundedCache(max_entries=2))
+        cachehelper.function_cache["stale"] = ("value", 100, 0)
+        cachehelper.function_cache["other"] = ("value", 100, 0)
+        cachehelper._set_tags("stale", [TAG_STATS])
+
+        await mark_stale(TAG_STATS)
+        cachehelper.function_cache["new"] = ("value", 100, 0)
+
+        # "stale" was still the least recently used entry
+        self.assertEqual(["other", "new"], cachehelper.function_cache.keys())
+
+    async def test_invalidate_while_computing(self):
+        data = ["old"]
+        started = asyncio.Event()
+        release = asyncio.Event()
+
+        @cache(ttl=60, tags=["t"])
+        async def value():
+            result = data[0]
+            started.set()
+            await release.wait()
+            return result
+
+        running = asyncio.ensure_future(value())
+        await started.wait()
+
+        data[0] = "new"
+        await invalidate("t")
+        # doesn't wait for the computation that read the old data
+        after = asyncio.ensure_future(value())
+        await asyncio.sleep(0)
+        release.set()
+
+        self.assertEqual("old", await running)
+        self.assertEqual("new", await after)
+        self.assertEqual("new", await value())
+        self.assertEqual({}, cachehelper._generations)
+        self.assertEqual({}, cachehelper._computing_tags)
+
+    async def test_invalidate_tags_added_while_computing(self):
+        data = ["old"]
+        started = asyncio.Event()
+        release = asyncio.Event()
+
+        @cache(ttl=60)
+        async def value():
+            add_cache_tags("t")
+            result = data[0]
+            started.set()
+            await release.wait()
+            return result
+
+        running = asyncio.ensure_future(value())
+        await started.wait()
+        data[0] = "new"
+        await invalidate("t")
+        release.set()
+
+        self.assertEqual("old", await running)
+        self.assertEqual("new", await value())
+
+    async def test_evicted_entries_leave_the_tag_index(self):
+        cachehelper.set_cache_backends(function_backend=BoundedCache(max_entries=1000))
+
+        @cache(ttl=60, tags=lambda value: [f"value:{value}"])
+        async def tagged(value):
+            return value
+
+        for value in range(5000):
+            await tagged(value)
+
+        self.assertEqual(1000, len(cachehelper._key_tags))
+        self.assertNotIn("value:0", cachehelper._tag_keys)
+        self.assertEqual(1, len(cachehelper._tag_keys["value:4999"]))
+
+    async def test_tags_of_nested_cached_functions_propagate(self):
+        @cache(ttl=60)
+        async def inner():
+            add_cache_tags(game_tag("sm5", 1))
+            return 1
+
+        @cache(ttl=60)
+        async def outer():
+            return await inner() + 1
+
+        await outer()
+        await invalidate(game_tag("sm5", 1))
+
+        self.assertEqual(0, len(cachehelper.function_cache))
+
+
+class TestCachedQuery(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        await setup_test_database()
+        self._previous_backend = cachehelper.queryset_cache
+        cachehelper.set_cache_backends(queryset_backend=BoundedCache(max_entries=100))
+        cachehelper.function_cache_enabled = True
+        cachehelper.query_shape_stats.clear()
+        cachehelper._query_expiry.clear()
+
+    async def asyncTearDown(self):
+        cachehelper.function_cache_enabled = False
+        cachehelper.set_cache_backends(queryset_backend=self._previous_backend)
+        cachehelper._tag_keys.clear()
+        cachehelper._key_tags.clear()
+        await teardown_test_database()
+
+    async def test_hits_are_counted_per_query_shape(self):
+        await cached_query(SM5Game.filter(id=get_sm5_game_id()))
+        await cached_query(SM5Game.filter(id=get_sm5_game_id()))
+        await cached_query(SM5Game.filter(id=get_sm5_game_id() + 1))
+
+        self.assertEqual(1, len(cachehelper.query_shape_stats))
+        self.assertEqual([[1, 2]], list(cachehelper.query_shape_stats.values()))
+
+    async def test_callers_get_their_own_instances(self):
+        first = await cached_query(SM5Game.filter(id=get_sm5_game_id()).first())
+        first.mission_name = "changed"
+        second = await cached_query(SM5Game.filter(id=get_sm5_game_id()).first())
+
+        self.assertIsNot(first, second)
+        self.assertNotEqual("changed", second.mission_name)
+
+    async def test_first_and_all_are_different_entries(self):
+        game = await cached_query(SM5Game.filter(id=get_sm5_game_id()).first())
+        games = await cached_query(SM5Game.filter(id=get_sm5_game_id()))
+
+        self.assertIsInstance(game, SM5Game)
+        self.assertEqual([game.id], [g.id for g in games])
+
+    async def test_expired_entries_are_removed(self):
+        await cached_query(SM5Game.filter(id=get_sm5_game_id()), ttl=0)
+        await cached_query(SM5Game.all(), ttl=60)
+
+        self.assertEqual(1, len(cachehelper.queryset_cache))
+        self.assertEqual(1, len(cachehelper._query_expiry))
+
+    async def test_expiring_does_not_count_as_a_use(self):
+        cachehelper.set_cache_backends(queryset_backend=BoundedCache(max_entries=2))
+        cachehelper.queryset_cache["refreshed"] = (None, 100, 0)
+        cachehelper.queryset_cache["other"] = (None, 100, 0)
+        # pushed before "refreshed" got its later expiry
+        cachehelper._query_expiry.append((10, "refreshed"))
+
+        cachehelper._expire_queries(50)
+        cachehelper.queryset_cache["new"] = (None, 100, 0)
+
+        # "refreshed" is still the least recently used entry
+        self.assertEqual(["other", "new"], cachehelper.queryset_cache.keys())
+
+    async def test_tags_invalidate_queries(self):
+        await cached_query(SM5Game.all(), tags=[TAG_STATS])
+        await mark_stale(TAG_STATS)
+
+        self.assertEqual(0, len(cachehelper.queryset_cache))
+
+
+class TestCacheKeys(unittest.TestCase):
+    @staticmethod
+    def _request(url: bytes) -> Request:
+        return Request(url, {}, "1.1", "GET", None, None)
+
+    def test_query_string_is_normalized(self):
+        async def handler(request):
+            pass
+
+        self.assertEqual(_create_cache_key(handler, (self._request(b"/players?page=1&sort=2"),), {}),
+                         _create_cache_key(handler, (self._request(b"/players?sort=2&page=1"),), {}))
+        self.assertNotEqual(_create_cache_key(handler, (self._request(b"/players?page=1"),), {}),
+                            _create_cache_key(handler, (self._request(b"/players?page=2"),), {}))
+
+    def test_only_whitelisted_query_args_count(self):
+        async def handler(request):
+            pass
+
+        cache_template(query_args=("page",))(handler)
+
+        self.assertEqual(_create_cache_key(handler, (self._request(b"/games?page=1"),), {}),
+                         _create_cache_key(handler, (self._request(b"/games?page=1&fbclid=abc"),), {}))
+
+    def test_path_params_and_models_are_part_of_the_key(self):
+        async def game(request, type, id):
+            pass
+
+        request = self._request(b"/game/sm5/1/")
+        self.assertNotEqual(_create_cache_key(game, (request,), {"type": "sm5", "id": 1}),
+                            _create_cache_key(game, (request,), {"type": "sm5", "id": 2}))
+        self.assertEqual(_create_cache_key(game, (SM5Game(id=1),), {}),
+                         _create_cache_key(game, (SM5Game(id=1, mission_name="changed"),), {}))
+
+    def test_keys_have_a_fixed_size(self):
+        async def handler(request):
+            pass
+
+        short = _create_cache_key(handler, ("x",), {})
+        long = _create_cache_key(handler, ("x" * 10000,), {})
+
+        self.assertEqual(len(short), len(long))
+        self.assertTrue(short.startswith(f"{__name__}."))
+
+
+class TestPrecacheScheduler(unittest.IsolatedAsyncioTestCase):
+    async def test_runs_in_priority_order_with_limited_concurrency(self):
+        order = []
+        running = []
+        most_running = []
+
+        def target(name):
+            async def run():
+                running.append(name)
+                most_running.append(len(running))
+                await asyncio.sleep(0.001)
+                running.remove(name)
+                order.append(name)
+            return run
+
+        scheduler = PrecacheScheduler(concurrency=2)
+        scheduler.add(2, "player", target("player"))
+        scheduler.add(1, "game 1", target("game 1"))
+        scheduler.add(0, "index", target("index"))
+        scheduler.add(1, "game 2", target("game 2"))
+        scheduler.add(0, "stats", target("stats"))
+        await scheduler.run()
+
+        self.assertEqual({"index", "stats"}, set(order[:2]))
+        self.assertEqual({"game 1", "game 2"}, set(order[2:4]))
+        self.assertEqual("player", order[4])
+        self.assertEqual(2, max(most_running))
+
+    async def test_progress_and_failures(self):
+        async def broken():
+            raise ValueError("broken")
+
+        async def fine():
+            pass
+
+        scheduler = PrecacheScheduler()
+        scheduler.add(0, "broken", broken)
+        scheduler.add(0, "fine", fine)
+        await scheduler.run()
+
+        progress = scheduler.get_progress()
+        self.assertEqual(2, progress["done"])
+        self.assertEqual(1, progress["failed"])
+        self.assertTrue(progress["finished"])
+        self.assertEqual(["broken", "fine"], [timing["name"] for timing in progress["timings"]])
+
+    async def test_cancel(self):
+        started = []
+
+        async def slow():
+            started.append(1)
+            await asyncio.sleep(10)
+
+        scheduler = PrecacheScheduler(concurrency=1)
+        for i in range(3):
+            scheduler.add(0, f"slow {i}", slow)
+
+        task = asyncio.ensure_future(scheduler.run())
+        await asyncio.sleep(0.01)
+        scheduler.cancel()
+
+        with self.assertRaises(asyncio.CancelledError):
+            await task
+        self.assertEqual(1, len(started))
+        self.assertTrue(scheduler.get_progress()["cancelled"])
+
+
+if __name__ == '__main__':
+    unittest.main()
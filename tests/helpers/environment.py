@@ -79,7 +79,7 @@ async def setup_test_database(basic_events: bool = True):
 
     await Tortoise.init(db_url="sqlite://:memory:",
                         modules={
-                            "models": ["db.game", "db.laserball", "db.legacy", "db.player", "db.sm5", "aerich.models"]})
+                            "models": ["db.game", "db.laserball", "db.legacy", "db.player", "db.sm5", "db.upload", "aerich.models"]})
 
     await Tortoise.generate_schemas()
 
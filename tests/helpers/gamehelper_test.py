@@ -3,10 +3,12 @@ import unittest
 from sanic import exceptions
 
 from db.types import Team
+from db.laserball import LaserballGame
+from db.sm5 import SM5Game
 from helpers.gamehelper import get_players_from_team, get_team_rosters, PlayerInfo, get_player_display_names, \
-    get_matchmaking_teams
+    get_matchmaking_teams, get_game_etag
 from tests.helpers.environment import setup_test_database, teardown_test_database, add_entity, get_red_team, \
-    get_green_team, get_blue_team
+    get_green_team, get_blue_team, get_sm5_game_id, get_laserball_game_id
 
 
 class TestGameHelper(unittest.IsolatedAsyncioTestCase):
@@ -113,6 +115,25 @@ class TestGameHelper(unittest.IsolatedAsyncioTestCase):
         with self.assertRaises(exceptions.ServerError):
             await get_matchmaking_teams(roster)
 
+    async def test_get_game_etag_changes_with_edits(self):
+        game = await SM5Game.filter(id=get_sm5_game_id()).first()
+        etag = await get_game_etag("sm5", game.id)
+
+        self.assertEqual(etag, await get_game_etag("sm5", game.id))
+        self.assertNotEqual(etag, await get_game_etag("laserball", game.id))
+
+        await game.mark_edited()
+
+        self.assertEqual(1, (await SM5Game.filter(id=game.id).first()).edit_version)
+        self.assertNotEqual(etag, await get_game_etag("sm5", game.id))
+
+    async def test_get_game_etag_unknown_game(self):
+        laserball_game = await LaserballGame.filter(id=get_laserball_game_id()).first()
+
+        self.assertIsNotNone(await get_game_etag("laserball", laserball_game.id))
+        self.assertIsNone(await get_game_etag("laserball", laserball_game.id + 1))
+        self.assertIsNone(await get_game_etag("sm4", laserball_game.id))
+
 
 if __name__ == '__main__':
     unittest.main()
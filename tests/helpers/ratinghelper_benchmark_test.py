@@ -0,0 +1,53 @@
+"""Benchmark for the one on one rating updates.
+
+Prints the events per second of rate_1v1_events() next to calling model.rate() for every event, which is how the event
+updates were done before. Run with `pytest -s` to see the numbers, nothing is asserted about them since they depend on
+the machine.
+"""
+import random
+import time
+import unittest
+
+from helpers.ratinghelper import MU, SIGMA, model, Rating, rate_1v1_events
+
+PLAYERS = 50
+EVENTS = 20000
+
+
+def _openskill_events(mu: list, sigma: list, events: list) -> None:
+    # how the event updates used openskill before, kept here for comparison
+    for winner, loser, winner_weight_mu, winner_weight_sigma, loser_weight_mu, loser_weight_sigma in events:
+        out = model.rate([[Rating(mu[winner], sigma[winner])], [Rating(mu[loser], sigma[loser])]], ranks=[0, 1])
+
+        mu[winner] += (out[0][0].mu - mu[winner]) * winner_weight_mu
+        sigma[winner] += (out[0][0].sigma - sigma[winner]) * winner_weight_sigma
+        mu[loser] += (out[1][0].mu - mu[loser]) * loser_weight_mu
+        sigma[loser] += (out[1][0].sigma - sigma[loser]) * loser_weight_sigma
+
+
+class TestOneOnOneBenchmark(unittest.TestCase):
+    def test_events_per_second(self):
+        rng = random.Random(0)
+        events = []
+        for _ in range(EVENTS):
+            winner, loser = rng.sample(range(PLAYERS), 2)
+            events.append((winner, loser, 0.02, 0.01, 0.02, 0.01))
+
+        legacy_mu, legacy_sigma = [MU] * PLAYERS, [SIGMA] * PLAYERS
+        start = time.perf_counter()
+        _openskill_events(legacy_mu, legacy_sigma, events)
+        legacy_rate = EVENTS / (time.perf_counter() - start)
+
+        mu, sigma = [MU] * PLAYERS, [SIGMA] * PLAYERS
+        start = time.perf_counter()
+        rate_1v1_events(mu, sigma, events)
+        current_rate = EVENTS / (time.perf_counter() - start)
+
+        print(f"\n{EVENTS} events: openskill {legacy_rate:.0f} events/s, rate_1v1_events {current_rate:.0f} events/s")
+
+        for value, legacy_value in zip(mu + sigma, legacy_mu + legacy_sigma):
+            self.assertAlmostEqual(legacy_value, value, delta=1e-9)
+
+
+if __name__ == '__main__':
+    unittest.main()
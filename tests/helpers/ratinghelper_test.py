@@ -0,0 +1,504 @@
+import datetime
+import random
+import unittest
+
+from db.game import EntityEnds
+from db.laserball import LaserballGame
+from db.player import Player
+from db.sm5 import SM5Game
+from db.types import IntRole, GameType, EventType
+from helpers import ratinghelper, userhelper
+from helpers.ratinghelper import MU, SIGMA, SM5_HIT_WEIGHT_MU, SM5_HIT_WEIGHT_SIGMA, SM5_HIT_MEDIC_WEIGHT_MU, \
+    SM5_HIT_MEDIC_WEIGHT_SIGMA, SM5_MISSILE_WEIGHT_MU, SM5_MISSILE_WEIGHT_SIGMA, SM5_MISSILE_MEDIC_WEIGHT_MU, \
+    SM5_MISSILE_MEDIC_WEIGHT_SIGMA, SM5_ROLE_WEIGHT_MULTIPLIERS, LB_STEAL_WEIGHT_MU, LB_STEAL_WEIGHT_SIGMA, \
+    LB_GOAL_WEIGHT_MU, LB_GOAL_WEIGHT_SIGMA, recalculate_sm5_ratings, recalculate_laserball_ratings, \
+    update_sm5_ratings, update_laserball_ratings, SM5_RATING_FIELDS, LASERBALL_RATING_FIELDS, model, Rating, rate_1v1, \
+    rate_against_self, rate_1v1_events, correct_ratings, correct_ratings_from
+from helpers.tdfhelper import read_sm5_game, read_laserball_game, save_sm5_game, save_laserball_game
+from tests.helpers.environment import setup_test_database, teardown_test_database, get_test_data_path
+
+ENTITY_END_FIELDS = ["previous_rating_mu", "previous_rating_sigma", "current_rating_mu", "current_rating_sigma",
+                     "current_role_rating_mu", "current_role_rating_sigma"]
+
+LASERBALL_LINES = [
+    "1\t28\tLaserball\t20240114205710\t900000",
+    "2\t0\tFire Team\t11\tFire",
+    "2\t1\tEarth Team\t12\tEarth",
+    "2\t2\tNeutral\t0\tNone",
+    "3\t0\t#a\tplayer\tA\t0\t0\t0\tSuit1",
+    "3\t0\t#b\tplayer\tB\t0\t0\t0\tSuit2",
+    "3\t0\t#c\tplayer\tC\t1\t0\t0\tSuit3",
+    "3\t0\t#d\tplayer\tD\t1\t0\t0\tSuit4",
+    "4\t1000\t1105\t* Round Start *",
+    "4\t2000\t1100\t#a\t passes to \t#b",
+    "4\t3000\t1101\t#b\t scores!",
+    "4\t4000\t1105\t* Round Start *",
+    "4\t5000\t1100\t#c\t passes to \t#d",
+    "4\t6000\t1103\t#a\t steals from \t#d",
+    "4\t6000\t1103\t#c\t steals from \t#a",
+    "4\t7000\t1101\t#c\t scores!",
+    "4\t8000\t1105\t* Round Start *",
+    "4\t9000\t1103\t#b\t steals from \t#c",
+    "4\t10000\t1101\t#b\t scores!",
+    "4\t900000\t0101\t* Mission End *",
+    "6\t900000\t#a\t2\t0",
+    "6\t900000\t#b\t2\t0",
+    "6\t900000\t#c\t2\t0",
+    "6\t900000\t#d\t2\t0",
+]
+
+
+# the per game updates as they were before the replay, one query per event and openskill for every rate call.
+# kept here unchanged (except for ordering events with the same time by id) so the new code is compared against
+# them and not against itself
+
+
+def _original_update_sm5_player(player: Player, role: IntRole, general: Rating, role_rating: Rating,
+                                weight_mu: float, weight_sigma: float) -> None:
+    player.sm5_mu += (general.mu - player.sm5_mu) * weight_mu
+    player.sm5_sigma += (general.sigma - player.sm5_sigma) * weight_sigma
+
+    role_weight_mu, role_weight_sigma = SM5_ROLE_WEIGHT_MULTIPLIERS[role]
+    role_name = str(role).lower()
+
+    setattr(player, f"{role_name}_mu", getattr(player, f"{role_name}_mu") + (role_rating.mu - getattr(player, f"{role_name}_mu")) * weight_mu * role_weight_mu)
+    setattr(player, f"{role_name}_sigma", getattr(player, f"{role_name}_sigma") + (role_rating.sigma - getattr(player, f"{role_name}_sigma")) * weight_sigma * role_weight_sigma)
+
+
+async def _original_update_sm5_ratings(game: SM5Game) -> None:
+    for entity_end in await game.entity_ends.filter(entity__type="player", entity__entity_id__startswith="#"):
+        player = await Player.filter(entity_id=(await entity_end.entity).entity_id).first()
+        entity_end.previous_rating_mu = player.sm5_mu
+        entity_end.previous_rating_sigma = player.sm5_sigma
+        await entity_end.save()
+
+    events = await game.events.filter(type__in=[EventType.DAMAGED_OPPONENT, EventType.DOWNED_OPPONENT,
+                                                EventType.MISSILE_DAMAGE_OPPONENT, EventType.MISSILE_DOWN_OPPONENT,
+                                                EventType.RESUPPLY_LIVES, EventType.RESUPPLY_AMMO]
+                                      ).order_by("time", "id")
+
+    for event in events:
+        if "@" in event.arguments[0] or "@" in event.arguments[2]:
+            continue
+        match event.type:
+            case EventType.DAMAGED_OPPONENT | EventType.DOWNED_OPPONENT:
+                weights = (SM5_HIT_WEIGHT_MU, SM5_HIT_WEIGHT_SIGMA, SM5_HIT_MEDIC_WEIGHT_MU, SM5_HIT_MEDIC_WEIGHT_SIGMA)
+            case EventType.MISSILE_DAMAGE_OPPONENT | EventType.MISSILE_DOWN_OPPONENT:
+                weights = (SM5_MISSILE_WEIGHT_MU, SM5_MISSILE_WEIGHT_SIGMA, SM5_MISSILE_MEDIC_WEIGHT_MU,
+                           SM5_MISSILE_MEDIC_WEIGHT_SIGMA)
+            case _:
+                continue
+
+        shooter = await userhelper.player_from_token(game, event.arguments[0])
+        shooter_player = await Player.filter(entity_id=shooter.entity_id).first()
+        target = await userhelper.player_from_token(game, event.arguments[2])
+        target_player = await Player.filter(entity_id=target.entity_id).first()
+
+        general_out = model.rate([[shooter_player.sm5_rating], [target_player.sm5_rating]], ranks=[0, 1])
+        role_out = model.rate([[shooter_player.get_role_rating(shooter.role)],
+                               [target_player.get_role_rating(target.role)]], ranks=[0, 1])
+
+        weight_mu, weight_sigma = weights[:2]
+        if target.role == IntRole.MEDIC:
+            weight_mu, weight_sigma = weights[2:]
+
+        _original_update_sm5_player(shooter_player, shooter.role, general_out[0][0], role_out[0][0],
+                                    weight_mu, weight_sigma)
+        # don't penalize medics extra just for being medic
+        _original_update_sm5_player(target_player, target.role, general_out[1][0], role_out[1][0], *weights[:2])
+
+        await shooter_player.save()
+        await target_player.save()
+
+    await _original_rate_teams(game, "sm5")
+
+    for entity_end in await game.entity_ends.filter(entity__type="player"):
+        entity_start = await entity_end.entity
+        player = await Player.filter(entity_id=entity_start.entity_id).first()
+
+        entity_end.current_rating_mu = player.sm5_mu
+        entity_end.current_rating_sigma = player.sm5_sigma
+        entity_end.current_role_rating_mu = player.get_role_rating(entity_start.role).mu
+        entity_end.current_role_rating_sigma = player.get_role_rating(entity_start.role).sigma
+        await entity_end.save()
+
+    await game.mark_edited()
+
+
+async def _original_update_laserball_ratings(game: LaserballGame) -> None:
+    for entity_end in await game.entity_ends.filter(entity__type="player"):
+        player = await Player.filter(entity_id=(await entity_end.entity).entity_id).first()
+        entity_end.previous_rating_mu = player.laserball_mu
+        entity_end.previous_rating_sigma = player.laserball_sigma
+        await entity_end.save()
+
+    events = await game.events.filter(type__in=[EventType.STEAL, EventType.GOAL, EventType.ASSIST]
+                                      ).order_by("time", "id")
+
+    for event in events:
+        if "@" in event.arguments[0] or (len(event.arguments) > 3) and "@" in event.arguments[2]:
+            continue
+        match event.type:
+            case EventType.STEAL:
+                stealer = await userhelper.player_from_token(game, event.arguments[0])
+                stealer_player = await Player.filter(entity_id=stealer.entity_id).first()
+                stolen = await userhelper.player_from_token(game, event.arguments[2])
+                stolen_player = await Player.filter(entity_id=stolen.entity_id).first()
+
+                out = model.rate([[Rating(stealer_player.laserball_mu, stealer_player.laserball_sigma)],
+                                  [Rating(stolen_player.laserball_mu, stolen_player.laserball_sigma)]], ranks=[0, 1])
+
+                stealer_player.laserball_mu += (out[0][0].mu - stealer_player.laserball_mu) * LB_STEAL_WEIGHT_MU
+                stealer_player.laserball_sigma += (out[0][0].sigma - stealer_player.laserball_sigma) * LB_STEAL_WEIGHT_SIGMA
+                stolen_player.laserball_mu += (out[1][0].mu - stolen_player.laserball_mu) * LB_STEAL_WEIGHT_MU
+                stolen_player.laserball_sigma += (out[1][0].sigma - stolen_player.laserball_sigma) * LB_STEAL_WEIGHT_SIGMA
+
+                await stealer_player.save()
+                await stolen_player.save()
+            case EventType.GOAL:
+                scorer = await userhelper.player_from_token(game, event.arguments[0])
+                scorer_player = await Player.filter(entity_id=scorer.entity_id).first()
+                scorer_elo = Rating(scorer_player.laserball_mu, scorer_player.laserball_sigma)
+
+                out = model.rate([[scorer_elo], [scorer_elo]], ranks=[0, 1])
+
+                scorer_player.laserball_mu += (out[0][0].mu - scorer_player.laserball_mu) * LB_GOAL_WEIGHT_MU
+                scorer_player.laserball_sigma += (out[0][0].sigma - scorer_player.laserball_sigma) * LB_GOAL_WEIGHT_SIGMA
+
+                await scorer_player.save()
+            # assists were rated on a copy of the ratings that was never saved
+
+    await _original_rate_teams(game, "laserball")
+
+    for entity_end in await game.entity_ends.filter(entity__type="player"):
+        player = await Player.filter(entity_id=(await entity_end.entity).entity_id).first()
+        entity_end.current_rating_mu = player.laserball_mu
+        entity_end.current_rating_sigma = player.laserball_sigma
+        await entity_end.save()
+
+    await game.mark_edited()
+
+
+async def _original_rate_teams(game, mode: str) -> None:
+    team1 = []
+    team2 = []
+
+    teams = await game.get_teams()
+
+    for player in await game.entity_starts.filter(type="player"):
+        if (await player.team).color_name == teams[0].color_name:
+            team1.append(await Player.filter(entity_id=player.entity_id).first())
+        else:
+            team2.append(await Player.filter(entity_id=player.entity_id).first())
+
+    team1_elo = [Rating(getattr(x, f"{mode}_mu"), getattr(x, f"{mode}_sigma")) for x in team1]
+    team2_elo = [Rating(getattr(x, f"{mode}_mu"), getattr(x, f"{mode}_sigma")) for x in team2]
+
+    if game.winner == teams[0].enum:
+        team1_new, team2_new = model.rate([team1_elo, team2_elo], ranks=[0, 1])
+    else:
+        team1_new, team2_new = model.rate([team1_elo, team2_elo], ranks=[1, 0])
+
+    for player, rating in zip(team1 + team2, team1_new + team2_new):
+        setattr(player, f"{mode}_mu", rating.mu)
+        setattr(player, f"{mode}_sigma", rating.sigma)
+        await player.save()
+
+
+async def _legacy_recalculate_sm5_ratings() -> None:
+    # how recalculate_sm5_ratings() worked before the replay, kept here for comparison
+    await Player.all().update(**{field: MU if field.endswith("mu") else SIGMA for field in SM5_RATING_FIELDS})
+
+    for game in await SM5Game.all().order_by("start_time", "id"):
+        if game.ranked:
+            await _original_update_sm5_ratings(game)
+        else:
+            for entity_end in await game.entity_ends.filter(entity__type="player", entity__entity_id__startswith="#"):
+                player = await Player.filter(entity_id=(await entity_end.entity).entity_id).first()
+
+                if not player:
+                    continue
+
+                entity_end.previous_rating_mu = player.sm5_mu
+                entity_end.previous_rating_sigma = player.sm5_sigma
+                entity_end.current_rating_mu = player.sm5_mu
+                entity_end.current_rating_sigma = player.sm5_sigma
+
+                await entity_end.save()
+
+
+async def _legacy_recalculate_laserball_ratings() -> None:
+    await Player.all().update(laserball_mu=MU, laserball_sigma=SIGMA)
+
+    for game in await LaserballGame.all().order_by("start_time", "id"):
+        if game.ranked:
+            await _original_update_laserball_ratings(game)
+        else:
+            for entity_end in await game.entity_ends.filter(entity__type="player", entity__entity_id__startswith="#"):
+                player = await Player.filter(entity_id=(await entity_end.entity).entity_id).first()
+
+                entity_end.previous_rating_mu = player.laserball_mu
+                entity_end.previous_rating_sigma = player.laserball_sigma
+                entity_end.current_rating_mu = player.laserball_mu
+                entity_end.current_rating_sigma = player.laserball_sigma
+
+                await entity_end.save()
+
+
+async def _snapshot(game_model, player_fields: list) -> tuple:
+    players = await Player.all().order_by("id").values_list("entity_id", *player_fields)
+    entity_ends = await EntityEnds.all().order_by("id").values_list("id", *ENTITY_END_FIELDS)
+    edit_versions = await game_model.all().order_by("id").values_list("id", "edit_version")
+    return players, entity_ends, edit_versions
+
+
+class TestRatingHelper(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        await setup_test_database()
+
+        # the test games don't have everything a rated game needs
+        await SM5Game.all().update(ranked=False)
+        await LaserballGame.all().update(ranked=False)
+
+    async def asyncTearDown(self):
+        await teardown_test_database()
+
+    async def test_recalculate_sm5_ratings_matches_per_game_updates(self):
+        for day in range(3):
+            parsed = read_sm5_game(get_test_data_path("sm5_game1.tdf"))
+            parsed.game.start_time += datetime.timedelta(days=day)
+            parsed.game.ranked = day != 1
+            await save_sm5_game(parsed, f"sm5_game{day}.tdf", update_ratings=False)
+
+        await _legacy_recalculate_sm5_ratings()
+        expected = await _snapshot(SM5Game, SM5_RATING_FIELDS)
+
+        await EntityEnds.all().update(**{field: None for field in ENTITY_END_FIELDS})
+        await recalculate_sm5_ratings()
+        players, entity_ends, edit_versions = await _snapshot(SM5Game, SM5_RATING_FIELDS)
+
+        # floats are compared exactly, the replay has to do the same operations in the same order
+        self.assertEqual(expected[0], players)
+        self.assertEqual(expected[1], entity_ends)
+        self.assertEqual([(id, version * 2) for id, version in expected[2]], edit_versions)
+
+        player = await Player.filter(entity_id="#heiKvCz").first()
+        self.assertNotEqual(MU, player.sm5_mu)
+        self.assertNotEqual(MU, player.get_role_rating(IntRole.COMMANDER).mu)
+
+    async def test_recalculate_laserball_ratings_matches_per_game_updates(self):
+        for day in range(3):
+            parsed = read_laserball_game("laserball.tdf", "\n".join(LASERBALL_LINES).encode("utf-16"))
+            parsed.game.start_time += datetime.timedelta(days=day)
+            await save_laserball_game(parsed, f"laserball{day}.tdf", update_ratings=False)
+
+        games = await LaserballGame.filter(tdf_name="laserball.tdf").order_by("start_time")
+        self.assertTrue(games[0].ranked)
+        await LaserballGame.filter(id=games[1].id).update(ranked=False)
+
+        await _legacy_recalculate_laserball_ratings()
+        expected = await _snapshot(LaserballGame, LASERBALL_RATING_FIELDS)
+
+        await EntityEnds.all().update(**{field: None for field in ENTITY_END_FIELDS})
+        await recalculate_laserball_ratings()
+        players, entity_ends, edit_versions = await _snapshot(LaserballGame, LASERBALL_RATING_FIELDS)
+
+        self.assertEqual(expected[0], players)
+        self.assertEqual(expected[1], entity_ends)
+        self.assertEqual([(id, version * 2) for id, version in expected[2]], edit_versions)
+        self.assertNotEqual(MU, (await Player.filter(entity_id="#b").first()).laserball_mu)
+
+    async def test_update_sm5_ratings(self):
+        parsed = read_sm5_game(get_test_data_path("sm5_game1.tdf"))
+        game = await save_sm5_game(parsed, "sm5_game1.tdf", update_ratings=False)
+
+        self.assertFalse(await update_sm5_ratings(await SM5Game.filter(ranked=False).first()))
+        self.assertTrue(await update_sm5_ratings(game))
+
+        self.assertEqual(1, (await SM5Game.get(id=game.id)).edit_version)
+        for entity_end in await game.entity_ends.filter(entity__type="player").prefetch_related("entity"):
+            player = await Player.filter(entity_id=entity_end.entity.entity_id).first()
+            # new players start with the field defaults
+            self.assertEqual(MU, entity_end.previous_rating_mu)
+            self.assertNotEqual(entity_end.previous_rating_mu, entity_end.current_rating_mu)
+            self.assertEqual((player.sm5_mu, player.sm5_sigma),
+                             (entity_end.current_rating_mu, entity_end.current_rating_sigma))
+            self.assertEqual(player.get_role_rating(entity_end.entity.role).mu, entity_end.current_role_rating_mu)
+
+    async def test_update_ratings_match_original(self):
+        sm5_game = await save_sm5_game(read_sm5_game(get_test_data_path("sm5_game1.tdf")), "sm5_game1.tdf",
+                                       update_ratings=False)
+        laserball_game = await save_laserball_game(
+            read_laserball_game("laserball.tdf", "\n".join(LASERBALL_LINES).encode("utf-16")), "laserball.tdf",
+            update_ratings=False)
+        fields = SM5_RATING_FIELDS + LASERBALL_RATING_FIELDS
+        reset = {field: MU if field.endswith("mu") else SIGMA for field in fields}
+
+        await Player.all().update(**reset)
+        await _original_update_sm5_ratings(sm5_game)
+        await _original_update_laserball_ratings(laserball_game)
+        expected = (await _snapshot(SM5Game, fields))[:2]
+
+        await Player.all().update(**reset)
+        await EntityEnds.all().update(**{field: None for field in ENTITY_END_FIELDS})
+
+        self.assertTrue(await update_sm5_ratings(sm5_game))
+        self.assertTrue(await update_laserball_ratings(laserball_game))
+
+        self.assertEqual(expected, (await _snapshot(SM5Game, fields))[:2])
+
+    async def test_correct_ratings_matches_recalculation(self):
+        for day in range(4):
+            parsed = read_sm5_game(get_test_data_path("sm5_game1.tdf"))
+            parsed.game.start_time += datetime.timedelta(days=day)
+            await save_sm5_game(parsed, f"sm5_game{day}.tdf", update_ratings=False)
+        await recalculate_sm5_ratings()
+
+        games = await SM5Game.filter(ranked=True).order_by("start_time")
+        await SM5Game.filter(id=games[1].id).update(ranked=False)
+
+        # the game itself and everything after it, they all have the same players
+        self.assertEqual(3, await correct_ratings(await SM5Game.get(id=games[1].id)))
+        corrected = await _snapshot(SM5Game, SM5_RATING_FIELDS)
+
+        await recalculate_sm5_ratings()
+        expected = await _snapshot(SM5Game, SM5_RATING_FIELDS)
+
+        self.assertEqual(expected[0], corrected[0])
+        self.assertEqual(expected[1], corrected[1])
+
+    async def test_import_older_game(self):
+        for day in [0, 2, 1]:
+            parsed = read_sm5_game(get_test_data_path("sm5_game1.tdf"))
+            parsed.game.start_time += datetime.timedelta(days=day)
+            await save_sm5_game(parsed, f"sm5_game{day}.tdf")
+        imported = await _snapshot(SM5Game, SM5_RATING_FIELDS)
+
+        await recalculate_sm5_ratings()
+        expected = await _snapshot(SM5Game, SM5_RATING_FIELDS)
+
+        self.assertEqual(expected[0], imported[0])
+        self.assertEqual(expected[1], imported[1])
+
+    async def test_correct_ratings_only_replays_affected_games(self):
+        other_players = [line.replace("#", "#other").replace("\tplayer\t", "\tplayer\tOther") for line in LASERBALL_LINES]
+        for day, lines in enumerate([LASERBALL_LINES, other_players, LASERBALL_LINES, other_players]):
+            parsed = read_laserball_game("laserball.tdf", "\n".join(lines).encode("utf-16"))
+            parsed.game.start_time += datetime.timedelta(days=day)
+            await save_laserball_game(parsed, f"laserball{day}.tdf", update_ratings=False)
+        await recalculate_laserball_ratings()
+
+        games = await LaserballGame.filter(tdf_name="laserball.tdf").order_by("start_time")
+        await LaserballGame.filter(id=games[0].id).update(ranked=False)
+
+        self.assertEqual(2, await correct_ratings(await LaserballGame.get(id=games[0].id)))
+        corrected = await _snapshot(LaserballGame, LASERBALL_RATING_FIELDS)
+
+        await recalculate_laserball_ratings()
+        expected = await _snapshot(LaserballGame, LASERBALL_RATING_FIELDS)
+
+        self.assertEqual(expected[0], corrected[0])
+        self.assertEqual(expected[1], corrected[1])
+
+    async def test_correct_ratings_after_deleting_last_game(self):
+        for day in range(2):
+            parsed = read_laserball_game("laserball.tdf", "\n".join(LASERBALL_LINES).encode("utf-16"))
+            parsed.game.start_time += datetime.timedelta(days=day)
+            await save_laserball_game(parsed, f"laserball{day}.tdf", update_ratings=False)
+        await recalculate_laserball_ratings()
+
+        first, last = await LaserballGame.filter(tdf_name="laserball.tdf").order_by("start_time")
+        entity_ids = await last.entity_starts.filter(type="player").values_list("entity_id", flat=True)
+        await last.delete()
+
+        self.assertEqual(0, await correct_ratings_from(GameType.LASERBALL, last.start_time, last.id, entity_ids))
+
+        entity_end = await first.entity_ends.filter(entity__entity_id="#b").first()
+        player = await Player.filter(entity_id="#b").first()
+        self.assertEqual((entity_end.current_rating_mu, entity_end.current_rating_sigma),
+                         (player.laserball_mu, player.laserball_sigma))
+
+    async def test_replay_spans_batches(self):
+        for day in range(3):
+            parsed = read_sm5_game(get_test_data_path("sm5_game1.tdf"))
+            parsed.game.start_time += datetime.timedelta(days=day)
+            await save_sm5_game(parsed, f"sm5_game{day}.tdf", update_ratings=False)
+
+        await recalculate_sm5_ratings()
+        expected = await _snapshot(SM5Game, SM5_RATING_FIELDS)
+
+        batch_size = ratinghelper._REPLAY_BATCH_SIZE
+        ratinghelper._REPLAY_BATCH_SIZE = 1
+        try:
+            await recalculate_sm5_ratings()
+        finally:
+            ratinghelper._REPLAY_BATCH_SIZE = batch_size
+
+        players, entity_ends, _ = await _snapshot(SM5Game, SM5_RATING_FIELDS)
+        self.assertEqual(expected[0], players)
+        self.assertEqual(expected[1], entity_ends)
+
+
+class TestOneOnOneRatings(unittest.TestCase):
+    def test_rate_1v1_matches_openskill(self):
+        rng = random.Random(5)
+        for _ in range(1000):
+            winner = (rng.uniform(0, 50), rng.uniform(0.1, 10))
+            loser = (rng.uniform(0, 50), rng.uniform(0.1, 10))
+
+            out = model.rate([[Rating(*winner)], [Rating(*loser)]], ranks=[0, 1])
+            expected = (out[0][0].mu, out[0][0].sigma, out[1][0].mu, out[1][0].sigma)
+
+            for value, expected_value in zip(rate_1v1(*winner, *loser), expected):
+                self.assertAlmostEqual(expected_value, value, delta=1e-9)
+
+    def test_rate_against_self_matches_openskill(self):
+        rng = random.Random(5)
+        for _ in range(1000):
+            rating = Rating(rng.uniform(0, 50), rng.uniform(0.1, 10))
+            expected = (rating.mu, rating.sigma)
+
+            out = model.rate([[rating], [rating]], ranks=[0, 1])
+
+            for value, expected_value in zip(rate_against_self(*expected), (out[0][0].mu, out[0][0].sigma)):
+                self.assertAlmostEqual(expected_value, value, delta=1e-9)
+
+    def test_rate_1v1_events(self):
+        rng = random.Random(5)
+        mu = [rng.uniform(0, 50) for _ in range(10)]
+        sigma = [rng.uniform(0.1, 10) for _ in range(10)]
+        scale_mu = [rng.choice([1, 1.25, 2]) for _ in range(10)]
+        scale_sigma = [rng.choice([1, 1.25, 2]) for _ in range(10)]
+
+        events = []
+        for _ in range(200):
+            winner, loser = rng.sample(range(10), 2)
+            if rng.random() < 0.2:
+                loser = winner # against themselves
+            events.append((winner, loser, rng.uniform(0, 0.2), rng.uniform(0, 0.2), rng.uniform(0, 0.2),
+                           rng.uniform(0, 0.2)))
+
+        expected_mu = list(mu)
+        expected_sigma = list(sigma)
+        for winner, loser, winner_weight_mu, winner_weight_sigma, loser_weight_mu, loser_weight_sigma in events:
+            winner_rating = Rating(expected_mu[winner], expected_sigma[winner])
+            # rated against themselves like goals are, with the same rating object on both sides
+            loser_rating = winner_rating if winner == loser else Rating(expected_mu[loser], expected_sigma[loser])
+            out = model.rate([[winner_rating], [loser_rating]], ranks=[0, 1])
+
+            if winner != loser:
+                expected_mu[loser] += (out[1][0].mu - expected_mu[loser]) * loser_weight_mu * scale_mu[loser]
+                expected_sigma[loser] += \
+                    (out[1][0].sigma - expected_sigma[loser]) * loser_weight_sigma * scale_sigma[loser]
+            expected_mu[winner] += (out[0][0].mu - expected_mu[winner]) * winner_weight_mu * scale_mu[winner]
+            expected_sigma[winner] += \
+                (out[0][0].sigma - expected_sigma[winner]) * winner_weight_sigma * scale_sigma[winner]
+
+        rate_1v1_events(mu, sigma, events, scale_mu=scale_mu, scale_sigma=scale_sigma)
+
+        for value, expected_value in zip(mu + sigma, expected_mu + expected_sigma):
+            self.assertAlmostEqual(expected_value, value, delta=1e-9)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,3 +1,4 @@
+import os
 import unittest
 
 from db.game import EntityStarts
@@ -6,7 +7,10 @@ from db.sm5 import SM5Game, SM5Stats
 from db.types import Team
 from helpers.statshelper import count_zaps, get_sm5_kd_ratio, get_sm5_score_components, \
     get_sm5_single_player_score_graph_data, get_sm5_single_team_score_graph_data, get_sm5_team_score_graph_data, \
-    get_sm5_gross_positive_score, get_points_per_minute, count_blocks, count_missiles, get_points_scored
+    get_sm5_gross_positive_score, get_points_per_minute, count_blocks, count_missiles, get_points_scored, \
+    build_game_summary, get_game_summary, get_player_state_distribution
+from helpers.gamehelper import SM5_STATE_LABEL_MAP
+from helpers.tdfhelper import parse_sm5_game
 from tests.helpers.environment import setup_test_database, ENTITY_ID_1, ENTITY_ID_2, ENTITY_ID_3, get_sm5_game_id, \
     teardown_test_database, create_destroy_base_event, add_entity, get_red_team, get_green_team, add_sm5_score, \
     create_award_base_event, create_block_event, get_laserball_game_id, create_zap_event, create_missile_event, \
@@ -185,6 +189,42 @@ class TestStatsHelper(unittest.IsolatedAsyncioTestCase):
                           200, 200, 200, 200, 200, 200, 200, 200, 200, 200, 200, 200, 200, 200, 200, 200, 200,
                           200, 200, 200, 200]}, scores)
 
+    async def test_build_game_summary(self):
+        game = await parse_sm5_game(os.path.join(os.path.dirname(os.path.dirname(__file__)), "data", "sm5_game1.tdf"))
+
+        # built when the game was imported
+        summary = await get_game_summary(game)
+
+        self.assertEqual(await game.get_game_duration(), summary.duration)
+        self.assertEqual(await game.get_team_score(Team.RED), summary.get_team_score(Team.RED))
+        self.assertEqual(await game.get_team_score(Team.GREEN), summary.get_team_score(Team.GREEN))
+        self.assertEqual(["Earth"], summary.eliminated_teams)
+        self.assertTrue(await game.get_team_eliminated(Team.GREEN))
+
+        # the game page takes these from the summary
+        for team in [Team.RED, Team.GREEN]:
+            self.assertEqual(await game.get_team_eliminated(team), summary.is_team_eliminated(team))
+            self.assertEqual(await game.get_medic_death_time(team), summary.get_medic_death_time(team))
+            self.assertEqual(await game._get_team_doubles_percent(team),
+                             await game._get_team_doubles_percent(team, summary))
+        all_stats = await SM5Stats.filter(entity__sm5games=game.id)
+        self.assertEqual(12, len(all_stats))
+        for stats in all_stats:
+            self.assertEqual(await stats.mvp_points(), await stats.mvp_points(summary))
+
+        entity_start = await game.entity_starts.filter(type="player").first()
+        entity_end = await entity_start.get_entity_end()
+        stats = await SM5Stats.filter(entity_id=entity_start.id).first()
+        player_summary = summary.get_player(entity_start)
+
+        self.assertEqual(await get_sm5_score_components(game, stats, entity_start), player_summary["score_components"])
+        self.assertEqual(await get_player_state_distribution(entity_start, entity_end, game.player_states, game.events,
+                                                             SM5_STATE_LABEL_MAP),
+                         player_summary["state_distribution"])
+
+        # building it again replaces it
+        self.assertEqual(summary.id, (await build_game_summary(game)).id)
+
     async def test_get_points_scored(self):
         game = await SM5Game.filter(id=get_sm5_game_id()).first()
 
@@ -0,0 +1,67 @@
+import datetime
+import unittest
+
+from db.game import GameSummary
+from db.laserball import LaserballGame
+from db.sm5 import SM5Game
+from helpers.ratinghelper import DEFAULT_CONFIG, RatingConfig, recalculate_sm5_ratings
+from helpers.statshelper import get_predictive_accuracy, get_brier_score, get_margin_prediction_error
+from helpers.sweephelper import load_sweep_history, evaluate, sweep, config_grid
+from helpers.tdfhelper import read_sm5_game, save_sm5_game
+from tests.helpers.environment import setup_test_database, teardown_test_database, get_test_data_path
+
+
+class TestSweepHelper(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        await setup_test_database()
+
+        # the test games don't have everything a rated game needs
+        await SM5Game.all().update(ranked=False)
+        await LaserballGame.all().update(ranked=False)
+
+        for day in range(4):
+            parsed = read_sm5_game(get_test_data_path("sm5_game1.tdf"))
+            parsed.game.start_time += datetime.timedelta(days=day)
+            parsed.game.ranked = day != 1
+            await save_sm5_game(parsed, f"sm5_game{day}.tdf", update_ratings=False)
+
+        # the scores of games without a summary are added up instead
+        first = await SM5Game.filter(tdf_name="sm5_game1.tdf").order_by("start_time").first()
+        await GameSummary.filter(game_type="sm5", game_id=first.id).delete()
+
+    async def asyncTearDown(self):
+        await teardown_test_database()
+
+    async def assertMatchesStats(self, config: RatingConfig) -> None:
+        history = await load_sweep_history()
+        result = evaluate(history, config)
+
+        await recalculate_sm5_ratings(config=config)
+
+        self.assertEqual(3, len(history.games))
+        self.assertAlmostEqual(await get_predictive_accuracy(), result.accuracy, places=9)
+        self.assertAlmostEqual(await get_brier_score(), result.brier_score, places=9)
+        self.assertAlmostEqual(await get_margin_prediction_error(), result.margin_error, places=9)
+
+    async def test_evaluate_matches_stats(self):
+        await self.assertMatchesStats(DEFAULT_CONFIG)
+
+    async def test_evaluate_matches_stats_with_other_config(self):
+        # the stats predict with the default model, so only the parameters of the rating updates can differ
+        await self.assertMatchesStats(RatingConfig(tau=0.2, sm5_hit_weight_mu=0.1, sm5_missile_medic_weight_mu=0.5))
+
+    async def test_sweep(self):
+        history = await load_sweep_history()
+        configs = config_grid({"tau": [0.05, 0.2], "sm5_hit_weight_mu": [0.01, 0.1]})
+
+        results = sweep(history, configs, workers=2)
+
+        self.assertEqual([(0.05, 0.01), (0.05, 0.1), (0.2, 0.01), (0.2, 0.1)],
+                         [(result.config.tau, result.config.sm5_hit_weight_mu) for result in results])
+        self.assertEqual([evaluate(history, config).brier_score for config in configs],
+                         [result.brier_score for result in results])
+        self.assertNotEqual(results[0].brier_score, results[-1].brier_score)
+
+
+if __name__ == '__main__':
+    unittest.main()
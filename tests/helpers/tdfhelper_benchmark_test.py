@@ -0,0 +1,72 @@
+"""Benchmark for saving a parsed TDF file.
+
+Prints the rows per second written by persist_game(), next to saving every row on its own and linking them to the game
+with the many-to-many add() calls, which is how games were saved before. Run with `pytest -s` to see the numbers,
+nothing is asserted about them since they depend on the machine and the database.
+"""
+import os
+import time
+import unittest
+
+from helpers import sm5helper
+from helpers.tdfhelper import ParsedGame, read_sm5_game, persist_game
+from tests.helpers.environment import setup_test_database, teardown_test_database
+
+TDF_PATH = os.path.join(os.path.dirname(os.path.dirname(__file__)), "data", "sm5_game1.tdf")
+
+
+async def _legacy_persist_game(parsed: ParsedGame) -> None:
+    # how parse_sm5_game() saved games before, kept here for comparison
+    game = parsed.game
+    await game.save()
+
+    for team in parsed.teams:
+        await team.save()
+    for entity_start in parsed.entity_starts:
+        entity_start.team = entity_start.team
+        await entity_start.save()
+    for event in parsed.events:
+        await event.save()
+    for instances in [parsed.scores, parsed.player_states, parsed.entity_ends, parsed.stats]:
+        for instance in instances:
+            instance.entity = instance.entity
+            await instance.save()
+
+    await game.teams.add(*parsed.teams)
+    await game.entity_starts.add(*parsed.entity_starts)
+    await game.events.add(*parsed.events)
+    await game.player_states.add(*parsed.player_states)
+    await game.scores.add(*parsed.scores)
+    await game.entity_ends.add(*parsed.entity_ends)
+    await game.sm5_stats.add(*parsed.stats)
+
+    await sm5helper.update_winner(game)
+    await game.save()
+
+
+class TestPersistGameBenchmark(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        await setup_test_database()
+
+    async def asyncTearDown(self):
+        await teardown_test_database()
+
+    async def test_rows_per_second(self):
+        legacy = read_sm5_game(TDF_PATH)
+        start = time.perf_counter()
+        await _legacy_persist_game(legacy)
+        legacy_rate = legacy.row_count / (time.perf_counter() - start)
+
+        current = read_sm5_game(TDF_PATH)
+        start = time.perf_counter()
+        await persist_game(current)
+        current_rate = current.row_count / (time.perf_counter() - start)
+
+        print(f"\n{current.row_count} rows: legacy {legacy_rate:.0f} rows/s, current {current_rate:.0f} rows/s")
+
+        self.assertEqual(len(legacy.events), await legacy.game.events.all().count())
+        self.assertEqual(len(current.events), await current.game.events.all().count())
+
+
+if __name__ == '__main__':
+    unittest.main()
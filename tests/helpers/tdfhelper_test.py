@@ -1,12 +1,20 @@
 import datetime
 import os
+import shutil
+import tempfile
 import unittest
 
 from pytz import utc
 
-from db.types import Team
-from helpers.tdfhelper import parse_sm5_game
-from tests.helpers.environment import setup_test_database, teardown_test_database
+from db.game import EntityStarts
+from db.player import Player
+from db.sm5 import SM5Game
+from db.types import EventType, IntRole, Team
+from helpers import cachehelper, tdfhelper
+from helpers.cachehelper import BoundedCache, cache, entity_tag
+from helpers.tdfhelper import parse_sm5_game, read_sm5_game, read_laserball_game, persist_game, TdfReader, SystemInfoRecord, \
+    GameInfoRecord, TeamRecord, bulk_import_tdfs, resolve_players, compress_tdf, check_tdf
+from tests.helpers.environment import setup_test_database, teardown_test_database, get_sm5_game_id
 
 
 class TestTdfHelper(unittest.IsolatedAsyncioTestCase):
@@ -53,6 +61,214 @@ class TestTdfHelper(unittest.IsolatedAsyncioTestCase):
             },
         ], teams)
 
+    async def testReadSm5WithoutSaving(self):
+        parsed = read_sm5_game(self._get_test_data_path("sm5_game1.tdf"))
+
+        self.assertIsNone(parsed.game.id)
+        self.assertEqual(3, len(parsed.teams))
+        self.assertTrue(all(entity_start.id is None for entity_start in parsed.entity_starts))
+        self.assertIs(parsed.teams[1], parsed.entity_starts[0].team)
+
+        game = await persist_game(parsed)
+
+        self.assertEqual(len(parsed.events), await game.events.all().count())
+        self.assertEqual(len(parsed.entity_starts), await game.entity_starts.all().count())
+        self.assertEqual(len(parsed.stats), await game.sm5_stats.all().count())
+        self.assertEqual(parsed.teams[1].id, parsed.entity_starts[0].team_id)
+        self.assertEqual(parsed.scores[0].entity.id, parsed.scores[0].entity_id)
+        self.assertEqual(Team.RED, game.winner)
+
+    async def testCheckTdf(self):
+        game_count = await SM5Game.all().count()
+        player_count = await Player.all().count()
+
+        check = await check_tdf(self._get_test_data_path("sm5_game1.tdf"))
+
+        self.assertEqual("sm5", check.type)
+        self.assertTrue(check.ranked)
+        self.assertEqual([], check.unranked_reasons)
+        self.assertEqual((6, 6), check.team_sizes)
+        self.assertEqual(1, check.role_counts["Fire Team"][IntRole.COMMANDER])
+        self.assertEqual(50, check.special_points["Jdlzcsb☺"])
+        self.assertEqual("red", check.winner_color)
+        self.assertEqual(["tokenize", "checks", "save", "summary", "rating"], list(check.timings))
+
+        # nothing was kept
+        self.assertEqual(game_count, await SM5Game.all().count())
+        self.assertEqual(player_count, await Player.all().count())
+
+    async def testCheckTdfKeepsCache(self):
+        previous_backend = cachehelper.function_cache
+        cachehelper.set_cache_backends(function_backend=BoundedCache(max_entries=100))
+        cachehelper.function_cache_enabled = True
+        path = self._get_test_data_path("sm5_game1.tdf")
+        calls = []
+
+        @cache(ttl=60, tags=[entity_tag(e.entity_id) for e in read_sm5_game(path).entity_starts])
+        async def value():
+            calls.append(1)
+            return len(calls)
+
+        try:
+            await value()
+            await check_tdf(path)
+            await value()
+        finally:
+            cachehelper.function_cache_enabled = False
+            cachehelper.set_cache_backends(function_backend=previous_backend)
+            cachehelper._tag_keys.clear()
+            cachehelper._key_tags.clear()
+
+        self.assertEqual(1, len(calls))
+
+    def testReadLaserballAssists(self):
+        lines = [
+            "0\t2.005\t8.503\t4-43",
+            "1\t28\tLaserball\t20240114205710\t900000",
+            "2\t0\tFire Team\t11\tFire",
+            "2\t1\tEarth Team\t12\tEarth",
+            "3\t0\t#a\tplayer\tA\t0\t0\t0\tSuit1",
+            "3\t0\t#b\tplayer\tB\t0\t0\t0\tSuit2",
+            "3\t0\t#c\tplayer\tC\t1\t0\t0\tSuit3",
+            "3\t0\t#d\tplayer\tD\t1\t0\t0\tSuit4",
+            "4\t1000\t1105\t* Round Start *",
+            "4\t2000\t1100\t#a\t passes to \t#b",
+            "4\t3000\t1101\t#b\t scores!",
+            "4\t4000\t1105\t* Round Start *",
+            "4\t5000\t1100\t#c\t passes to \t#d",
+            "4\t6000\t1103\t#a\t steals from \t#d",
+            "4\t7000\t1101\t#a\t scores!",
+            "4\t900000\t0101\t* Mission End *",
+        ]
+
+        parsed = read_laserball_game("assists.tdf", "\n".join(lines).encode("utf-16"))
+
+        assists = {stats.entity.entity_id: stats.assists for stats in parsed.stats}
+        self.assertEqual({"#a": 1, "#b": 0, "#c": 0, "#d": 0}, assists)
+
+        # the assist comes right after the goal it's for, the goal after a steal has none
+        event_types = [event.type for event in parsed.events]
+        self.assertEqual(1, event_types.count(EventType.ASSIST))
+        self.assertEqual(EventType.GOAL, event_types[event_types.index(EventType.ASSIST) - 1])
+        self.assertEqual(["#a", "assists", "#b"], parsed.events[event_types.index(EventType.ASSIST)].arguments)
+
+    def testReadRecords(self):
+        path = self._get_test_data_path("sm5_game1.tdf")
+        records = list(TdfReader(path))
+
+        self.assertEqual(SystemInfoRecord("2.005", "8.503", "4-43"), records[0])
+        self.assertEqual(GameInfoRecord(5, "Space Marines 5 Tournament Edition", "20240114205710", 900000), records[1])
+        self.assertEqual(TeamRecord(0, "Fire Team", 11, "Fire"), records[2])
+
+        with open(path, "rb") as file:
+            self.assertEqual(records, list(TdfReader(file.read())))
+
+    def testReadCompressed(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = shutil.copy(self._get_test_data_path("sm5_game1.tdf"), directory)
+            compressed_path = compress_tdf(path)
+
+            self.assertEqual(path + ".gz", compressed_path)
+            self.assertFalse(os.path.exists(path))
+
+            parsed = read_sm5_game(compressed_path)
+            with open(compressed_path, "rb") as file:
+                records = list(TdfReader(file.read()))
+
+        self.assertEqual("sm5_game1.tdf", parsed.game.tdf_name)
+        self.assertEqual(list(TdfReader(self._get_test_data_path("sm5_game1.tdf"))), records)
+
+    async def testBulkImport(self):
+        # the ratings of all games are recalculated, and the test game doesn't have everything a rated game needs
+        await SM5Game.filter(id=get_sm5_game_id()).update(ranked=False)
+
+        previous_directory = os.getcwd()
+        with tempfile.TemporaryDirectory() as directory:
+            os.mkdir(os.path.join(directory, "sm5_tdf"))
+            shutil.copy(self._get_test_data_path("sm5_game1.tdf"), os.path.join(directory, "sm5_tdf"))
+            os.chdir(directory)
+            try:
+                result = await bulk_import_tdfs(workers=1)
+                # the second time, the game exists already
+                repeated = await bulk_import_tdfs(workers=1)
+            finally:
+                os.chdir(previous_directory)
+
+        self.assertEqual(1, result.files)
+        self.assertEqual(1, result.games)
+        self.assertEqual([], result.failed)
+        self.assertEqual(0, repeated.games)
+
+        game = await SM5Game.filter(tdf_name="sm5_game1.tdf").first()
+        self.assertEqual(Team.RED, game.winner)
+        self.assertIsNotNone((await game.entity_ends.filter(entity__type="player").first()).current_rating_mu)
+
+    async def testBulkImportSkipsGamesThatFailToSave(self):
+        await SM5Game.filter(id=get_sm5_game_id()).update(ranked=False)
+        save_sm5_game = tdfhelper.save_sm5_game
+
+        async def save_or_fail(parsed, file_location, **kwargs):
+            game = await save_sm5_game(parsed, file_location, **kwargs)
+            if file_location.endswith("broken.tdf"):
+                raise RuntimeError("save failed")
+            return game
+
+        previous_directory = os.getcwd()
+        with tempfile.TemporaryDirectory() as directory:
+            os.mkdir(os.path.join(directory, "sm5_tdf"))
+            shutil.copy(self._get_test_data_path("sm5_game1.tdf"), os.path.join(directory, "sm5_tdf"))
+            shutil.copy(self._get_test_data_path("sm5_game1.tdf"), os.path.join(directory, "sm5_tdf", "broken.tdf"))
+            os.chdir(directory)
+            tdfhelper.save_sm5_game = save_or_fail
+            try:
+                result = await bulk_import_tdfs(workers=1)
+            finally:
+                tdfhelper.save_sm5_game = save_sm5_game
+                os.chdir(previous_directory)
+
+        self.assertEqual(1, result.games)
+        self.assertEqual([os.path.join("sm5_tdf", "broken.tdf")], result.failed)
+        self.assertFalse(await SM5Game.filter(tdf_name="broken.tdf").exists())
+        self.assertTrue(await SM5Game.filter(tdf_name="sm5_game1.tdf").exists())
+
+    async def testResolvePlayers(self):
+        await Player.create(player_id="", codename="Linked", entity_id="")
+        await Player.create(player_id="4-43-100", codename="Old Name", entity_id="#renamed")
+
+        players = await resolve_players([
+            self._entity_start("#linked", "Linked"),
+            self._entity_start("#renamed", "New Name"),
+            self._entity_start("#new", "Newcomer", member_id="4-43-200"),
+            # non-member
+            self._entity_start("@123", "Heavy", battlesuit="Heavy"),
+        ])
+
+        self.assertEqual({"#linked", "#renamed", "#new"}, set(players.keys()))
+        self.assertEqual("#linked", (await Player.get(codename="Linked")).entity_id)
+        self.assertEqual("New Name", (await Player.get(entity_id="#renamed")).codename)
+        self.assertEqual("4-43-200", (await Player.get(entity_id="#new")).player_id)
+        self.assertFalse(await Player.filter(entity_id="@123").exists())
+
+    async def testResolvePlayersIgnoresCase(self):
+        players = await resolve_players([
+            self._entity_start("#first", "Same Name"),
+            self._entity_start("#second", "SAME NAME"),
+            self._entity_start("#AB12", "Other"),
+            self._entity_start("#ab12", "Other"),
+        ])
+
+        # the database finds the first player for both, so no duplicates are created
+        self.assertNotIn("#second", players)
+        self.assertIs(players["#AB12"], players["#ab12"])
+        self.assertEqual(1, await Player.filter(codename="Same Name").count())
+        self.assertFalse(await Player.filter(codename="SAME NAME").exists())
+        self.assertEqual(1, await Player.filter(codename="Other").count())
+
+    @staticmethod
+    def _entity_start(entity_id: str, name: str, battlesuit: str = "Suit", member_id: str = None) -> EntityStarts:
+        return EntityStarts(time=0, entity_id=entity_id, type="player", name=name, level=0, role=1,
+                            battlesuit=battlesuit, member_id=member_id)
+
     @staticmethod
     def _get_test_data_path(filename: str) -> str:
         """Returns the full path of a file within the tests/data folder."""
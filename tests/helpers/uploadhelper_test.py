@@ -0,0 +1,147 @@
+import os
+import tempfile
+import unittest
+
+from db.sm5 import SM5Game
+from db.upload import UploadJob, UploadStatus
+from helpers import uploadhelper
+from helpers.uploadhelper import SPOOL_DIRECTORY, WORKER_LOCK_PATH, enqueue_upload, get_queue_position, \
+    process_upload, claim_next_job, acquire_worker_lock
+from tests.helpers.environment import setup_test_database, teardown_test_database
+
+
+class TestUploadHelper(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        await setup_test_database()
+
+        self.previous_directory = os.getcwd()
+        self.directory = tempfile.TemporaryDirectory()
+        os.chdir(self.directory.name)
+
+    async def asyncTearDown(self):
+        os.chdir(self.previous_directory)
+        self.directory.cleanup()
+
+        await teardown_test_database()
+
+    async def test_process_upload_imports_game(self):
+        job, created = await enqueue_upload("sm5", "sm5_game1.tdf", self._read_test_data("sm5_game1.tdf"))
+
+        self.assertTrue(created)
+        self.assertEqual(UploadStatus.QUEUED, job.status)
+        self.assertEqual("20240114205710", job.start_time)
+        self.assertTrue(os.path.exists(job.spool_path))
+
+        await process_upload(job)
+
+        job = await UploadJob.get(id=job.id)
+        self.assertEqual(UploadStatus.DONE, job.status)
+        self.assertIsNotNone(job.game_id)
+        self.assertIsNotNone(job.finished_at)
+        self.assertFalse(os.path.exists(job.spool_path))
+        self.assertEqual(["sm5_game1.tdf.gz"], os.listdir("sm5_tdf"))
+
+    async def test_process_upload_stores_error(self):
+        job, _ = await enqueue_upload("sm5", "broken.tdf", "1\tnot a number\n".encode("utf-16"))
+
+        await process_upload(job)
+
+        job = await UploadJob.get(id=job.id)
+        self.assertEqual(UploadStatus.FAILED, job.status)
+        self.assertIn("ValueError", job.error)
+
+    async def test_queue_is_ordered_by_start_time(self):
+        later, _ = await enqueue_upload("sm5", "later.tdf", self._read_test_data("sm5_game1.tdf"))
+        earlier, _ = await enqueue_upload("sm5_3team", "earlier.tdf",
+                                       "1\t5\tSpace Marines 5\t20230101120000\t900000\n".encode("utf-16"))
+
+        self.assertEqual(0, await get_queue_position(earlier))
+        self.assertEqual(1, await get_queue_position(later))
+
+        await process_upload(earlier)
+
+        self.assertIsNone(await get_queue_position(earlier))
+        self.assertEqual(0, await get_queue_position(later))
+
+    async def test_same_file_is_queued_once(self):
+        content = self._read_test_data("sm5_game1.tdf")
+        job, _ = await enqueue_upload("sm5", "sm5_game1.tdf", content)
+        await process_upload(job)
+
+        duplicate, created = await enqueue_upload("sm5", "renamed.tdf", content)
+
+        self.assertFalse(created)
+        self.assertEqual(job.id, duplicate.id)
+        self.assertEqual(UploadStatus.DONE, duplicate.status)
+        self.assertEqual(["sm5_game1.tdf.gz"], os.listdir("sm5_tdf"))
+        self.assertEqual([], os.listdir(SPOOL_DIRECTORY))
+
+    async def test_failed_file_is_queued_again(self):
+        content = "1\tnot a number\n".encode("utf-16")
+        job, _ = await enqueue_upload("sm5", "broken.tdf", content)
+        await process_upload(job)
+
+        retry, created = await enqueue_upload("sm5", "broken.tdf", content)
+
+        self.assertFalse(created)
+        self.assertEqual(job.id, retry.id)
+        self.assertEqual(UploadStatus.QUEUED, retry.status)
+        self.assertIsNone(retry.error)
+        self.assertTrue(os.path.exists(retry.spool_path))
+
+    async def test_deleted_game_is_queued_again(self):
+        content = self._read_test_data("sm5_game1.tdf")
+        job, _ = await enqueue_upload("sm5", "sm5_game1.tdf", content)
+        await process_upload(job)
+
+        # like /admin/game/sm5/<id>/delete
+        job = await UploadJob.get(id=job.id)
+        await (await SM5Game.get(id=job.game_id)).delete()
+        os.remove(os.path.join("sm5_tdf", "sm5_game1.tdf.gz"))
+
+        retry, created = await enqueue_upload("sm5", "sm5_game1.tdf", content)
+
+        self.assertFalse(created)
+        self.assertEqual(job.id, retry.id)
+        self.assertEqual(UploadStatus.QUEUED, retry.status)
+        self.assertIsNone(retry.game_id)
+
+        await process_upload(retry)
+
+        retry = await UploadJob.get(id=job.id)
+        self.assertEqual(UploadStatus.DONE, retry.status)
+        self.assertTrue(await SM5Game.exists(id=retry.game_id))
+
+    async def test_job_is_claimed_once(self):
+        job, _ = await enqueue_upload("sm5", "sm5_game1.tdf", self._read_test_data("sm5_game1.tdf"))
+
+        claimed = await claim_next_job()
+
+        self.assertEqual(job.id, claimed.id)
+        self.assertEqual(UploadStatus.PROCESSING, (await UploadJob.get(id=job.id)).status)
+        self.assertIsNone(await claim_next_job())
+
+    @unittest.skipIf(os.name == "nt", "uses flock")
+    async def test_one_process_holds_the_worker_lock(self):
+        import fcntl
+
+        self.assertTrue(acquire_worker_lock())
+        try:
+            self.assertFalse(acquire_worker_lock())
+
+            # another process opening the lock file can't take it
+            with open(WORKER_LOCK_PATH, "a") as other:
+                with self.assertRaises(OSError):
+                    fcntl.flock(other.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        finally:
+            uploadhelper._worker_lock_file.close()
+            uploadhelper._worker_lock_file = None
+
+    @staticmethod
+    def _read_test_data(filename: str) -> bytes:
+        with open(os.path.join(os.path.dirname(os.path.dirname(__file__)), "data", filename), "rb") as file:
+            return file.read()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,52 @@
+import datetime
+import unittest
+
+from db.player import Player
+from db.sm5 import SM5Game
+from helpers.tdfhelper import read_sm5_game, save_sm5_game
+from helpers.userhelper import get_player_etag
+from tests.helpers.environment import setup_test_database, teardown_test_database, get_test_data_path
+
+
+class TestUserHelper(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        await setup_test_database()
+
+    async def asyncTearDown(self):
+        await teardown_test_database()
+
+    async def _import_game(self, days: int, ranked: bool) -> SM5Game:
+        parsed = read_sm5_game(get_test_data_path("sm5_game1.tdf"))
+        parsed.game.start_time += datetime.timedelta(days=days)
+        parsed.game.ranked = ranked
+        return await save_sm5_game(parsed, f"sm5_game{days}.tdf", update_ratings=False)
+
+    async def test_get_player_etag_changes_with_unranked_games(self):
+        first_game = await self._import_game(days=0, ranked=True)
+        player = await Player.filter(entity_id__startswith="#").first()
+        etag = await get_player_etag(player.entity_id)
+
+        self.assertEqual(etag, await get_player_etag(player.entity_id))
+
+        game = await self._import_game(days=1, ranked=False)
+        unranked_etag = await get_player_etag(player.entity_id)
+        self.assertNotEqual(etag, unranked_etag)
+
+        # an older game imported afterwards, and an edit of a game that isn't the last one
+        await self._import_game(days=-1, ranked=False)
+        older_etag = await get_player_etag(player.entity_id)
+        self.assertNotEqual(unranked_etag, older_etag)
+
+        await first_game.mark_edited()
+        edited_etag = await get_player_etag(player.entity_id)
+        self.assertNotEqual(older_etag, edited_etag)
+
+        await game.delete()
+        self.assertNotEqual(edited_etag, await get_player_etag(player.entity_id))
+
+    async def test_get_player_etag_unknown_player(self):
+        self.assertIsNone(await get_player_etag("nobody"))
+
+
+if __name__ == '__main__':
+    unittest.main()
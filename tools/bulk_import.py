@@ -0,0 +1,41 @@
+"""Rebuilds the games from the files in sm5_tdf and laserball_tdf, reading them in parallel.
+
+Usage: python tools/bulk_import.py [--workers N] [--batch-size N]
+
+Games that are in the database already are skipped. Ratings are recalculated at the end, see
+tdfhelper.bulk_import_tdfs().
+"""
+import os
+import sys
+os.chdir(os.path.dirname(os.path.abspath(__file__)))
+os.chdir("..")
+sys.path.append(os.getcwd())
+import argparse
+import asyncio
+from tortoise import Tortoise
+from config import TORTOISE_ORM
+from helpers import tdfhelper
+
+
+async def main(workers: int, batch_size: int) -> None:
+    await Tortoise.init(config=TORTOISE_ORM)
+
+    result = await tdfhelper.bulk_import_tdfs(workers=workers, batch_size=batch_size)
+
+    print(f"Imported {result.games} games ({result.rows} rows) from {result.files} files in {result.seconds:.1f}s")
+    print(f"{result.games_per_second:.2f} games/s, {result.rows_per_second:.0f} rows/s")
+    for file_location in result.failed:
+        print(f"Failed to read {file_location}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--workers", type=int, default=None,
+                        help="processes reading the files (default: one per CPU)")
+    parser.add_argument("--batch-size", type=int, default=50, help="games saved per transaction (default: 50)")
+    args = parser.parse_args()
+
+    try:
+        asyncio.run(main(args.workers, args.batch_size))
+    finally:
+        asyncio.run(Tortoise.close_connections())
@@ -0,0 +1,68 @@
+"""Checks TDF files without importing them: what game they are, whether they would be ranked (and why not), and how long
+each phase of the import takes.
+
+Usage: python tools/check_tdf.py file [file ...]
+
+The games are imported into an empty in-memory database that is thrown away afterwards, so this can run anywhere,
+for example on files at the arena or on ones made by tools/anonymize_tdf.py. See tdfhelper.check_tdf().
+"""
+import os
+import sys
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import argparse
+import asyncio
+from typing import List
+from tortoise import Tortoise
+from helpers import tdfhelper
+
+
+def print_check(check: tdfhelper.TdfCheck) -> None:
+    print(check.file_location)
+
+    if check.type is None:
+        print(f"  Not an SM5 or Laserball game (mission type {check.mission_type})")
+        return
+
+    print(f"  Type: {check.type}")
+
+    if check.false_start:
+        print("  False start (ended early and lasted less than 3 minutes), would be skipped")
+    else:
+        print(f"  Ranked: {'yes' if check.ranked else 'no'}")
+        for reason in check.unranked_reasons:
+            print(f"    {reason}")
+        print(f"  Team sizes: {check.team_sizes[0]} and {check.team_sizes[1]}")
+        for team, role_counts in check.role_counts.items():
+            roles = ", ".join(f"{count} {role}" for role, count in sorted(role_counts.items()))
+            print(f"  {team}: {roles}")
+        if check.special_points:
+            print("  Special points: " + ", ".join(f"{name} {points}" for name, points in check.special_points.items()))
+        print(f"  Winner: {check.winner_color}")
+        print(f"  Rows: {check.rows}")
+
+    print("  Time: " + ", ".join(f"{phase} {seconds * 1000:.1f}ms" for phase, seconds in check.timings.items()) +
+          f" (total {check.seconds * 1000:.1f}ms)")
+
+
+async def main(files: List[str]) -> None:
+    await Tortoise.init(db_url="sqlite://:memory:",
+                        modules={"models": ["db.game", "db.laserball", "db.legacy", "db.player", "db.sm5", "db.tag",
+                                            "db.upload"]})
+    await Tortoise.generate_schemas()
+
+    for file_location in files:
+        try:
+            print_check(await tdfhelper.check_tdf(file_location))
+        except Exception as e:
+            print(f"{file_location}\n  Invalid: {e!r}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("files", nargs="+", help="TDF files, compressed or not")
+    args = parser.parse_args()
+
+    try:
+        asyncio.run(main(args.files))
+    finally:
+        asyncio.run(Tortoise.close_connections())
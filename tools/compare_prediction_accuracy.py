@@ -142,40 +142,40 @@ async def main():
 
     tdfhelper.logger = myLogger
 
-    # set params
+    # set params, the ones that aren't given are the defaults in ratinghelper
 
-    ratinghelper.MU = 25
-    ratinghelper.SIGMA = 25 / 3
-    ratinghelper.BETA = 25 / 6
-    ratinghelper.KAPPA = 0.0001
-    ratinghelper.TAU = 25 / 275  # default: 25/300 (for rating volatility, higher = more volatile ratings)
-    ratinghelper.ZETA = 0.09  # default: 0 (custom addition for uneven team rating adjustment), higher value = more adjustment for uneven teams
+    config = ratinghelper.RatingConfig(
+        mu=25,
+        sigma=25 / 3,
+        beta=25 / 6,
+        kappa=0.0001,
+        tau=25 / 275,  # default: 25/300 (for rating volatility, higher = more volatile ratings)
+        zeta=0.09,  # default: 0 (custom addition for uneven team rating adjustment), higher value = more adjustment for uneven teams
 
-    # mu is for skill, sigma is for uncertainty/confidence
-    # the higher the mu, the better the player is expected to perform
-    # the higher the sigma, the less confident we are in the player's skill
+        # mu is for skill, sigma is for uncertainty/confidence
+        # the higher the mu, the better the player is expected to perform
+        # the higher the sigma, the less confident we are in the player's skill
 
-    # sm5
+        # sm5
 
-    # TODO: possibly seperate damaged and downed events, but for now they are treated the same
+        # TODO: possibly seperate damaged and downed events, but for now they are treated the same
 
-    # overall weight for an entire game (mu_weight, sigma_weight) = (1, 1) ( rate([team1, team2]) )
+        # overall weight for an entire game (mu_weight, sigma_weight) = (1, 1) ( rate([team1, team2]) )
 
+        sm5_hit_weight_mu=0.01,  # skill weight for hits in sm5
+        sm5_hit_weight_sigma=0.01,  # uncertainty weight for hits in sm5
 
-    ratinghelper.SM5_HIT_WEIGHT_MU = 0.01  # skill weight for hits in sm5
-    ratinghelper.SM5_HIT_WEIGHT_SIGMA = 0.01  # uncertainty weight for hits in sm5
+        sm5_hit_medic_weight_mu=0.02,  # skill weight for medic hits in sm5
+        sm5_hit_medic_weight_sigma=0.01,  # uncertainty weight for medic hits in sm5
 
-    ratinghelper.SM5_HIT_MEDIC_WEIGHT_MU = 0.02  # skill weight for medic hits in sm5
-    ratinghelper.SM5_HIT_MEDIC_WEIGHT_SIGMA = 0.01  # uncertainty weight for medic hits in sm5
+        sm5_missile_weight_mu=0.025,  # skill weight for missile hits in sm5
+        sm5_missile_weight_sigma=0.01,  # uncertainty weight for missile hits in sm5
 
+        sm5_missile_medic_weight_mu=0.05,  # skill weight for medic missiles in sm5
+        sm5_missile_medic_weight_sigma=0.01,  # uncertainty weight for medic missiles in sm5
+    )
 
-    ratinghelper.SM5_MISSILE_WEIGHT_MU = 0.025  # skill weight for missile hits in sm5
-    ratinghelper.SM5_MISSILE_WEIGHT_SIGMA = 0.01  # uncertainty weight for missile hits in sm5
-
-    ratinghelper.SM5_MISSILE_MEDIC_WEIGHT_MU = 0.05  # skill weight for medic missiles in sm5
-    ratinghelper.SM5_MISSILE_MEDIC_WEIGHT_SIGMA = 0.01  # uncertainty weight for medic missiles in sm5
-
-    #ratinghelper.model = ratinghelper.CustomPlackettLuce(ratinghelper.MU, ratinghelper.SIGMA, ratinghelper.BETA, ratinghelper.KAPPA, tau=ratinghelper.TAU)
+    # the predictions of statshelper use ratinghelper.model, sweephelper.evaluate() uses config.model instead
 
     # exclude uneven player count games
 
@@ -192,7 +192,7 @@ async def main():
 
     # recalculate sm5 ratings
 
-    await ratinghelper.recalculate_sm5_ratings(_sample_size=n)
+    await ratinghelper.recalculate_sm5_ratings(config=config, _sample_size=n)
 
     # print prediction accuracy
 
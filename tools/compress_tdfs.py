@@ -0,0 +1,48 @@
+"""Compresses the TDF files in the archive folders in place (x.tdf becomes x.tdf.gz).
+
+Usage: python tools/compress_tdfs.py [folder ...]  (folders relative to the repository)
+
+Without arguments, all folders uploads are stored in are converted. Files that are compressed already are skipped, so
+it's safe to run again if it was interrupted. The server reads both formats, it doesn't have to be stopped.
+"""
+import os
+import sys
+os.chdir(os.path.dirname(os.path.abspath(__file__)))
+os.chdir("..")
+sys.path.append(os.getcwd())
+from helpers.tdfhelper import compress_tdf
+from helpers.uploadhelper import UPLOAD_TYPES
+
+
+def main(folders) -> None:
+    total_before = 0
+    total_after = 0
+    count = 0
+
+    for folder in folders:
+        if not os.path.isdir(folder):
+            continue
+
+        for name in sorted(os.listdir(folder)):
+            if not name.endswith(".tdf"):
+                continue
+
+            path = os.path.join(folder, name)
+            before = os.path.getsize(path)
+            after = os.path.getsize(compress_tdf(path))
+
+            total_before += before
+            total_after += after
+            count += 1
+
+        print(f"{folder}: done")
+
+    if count:
+        print(f"Compressed {count} files from {total_before / 1024 / 1024:.1f} MB to {total_after / 1024 / 1024:.1f} MB"
+              f" ({total_after / total_before * 100:.1f}%)")
+    else:
+        print("Nothing to compress")
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:] or [folder for folder, _ in UPLOAD_TYPES.values()])
@@ -0,0 +1,61 @@
+"""Scores combinations of rating model parameters against the ranked sm5 games, in parallel.
+
+Usage: python tools/sweep_rating_params.py --param tau=0.05,0.0909,0.12 --param sm5_hit_weight_mu=0.01,0.02 [--workers N]
+
+Every --param is a field of ratinghelper.RatingConfig with the values to try, every combination of them is scored.
+The games are loaded once and replayed in memory, nothing in the database is changed, see sweephelper.
+"""
+import os
+import sys
+os.chdir(os.path.dirname(os.path.abspath(__file__)))
+os.chdir("..")
+sys.path.append(os.getcwd())
+import argparse
+import asyncio
+from dataclasses import fields
+from typing import Dict, List
+from tortoise import Tortoise
+from config import TORTOISE_ORM
+from helpers import sweephelper
+from helpers.ratinghelper import RatingConfig
+
+PARAMETERS = [field.name for field in fields(RatingConfig) if field.type is float]
+
+
+def parse_param(value: str) -> tuple:
+    name, _, values = value.partition("=")
+    if name not in PARAMETERS:
+        raise argparse.ArgumentTypeError(f"unknown parameter {name}, one of: {', '.join(PARAMETERS)}")
+    try:
+        return name, [float(x) for x in values.split(",")]
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"values of {name} have to be numbers separated by commas")
+
+
+async def main(values: Dict[str, List[float]], workers: int) -> None:
+    await Tortoise.init(config=TORTOISE_ORM)
+
+    history = await sweephelper.load_sweep_history()
+    configs = sweephelper.config_grid(values)
+    print(f"Scoring {len(configs)} configs on {len(history.games)} games ({history.player_count} players)")
+
+    results = sweephelper.sweep(history, configs, workers=workers)
+
+    print(" ".join(f"{name:>12}" for name in values) + "    accuracy  brier  margin error")
+    for result in sorted(results, key=lambda x: x.brier_score):
+        print(" ".join(f"{getattr(result.config, name):>12g}" for name in values) +
+              f"    {result.accuracy*100:7.2f}%  {result.brier_score:.4f}  {result.margin_error:12.4f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--param", type=parse_param, action="append", required=True,
+                        help="name=value1,value2,... of a RatingConfig field")
+    parser.add_argument("--workers", type=int, default=None,
+                        help="processes scoring the configs (default: one per CPU)")
+    args = parser.parse_args()
+
+    try:
+        asyncio.run(main(dict(args.param), args.workers))
+    finally:
+        asyncio.run(Tortoise.close_connections())
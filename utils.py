@@ -1,5 +1,8 @@
-from typing import Callable, Any, Union
+import hashlib
+import re
+from typing import Callable, Any, Union, List, Tuple, Dict, Awaitable, Optional
 
+from markupsafe import Markup
 from sanic import Request, response
 from sanic.log import logger
 
@@ -35,6 +38,10 @@ async def render_template(r, template, *args, **kwargs) -> str:
         "str": str,
         "tooltip_info": TOOLTIP_INFO,
         "is_admin": is_admin(r),
+        "output_cache": False,
+        "user_region": _no_marker,
+        "end_user_region": _no_marker,
+        "user_fragment": _no_marker,
     }
 
     kwargs = {**kwargs, **additional_kwargs}
@@ -47,6 +54,195 @@ async def render_cached_template(r, template, *args, **kwargs) -> str:
     return r, template, args, kwargs
 
 
+# Pages in the output cache are rendered once for everyone. Whatever depends on who is looking at the page is
+# marked in the templates, either as a region that is kept or cut out (`user_region("admin")` ...
+# `end_user_region("admin")`, wrapped in `{% if output_cache or <condition> %}`) or as a fragment
+# (`user_fragment("banner")`) that is rendered for every response.
+USER_REGIONS: Dict[str, Callable[[Request], bool]] = {
+    "admin": lambda r: is_admin(r),
+    "logged_in": lambda r: bool(r.ctx.session.get("codename")),
+    "logged_out": lambda r: not r.ctx.session.get("codename"),
+}
+USER_FRAGMENTS: Dict[str, str] = {
+    "banner": "partials/banner.html",
+}
+
+_USER_MARKERS = re.compile(r"<!--user:(\w+)-->(.*?)<!--/user:\1-->|<!--user-fragment:(\w+)-->", re.DOTALL)
+
+
+def _no_marker(name: str) -> str:
+    return ""
+
+
+def _user_region_marker(name: str) -> Markup:
+    return Markup(f"<!--user:{name}-->")
+
+
+def _end_user_region_marker(name: str) -> Markup:
+    return Markup(f"<!--/user:{name}-->")
+
+
+def _user_fragment_marker(name: str) -> Markup:
+    return Markup(f"<!--user-fragment:{name}-->")
+
+
+async def render_output_template(r, template, *args, **kwargs) -> Tuple[List[Union[str, Tuple[str, ...]]], str]:
+    """
+    Renders a page for the output cache, with the per-user parts left as markers.
+
+    Returns the page split into static strings and ("region", name, html) / ("fragment", name) segments,
+    and an ETag for the static part. respond_with_output() turns it into a response.
+    """
+    additional_kwargs = {
+        "session": {},
+        "config": r.app.ctx.config,
+        "Permission": Permission,
+        "str": str,
+        "tooltip_info": TOOLTIP_INFO,
+        "is_admin": False,
+        "output_cache": True,
+        "user_region": _user_region_marker,
+        "end_user_region": _end_user_region_marker,
+        "user_fragment": _user_fragment_marker,
+    }
+
+    text = await app.ctx.jinja.render_string_async(template, r, **{**kwargs, **additional_kwargs})
+
+    segments = []
+    position = 0
+    for match in _USER_MARKERS.finditer(text):
+        segments.append(text[position:match.start()])
+        if match.group(3):
+            segments.append(("fragment", match.group(3)))
+        else:
+            segments.append(("region", match.group(1), match.group(2)))
+        position = match.end()
+    segments.append(text[position:])
+
+    return segments, hashlib.blake2b(text.encode("utf-8"), digest_size=16).hexdigest()
+
+
+async def respond_with_output(r, output: Tuple[List[Union[str, Tuple[str, ...]]], str]) -> response.HTTPResponse:
+    """
+    Fills the per-user parts of a page rendered with render_output_template() in for `r`.
+
+    The ETag covers those parts too, a matching If-None-Match gets a 304.
+    """
+    segments, etag = output
+
+    parts = []
+    variant = []
+    for segment in segments:
+        if isinstance(segment, str):
+            parts.append(segment)
+        elif segment[0] == "region":
+            keep = USER_REGIONS[segment[1]](r)
+            variant.append("1" if keep else "0")
+            if keep:
+                parts.append(segment[2])
+        else:
+            fragment = await app.ctx.jinja.render_string_async(USER_FRAGMENTS[segment[1]], r)
+            variant.append(fragment)
+            parts.append(fragment)
+
+    if variant:
+        etag += "-" + hashlib.blake2b("|".join(variant).encode("utf-8"), digest_size=8).hexdigest()
+    etag = f'"{etag}"'
+
+    if etag_matches(r, etag):
+        return response.empty(status=304, headers={"ETag": etag})
+    return response.html("".join(parts), headers={"ETag": etag})
+
+
+# Cache-Control for pages that differ per user: anyone may store them, but has to ask again every time (which is
+# cheap, see conditional_get()). Vary: Cookie keeps logged in users from getting someone else's copy.
+CACHE_CONTROL_PAGE = "public, no-cache"
+# Cache-Control for data that is the same for everyone and only changes when a game is edited.
+CACHE_CONTROL_DATA = "public, max-age=3600, stale-while-revalidate=86400"
+
+
+def etag_matches(r: Request, etag: str) -> bool:
+    if_none_match = r.headers.get("If-None-Match")
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    return etag in [tag.strip().removeprefix("W/") for tag in if_none_match.split(",")]
+
+
+def accepts_encoding(r: Request, encoding: str) -> bool:
+    """
+    Whether the Accept-Encoding header of the request allows `encoding`, by itself or through "*", with a q-value
+    above 0 ("gzip;q=0" refuses gzip)
+    """
+    wildcard = False
+    for coding in r.headers.get("Accept-Encoding", "").split(","):
+        name, *parameters = [part.strip() for part in coding.split(";")]
+        quality = 1.0
+        for parameter in parameters:
+            key, _, value = parameter.partition("=")
+            if key.strip().lower() == "q":
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+
+        name = name.lower()
+        if name == encoding:
+            # listing the encoding overrides "*"
+            return quality > 0
+        if name == "*":
+            wildcard = quality > 0
+
+    return wildcard
+
+
+def _user_variant(r: Request) -> str:
+    # everything besides the URL that the per-user parts of a page depend on, see USER_REGIONS and USER_FRAGMENTS
+    variant = [str(int(USER_REGIONS[name](r))) for name in USER_REGIONS]
+    variant.append(str(app.ctx.banner.get("text")))
+    variant.append(str(app.ctx.banner.get("type")))
+    return hashlib.blake2b("|".join(variant).encode("utf-8"), digest_size=8).hexdigest()
+
+
+def conditional_get(etag: Callable[..., Awaitable[Optional[str]]], cache_control: str,
+                    per_user: bool = False) -> Callable:
+    """
+    Decorator for handlers whose response only changes when `etag` does.
+
+    `etag` is called with the handler's arguments (without the request) and should be cheap, it runs before the
+    handler so a matching If-None-Match is answered with a 304 without loading anything else. If it returns
+    None (usually because whatever was asked for doesn't exist), the handler runs as usual.
+    Set per_user for pages with per-user parts, the ETag then also covers who is looking.
+    """
+    def decorator(f) -> Callable:
+        async def wrapper(request: Request, *args, **kwargs) -> response.HTTPResponse:
+            tag = await etag(*args, **kwargs)
+            if tag is None:
+                return await f(request, *args, **kwargs)
+
+            if per_user:
+                tag = f'{tag[:-1]}-{_user_variant(request)}"'
+
+            headers = {"ETag": tag, "Cache-Control": cache_control}
+            if per_user:
+                headers["Vary"] = "Cookie"
+
+            if etag_matches(request, tag):
+                return response.empty(status=304, headers=headers)
+
+            result = await f(request, *args, **kwargs)
+            if isinstance(result, response.HTTPResponse) and result.status == 200:
+                result.headers.update(headers)
+            return result
+
+        wrapper.__name__ = f.__name__
+
+        return wrapper
+
+    return decorator
+
+
 def admin_only(f) -> Callable:
     async def wrapper(request: Request, *args, **kwargs) -> Union[response.HTTPResponse, Any]:
         if not request.ctx.session.get("permissions", 0) == Permission.ADMIN:
@@ -48,7 +48,7 @@ import asyncio
 import router
 from tortoise import Tortoise
 from config import config, TORTOISE_ORM
-from helpers import cachehelper
+from helpers import cachehelper, uploadhelper
 import utils
 
 
@@ -74,6 +74,14 @@ async def close_db(app, loop) -> None:
     await Tortoise.close_connections()
 
 
+@app.listener("before_server_stop")
+async def stop_precache(app, loop) -> None:
+    """
+    Stop precaching when the server stops, so it doesn't hold on to database connections.
+    """
+    cachehelper.cancel_precache()
+
+
 @app.middleware("request")
 async def set_previous_page(request) -> None:
     """
@@ -103,12 +111,18 @@ async def setup_app(app, loop) -> None:
         config=TORTOISE_ORM
     )
 
+    uploadhelper.start_upload_worker(app)
+
     # use cache on production server
 
     # check for --debug argument
     if "--debug" not in sys.argv:
         logger.info("Using cache")
         cachehelper.use_cache()
+        if config["redis"] not in ["", None, False]:
+            # separate client, cached values are binary and can't go through decode_responses
+            app.ctx.redis_cache = aioredis.from_url(config["redis"])
+            cachehelper.use_shared_cache(app.ctx.redis_cache)
         app.add_task(cachehelper.precache_all_functions())
     else:
         logger.info("Not using cache, --debug argument detected")
@@ -130,6 +144,8 @@ async def main() -> None:
         config=TORTOISE_ORM
     )
 
+    uploadhelper.start_upload_worker(app)
+
     # generate css needed for the site
     from utils import generate_tailwind_css, generate_sitemap
     generate_tailwind_css()